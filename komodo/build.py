@@ -1,54 +1,98 @@
 #!/usr/bin/env python
 
 
+import contextlib
+import fcntl
 import hashlib
-import itertools as itr
+import heapq
+import json
 import os
 import pathlib
+import re
 import stat
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
 import requests
 
+from komodo import trace
+from komodo.build_cache import FakerootCache, package_key
+from komodo.copy_tree import copy_file, copy_tree
+from komodo.jobserver import Jobserver
 from komodo.package_version import (
     LATEST_PACKAGE_ALIAS,
-    latest_pypi_version,
     strip_version,
 )
-from komodo.shell import pushd, shell
+from komodo.rpm_payload import extract_rpm
+from komodo.shell import ExecutionContext, shell
+from komodo.simple_index import pip_source_options
 
-flatten = itr.chain.from_iterable
 
-
-def dfs(pkg, version, pkgs, repo):
-    # package has no more dependencies - add the package itself
-    if "depends" not in repo[pkg][version]:
-        return [pkg]
-
-    if not all(map(pkgs.__contains__, repo[pkg][version]["depends"])):
+def _dependencies(pkg, pkgs, repo):
+    # dependencies can change based on version (i.e. version 2 depends on
+    # package X, but version 3 depends on X and Y)
+    depends = repo[pkg][pkgs[pkg]].get("depends", [])
+    if not all(map(pkgs.__contains__, depends)):
         print(
             "error: "
-            + ",".join(repo[pkg][version]["depends"])
+            + ",".join(depends)
             + " required as dependency, is not in distribution",
             file=sys.stderr,
         )
         sys.exit(1)
-
-    # dependencies can change based on version (i.e. version 2 depends on
-    # package X, but version 3 depends on X and Y)
-    dependencies = [dfs(x, pkgs[x], pkgs, repo) for x in repo[pkg][version]["depends"]]
-    dependencies.append([pkg])
-    return flatten(dependencies)
+    return depends
+
+
+def build_order(pkgs, repo):
+    """Return the packages of a release in the order they must be built.
+
+    Every package comes after all of its dependencies. Apart from that the
+    order follows the release file and the depends lists, i.e. it is the
+    post-order of a depth-first walk that visits each package only once, so
+    planning is linear in the number of dependency edges. A dependency cycle
+    is reported as an error.
+    """
+    order = []
+    done = set()
+    for root in pkgs:
+        if root in done:
+            continue
+        stack = [(root, iter(_dependencies(root, pkgs, repo)))]
+        visiting = {root}
+        while stack:
+            pkg, depends = stack[-1]
+            for dependency in depends:
+                if dependency in done:
+                    continue
+                if dependency in visiting:
+                    cycle = [name for name, _ in stack]
+                    del cycle[: cycle.index(dependency)]
+                    cycle.append(dependency)
+                    print(
+                        "error: dependency cycle: " + " -> ".join(cycle),
+                        file=sys.stderr,
+                    )
+                    sys.exit(1)
+                stack.append((dependency, iter(_dependencies(dependency, pkgs, repo))))
+                visiting.add(dependency)
+                break
+            else:
+                stack.pop()
+                visiting.discard(pkg)
+                done.add(pkg)
+                order.append(pkg)
+    return order
 
 
 def rpm(pkg, ver, path, data, prefix, *args, **kwargs):
-    # cpio always outputs to cwd, can't be overriden with switches
-    with pushd(prefix):
-        print(f"Installing {pkg} ({ver}) from rpm")
-        shell(f"rpm2cpio {path}.rpm | cpio -imd --quiet")
-        shell("rsync -a usr/* .")
-        shell("rm -rf usr")
+    print(f"Installing {pkg} ({ver}) from rpm")
+    # the files in usr/ of the rpm go straight into the prefix
+    extract_rpm(f"{path}.rpm", prefix)
 
 
 # When running cmake we pass the option -DDEST_PREFIX=fakeroot, this is an
@@ -71,78 +115,223 @@ def cmake(
     jobs,
     *args,
     cmake="cmake",
+    cmake_generator=None,
+    cmake_build_dirs=None,
     **kwargs,
 ):
-    bdir = f"{pkg}-{ver}-build"
-    if builddir is not None:
-        bdir = os.path.join(builddir, bdir)
-
     fakeroot = kwargs["fakeroot"]
     fakeprefix = fakeroot + prefix
 
-    flags = [
-        "-DCMAKE_BUILD_TYPE=Release",
+    options = ["-DCMAKE_BUILD_TYPE=Release", "-DBUILD_SHARED_LIBS=ON"]
+    if kwargs.get("compiler_cache") is not None:
+        options += kwargs["compiler_cache"].cmake_flags()
+    flags = options + [
         f"-DBOOST_ROOT={fakeprefix}",
-        "-DBUILD_SHARED_LIBS=ON",
         f"-DCMAKE_PREFIX_PATH={fakeprefix}",
         f"-DCMAKE_MODULE_PATH={fakeprefix}/share/cmake/Modules",
         f"-DCMAKE_INSTALL_PREFIX={prefix}",
         f"-DDEST_PREFIX={fakeroot}",
     ]
+    if cmake_generator is not None:
+        flags.append(f"-G{cmake_generator}")
 
-    Path(bdir).mkdir(parents=True, exist_ok=True)
-    with pushd(bdir):
-        os.environ["LD_LIBRARY_PATH"] = kwargs.get("ld_lib_path")
-        _pre_PATH = os.environ["PATH"]
-        os.environ["PATH"] = kwargs.get("binpath")
+    bdir = f"{pkg}-{ver}-build"
+    if cmake_build_dirs is not None:
+        # a kept build directory is reused by every release with the same
+        # configuration; the paths of the release are given to each configure
+        configuration = json.dumps(
+            [pkg, ver, options, makeopts, cmake_generator]
+        ).encode("utf-8")
+        bdir = f"{pkg}-{ver}-{hashlib.sha256(configuration).hexdigest()[:16]}"
+        bdir = os.path.join(cmake_build_dirs, bdir)
+    elif builddir is not None:
+        bdir = os.path.join(builddir, bdir)
+    context = kwargs["context"].chdir(bdir)
 
-        print(f"Installing {pkg} ({ver}) from source with cmake")
-        shell([cmake, path] + flags + [makeopts])
-        print(shell(f"make -j{jobs}"))
-        print(shell(f"make DESTDIR={fakeroot} install"))
+    Path(context.cwd).mkdir(parents=True, exist_ok=True)
+    context = context.setenv(
+        LD_LIBRARY_PATH=kwargs.get("ld_lib_path"),
+        PATH=kwargs.get("binpath"),
+    )
 
-        del os.environ["LD_LIBRARY_PATH"]
-        os.environ["PATH"] = _pre_PATH
+    print(f"Installing {pkg} ({ver}) from source with cmake")
+    if cmake_build_dirs is not None and (Path(context.cwd) / "CMakeCache.txt").exists():
+        print(f"Reusing the cmake build directory {context.cwd}")
+    shell([cmake, path] + flags + [makeopts], context=context)
+    jobserver = kwargs.get("jobserver")
+    ninja = cmake_generator is not None and "Ninja" in cmake_generator
+    if jobserver is not None and not (ninja and not _ninja_jobserver(context)):
+        # make, and ninja from 1.13, take their job slots from MAKEFLAGS
+        build_jobs = contextlib.nullcontext(None)
+    else:
+        build_jobs = _job_share(jobs, jobserver)
+    with build_jobs as share:
+        parallel = f"-j{share}" if share is not None else ""
+        if cmake_generator is None:
+            _run_and_print(["make", parallel], context)
+        else:
+            _run_and_print([cmake, "--build . --", parallel], context)
+    if cmake_build_dirs is not None:
+        # DESTDIR is set in the context; the prefix is given here, as another
+        # release may have configured the build directory last
+        _run_and_print([cmake, f"--install . --prefix {prefix}"], context)
+    elif cmake_generator is None:
+        _run_and_print(f"make DESTDIR={fakeroot} install", context)
+    else:
+        # DESTDIR is set in the context, which every generator honours
+        _run_and_print([cmake, "--build . --target install"], context)
+
+
+def _ninja_jobserver(context):
+    """Whether the ninja of context takes its job slots from a jobserver in
+    MAKEFLAGS, which it does from release 1.13."""
+    try:
+        version = shell("ninja --version", context=context, stream=False)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    release = tuple(int(part) for part in re.findall(r"\d+", version.decode())[:2])
+    return release >= (1, 13)
+
+
+def _job_share(jobs, jobserver):
+    """A context yielding the number of jobs for a tool that is no client of
+    jobserver: all jobs without a jobserver, and otherwise the slots the
+    package can take from it."""
+    if jobserver is None or jobs is None:
+        return contextlib.nullcontext(jobs)
+    return jobserver.share(jobs)
+
+
+def _run_and_print(cmd, context):
+    """Run cmd and print its output, unless it was streamed already."""
+    output = shell(cmd, context=context)
+    if not context.stream:
+        print(output)
 
 
 def sh(pkg, ver, pkgpath, data, prefix, makefile, *args, **kwargs):
     makefile = data.get(makefile)
+    binpath = kwargs["binpath"]
+    if kwargs.get("compiler_cache") is not None:
+        binpath = kwargs["compiler_cache"].path_with_compilers(binpath)
+
+    jobs = kwargs.get("jobs")
+    context = kwargs["context"].chdir(pkgpath)
+    # the scripts run make with $MAKE_JOBS, and other tools (b2, setup.py)
+    # with --jobs
+    if kwargs.get("jobserver") is not None:
+        # make takes its slots from the jobserver in MAKEFLAGS, the other
+        # tools are no clients of it and run one job in the slot of the
+        # package
+        context = context.setenv(MAKE_JOBS="")
+        jobs = 1
+    elif jobs is not None:
+        context = context.setenv(MAKE_JOBS=f"-j{jobs}")
 
-    with pushd(pkgpath):
-        cmd = [
-            f"bash {makefile} --prefix {prefix}",
-            f"--fakeroot {kwargs['fakeroot']}",
-            f"--python {prefix}/bin/python",
-        ]
-        if "jobs" in kwargs:
-            cmd.append(f"--jobs {kwargs['jobs']}")
-        if "cmake" in kwargs:
-            cmd.append(f"--cmake {kwargs['cmake']}")
-        cmd.append(f"--pythonpath {kwargs['pythonpath']}")
-        cmd.append(f"--path {kwargs['binpath']}")
-        cmd.append(f"--pip {kwargs['pip']}")
-        cmd.append(f"--virtualenv {kwargs['virtualenv']}")
-        cmd.append(f"--ld-library-path {kwargs['ld_lib_path']}")
-        cmd.append(kwargs.get("makeopts"))
-
-        print(f"Installing {pkg} ({ver}) from sh")
-        shell(cmd)
-
-
-def rsync(pkg, ver, pkgpath, data, prefix, *args, **kwargs):
+    cmd = [
+        f"bash {makefile} --prefix {prefix}",
+        f"--fakeroot {kwargs['fakeroot']}",
+        f"--python {prefix}/bin/python",
+    ]
+    if jobs is not None:
+        cmd.append(f"--jobs {jobs}")
+    if "cmake" in kwargs:
+        cmd.append(f"--cmake {kwargs['cmake']}")
+    cmd.append(f"--pythonpath {kwargs['pythonpath']}")
+    cmd.append(f"--path {binpath}")
+    cmd.append(f"--pip {kwargs['pip']}")
+    cmd.append(f"--virtualenv {kwargs['virtualenv']}")
+    cmd.append(f"--ld-library-path {kwargs['ld_lib_path']}")
+    cmd.append(kwargs.get("makeopts"))
+
+    print(f"Installing {pkg} ({ver}) from sh")
+    shell(cmd, context=context)
+
+
+def rsync(pkg, ver, pkgpath, data, prefix, *args, copy_mode="rsync", **kwargs):
     print(f"Installing {pkg} ({ver}) with rsync")
     # assume a root-like layout in the pkgpath dir, and just copy it
+    if copy_mode != "rsync" and not kwargs.get("makeopts"):
+        copy_tree(pkgpath, kwargs["fakeroot"] + prefix, mode=copy_mode)
+        return
     shell(
         [
             "rsync -am",
             kwargs.get("makeopts"),
             f"{pkgpath}/",
             kwargs["fakeroot"] + prefix,
-        ]
+        ],
+        context=kwargs["context"],
     )
 
 
-def download(pkg, ver, pkgpath, data, prefix, *args, **kwargs):
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+_session = None
+_session_lock = threading.Lock()
+
+
+def download_session():
+    """The HTTP session shared by all downloads, so connections are reused."""
+    global _session  # pylint: disable=global-statement
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount(
+                "https://",
+                requests.adapters.HTTPAdapter(max_retries=20, pool_maxsize=32),
+            )
+        return _session
+
+
+def fetch_url(url, path, sha256_hex):
+    """Download url to path, checking its sha256.
+
+    The data goes to path.partial first, which is renamed to path once its
+    hash is verified. A partial file left by an interrupted download is
+    resumed with a Range request, if the server supports it."""
+    partial = f"{path}.partial"
+    sha256 = hashlib.sha256()
+    offset = 0
+    if os.path.exists(partial):
+        with open(partial, "rb") as existing:
+            for chunk in iter(lambda: existing.read(_DOWNLOAD_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+                offset += len(chunk)
+
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with download_session().get(url, stream=True, headers=headers) as response:
+        if offset and response.status_code == 206:
+            print(f"Resuming the download of {url} at byte {offset}")
+            mode = "ab"
+        elif response.status_code == 200:
+            sha256, mode = hashlib.sha256(), "wb"
+        elif offset and response.status_code == 416:
+            # the partial file is already complete
+            mode = None
+        else:
+            raise RuntimeError(
+                f"GET request to {url} returned status code {response.status_code}"
+            )
+        if mode is not None:
+            with open(partial, mode) as file_handle:
+                for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+                    file_handle.write(chunk)
+                    sha256.update(chunk)
+
+    if sha256.hexdigest() != sha256_hex:
+        os.remove(partial)
+        if offset:
+            # the partial file was left by a different file, start over
+            fetch_url(url, path, sha256_hex)
+            return
+        raise ValueError(
+            f"Hash of downloaded file ({sha256.hexdigest()}) "
+            "not equal to expected hash."
+        )
+    os.replace(partial, path)
+
+
+def download(pkg, ver, pkgpath, data, prefix, *args, download_store=None, **kwargs):
     print(f"Installing {pkg} ({ver}) with download")
 
     url = kwargs["url"]
@@ -158,27 +347,26 @@ def download(pkg, ver, pkgpath, data, prefix, *args, **kwargs):
     fakeprefix = pathlib.Path(kwargs["fakeroot"] + prefix)
     dest_path = fakeprefix / kwargs["destination"]
 
-    session = requests.Session()
-    session.mount("https://", requests.adapters.HTTPAdapter(max_retries=20))
-    response = session.get(url, stream=True)
-
-    if response.status_code != 200:
-        raise RuntimeError(
-            f"GET request to {url} returned status code {response.status_code}"
-        )
-
-    sha256 = hashlib.sha256()
-
-    with open(dest_path, "wb") as file_handle:
-        for chunk in response.iter_content(chunk_size=1024):
-            file_handle.write(chunk)
-            sha256.update(chunk)
-
-    if sha256.hexdigest() != hash_value:
-        raise ValueError(
-            f"Hash of downloaded file ({sha256.hexdigest()}) "
-            "not equal to expected hash."
-        )
+    if download_store is None:
+        fetch_url(url, dest_path, hash_value)
+    else:
+        # files are stored by their hash, so any release can use them
+        stored = pathlib.Path(download_store) / hash_value[:2] / hash_value
+        stored.parent.mkdir(parents=True, exist_ok=True)
+        # other runs sharing the store wait rather than write the same
+        # partial file
+        with open(stored.with_name(f"{hash_value}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if stored.exists():
+                    print(f"Using {url} from the download store")
+                else:
+                    fetch_url(url, stored, hash_value)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        partial = dest_path.with_name(f".{dest_path.name}.partial")
+        copy_file(str(stored), str(partial), mode="reflink")
+        os.replace(partial, dest_path)
 
     # Add executable permission if in bin folder:
     if "bin" in dest_path.parts:
@@ -189,23 +377,54 @@ def download(pkg, ver, pkgpath, data, prefix, *args, **kwargs):
 
 def pip_install(pkg, ver, pkgpath, data, prefix, dlprefix, *args, pip="pip", **kwargs):
     ver = strip_version(ver)
-    if ver == LATEST_PACKAGE_ALIAS:
-        ver = latest_pypi_version(pkg)
     cmd = [
         pip,
         f"install {pkg}=={strip_version(ver)}",
         f"--root {kwargs['fakeroot']}",
         f"--prefix {prefix}",
-        "--no-index",
         "--no-deps",
         "--ignore-installed",
         f"--cache-dir {dlprefix}",
-        f"--find-links {dlprefix}",
+        *pip_source_options(dlprefix),
         kwargs.get("makeopts", ""),
     ]
 
     print(f"Installing {pkg} ({ver}) from pip")
-    shell(cmd)
+    shell(cmd, context=kwargs["context"])
+
+
+def pip_install_batch(requirements, prefix, dlprefix, pip="pip", **kwargs):
+    """Install several pip packages with a single pip invocation.
+
+    requirements is a list of (pypi name, version) pairs. This saves starting
+    pip and scanning the download cache once for every package."""
+    pins = []
+    for pkg, ver in requirements:
+        ver = strip_version(ver)
+        pins.append(f"{pkg}=={strip_version(ver)}")
+
+    handle, requirements_file = tempfile.mkstemp(
+        prefix="komodo-requirements-", suffix=".txt"
+    )
+    with os.fdopen(handle, "w") as requirements_txt:
+        requirements_txt.write("\n".join(pins) + "\n")
+
+    cmd = [
+        pip,
+        f"install -r {requirements_file}",
+        f"--root {kwargs['fakeroot']}",
+        f"--prefix {prefix}",
+        "--no-deps",
+        "--ignore-installed",
+        f"--cache-dir {dlprefix}",
+        *pip_source_options(dlprefix),
+    ]
+
+    print(f"Installing {', '.join(pins)} from pip")
+    try:
+        shell(cmd, context=kwargs["context"])
+    finally:
+        os.remove(requirements_file)
 
 
 def noop(pkg, ver, *args, **kwargs):
@@ -225,6 +444,21 @@ def pypaths(prefix, version):
     )
 
 
+def package_path(pkg, ver, dlprefix=None):
+    """The absolute path of the fetched sources of a package."""
+    return os.path.abspath(os.path.join(dlprefix or "", f"{pkg}-{ver}"))
+
+
+def resolve_makeopts(entry, prefix):
+    """The makeopts of a repository entry as passed to its builder, with the
+    extra_makeopts environment variable appended and $(prefix) expanded."""
+    makeopts = entry.get("makeopts", "")
+    extra_makeopts = os.environ.get("extra_makeopts")
+    if extra_makeopts:
+        makeopts = " ".join((makeopts, extra_makeopts))
+    return makeopts.replace("$(prefix)", prefix)
+
+
 def make(
     pkgs,
     repo,
@@ -237,16 +471,22 @@ def make(
     pip="pip",
     virtualenv=None,
     fakeroot=".",
+    package_jobs=1,
+    build_cache=None,
+    journal=None,
+    batch_pip=False,
+    history=None,
+    compiler_cache=None,
+    cmake_generator=None,
+    cmake_build_dirs=None,
+    copy_mode="rsync",
+    download_store=None,
+    stream_output=False,
+    log_dir=None,
+    command_timeout=None,
+    pypi_versions=None,
 ):
-    xs = flatten(dfs(pkg, ver, pkgs, repo) for pkg, ver in pkgs.items())
-
-    seen = set()
-    pkgorder = []
-    for x in xs:
-        if x in seen:
-            continue
-        seen.add(x)
-        pkgorder.append(x)
+    pkgorder = build_order(pkgs, repo)
 
     fakeprefix = fakeroot + prefix
     shell(["mkdir -p", fakeprefix])
@@ -255,8 +495,17 @@ def make(
     # assuming there always is a python *and* that python will be installed
     # before pip is required. This dependency *must* be explicit in the
     # repository
-    os.environ["DESTDIR"] = fakeroot
-    os.environ["BOOST_ROOT"] = fakeprefix
+    context = ExecutionContext(
+        stream=stream_output or log_dir is not None, timeout=command_timeout
+    ).setenv(DESTDIR=fakeroot, BOOST_ROOT=fakeprefix)
+    if compiler_cache is not None:
+        context = context.setenv(**compiler_cache.environment())
+    jobserver = None
+    if package_jobs > 1 and jobs > 1:
+        # concurrent packages share one budget of jobs instead of taking
+        # jobs each
+        jobserver = Jobserver(jobs)
+        context = jobserver.apply(context)
     build_ld_lib_path = ":".join(
         filter(
             None,
@@ -267,17 +516,9 @@ def make(
             ],
         )
     )
-    extra_makeopts = os.environ.get("extra_makeopts")
     build_pythonpath = pypaths(fakeprefix, pkgs.get("python"))
     build_path = ":".join([os.path.join(fakeprefix, "bin"), os.environ["PATH"]])
 
-    pkgpaths = [f"{pkg}-{pkgs[pkg]}" for pkg in pkgorder]
-    if dlprefix:
-        pkgpaths = [os.path.join(dlprefix, path) for path in pkgpaths]
-
-    def resolve(x):
-        return x.replace("$(prefix)", prefix)
-
     build = {
         "rpm": rpm,
         "cmake": cmake,
@@ -288,11 +529,34 @@ def make(
         "download": download,
     }
 
-    for pkg, path in zip(pkgorder, pkgpaths):
+    def package_context(name, ver=None):
+        """The context of the commands of a package, logging to its own file
+        in log_dir, and labelling its lines when packages build together."""
+        label = name if package_jobs > 1 else None
+        if log_dir is None:
+            return context.logging_to(None, label) if context.stream else context
+        os.makedirs(log_dir, exist_ok=True)
+        log = os.path.join(log_dir, f"{name}-{ver}.log" if ver else f"{name}.log")
+        with open(log, "wb"):
+            pass
+        return context.logging_to(log, label)
+
+    tasks = {}
+    keys = {}
+    for pkg in pkgorder:
         ver = pkgs[pkg]
         current = repo[pkg][ver]
         make = current["make"]
-        pkgpath = os.path.abspath(path)
+        if ver == LATEST_PACKAGE_ALIAS and make == "pip":
+            # resolved once by fetch, so that the release is built from what
+            # was downloaded
+            if pkg not in (pypi_versions or {}):
+                raise ValueError(
+                    f"{pkg} has version {LATEST_PACKAGE_ALIAS}, "
+                    "but no resolved version is given in pypi_versions"
+                )
+            ver = pypi_versions[pkg]
+        pkgpath = package_path(pkg, ver, dlprefix)
 
         download_keys = ["url", "destination", "hash"]
         if any(key in current for key in download_keys) and make != "download":
@@ -309,30 +573,310 @@ def make(
 
         package_name = current.get("pypi_package_name", pkg)
 
-        if extra_makeopts:
-            oldopts = current.get("makeopts", "")
-            current["makeopts"] = " ".join((oldopts, extra_makeopts))
+        current["makeopts"] = resolve_makeopts(current, prefix)
+        tasks[pkg] = (
+            build[make],
+            (package_name, ver, pkgpath, data),
+            {
+                "prefix": prefix,
+                "builddir": builddir,
+                "makeopts": current.get("makeopts"),
+                "makefile": current.get("makefile"),
+                "dlprefix": dlprefix,
+                "jobs": jobs,
+                "cmake": cmk,
+                "cmake_generator": cmake_generator,
+                "cmake_build_dirs": cmake_build_dirs,
+                "pip": pip,
+                "virtualenv": virtualenv,
+                "fakeroot": fakeroot,
+                "pythonpath": build_pythonpath,
+                "binpath": build_path,
+                "ld_lib_path": build_ld_lib_path,
+                "url": current.get("url"),
+                "destination": current.get("destination"),
+                "hash": current.get("hash"),
+                "compiler_cache": compiler_cache,
+                "jobserver": jobserver,
+                "copy_mode": copy_mode,
+                "download_store": download_store,
+                "context": package_context(pkg, ver),
+            },
+        )
+        if build_cache is not None or journal is not None:
+            keys[pkg] = package_key(
+                pkg,
+                ver,
+                current,
+                prefix,
+                [keys[dep] for dep in current.get("depends", [])],
+                data=data,
+                pkgpath=pkgpath,
+            )
 
-        current["makeopts"] = resolve(current.get("makeopts", ""))
-        build[make](
-            package_name,
-            ver,
-            pkgpath,
-            data,
+    cache = None
+    if build_cache is not None:
+        cache = FakerootCache(build_cache, keys, fakeroot)
+
+    pip_batch = None
+    if batch_pip:
+        pip_batch = PipBatch(
+            {
+                pkg: tasks[pkg][1][:2]
+                for pkg in pkgorder
+                if repo[pkg][pkgs[pkg]]["make"] == "pip"
+                and not repo[pkg][pkgs[pkg]]["makeopts"].strip()
+            },
             prefix=prefix,
-            builddir=builddir,
-            makeopts=current.get("makeopts"),
-            makefile=current.get("makefile"),
             dlprefix=dlprefix,
-            jobs=jobs,
-            cmake=cmk,
             pip=pip,
-            virtualenv=virtualenv,
             fakeroot=fakeroot,
-            pythonpath=build_pythonpath,
-            binpath=build_path,
-            ld_lib_path=build_ld_lib_path,
-            url=current.get("url"),
-            destination=current.get("destination"),
-            hash=current.get("hash"),
+            context=package_context("pip"),
+        )
+
+    dependencies = {pkg: repo[pkg][pkgs[pkg]].get("depends", []) for pkg in pkgorder}
+    run = build_in_parallel if package_jobs > 1 else build_in_sequence
+    durations = {}
+    if compiler_cache is not None:
+        compiler_cache.start(context)
+    try:
+        run(
+            pkgorder,
+            dependencies,
+            tasks,
+            package_jobs,
+            cache=cache,
+            journal=journal,
+            keys=keys,
+            pip_batch=pip_batch,
+            durations=durations,
+            jobserver=jobserver,
         )
+    finally:
+        if jobserver is not None:
+            jobserver.close()
+        if history is not None:
+            for pkg, seconds in durations.items():
+                # the version built, as resolved for pip packages at *
+                ver = tasks[pkg][1][1]
+                history.record(pkg, ver, repo[pkg][pkgs[pkg]]["make"], seconds)
+            history.compact()
+        if compiler_cache is not None:
+            compiler_cache.report(context)
+
+
+def build_in_sequence(
+    pkgorder,
+    dependencies,
+    tasks,
+    package_jobs=1,
+    cache=None,
+    journal=None,
+    keys=None,
+    pip_batch=None,
+    durations=None,
+    jobserver=None,
+):
+    """Run the build tasks of a release one after another, in pkgorder. The
+    arguments are the same as for build_in_parallel, which see."""
+    if durations is None:
+        durations = {}
+    batch = []
+
+    def install_batch():
+        if not batch:
+            return
+        builder, args, kwargs = pip_batch.task(batch)
+        seconds = run_task(", ".join(batch), builder, args, kwargs)
+        for pkg in batch:
+            durations[pkg] = seconds / len(batch)
+            if journal is not None:
+                journal.record(pkg, keys[pkg])
+        batch.clear()
+
+    for pkg in pkgorder:
+        if journal is not None and journal.is_done(pkg, keys[pkg]):
+            print(f"Skipping {pkg}, it was installed by a previous run")
+            continue
+        if cache is not None and cache.restore(pkg):
+            if journal is not None:
+                journal.record(pkg, keys[pkg])
+            continue
+        if pip_batch is not None and pkg in pip_batch:
+            if set(batch) & set(dependencies[pkg]):
+                install_batch()
+            batch.append(pkg)
+            continue
+
+        install_batch()
+        if cache is not None:
+            cache.begin(pkg)
+        builder, args, kwargs = tasks[pkg]
+        durations[pkg] = run_task(pkg, builder, args, kwargs)
+        if cache is not None:
+            cache.end(pkg)
+        if journal is not None:
+            journal.record(pkg, keys[pkg])
+    install_batch()
+
+
+def run_task(name, builder, args, kwargs, jobserver=None):
+    """Run a build task and return how many seconds it took, not counting
+    the time spent waiting for a slot of the jobserver."""
+    slot = jobserver.slot() if jobserver is not None else contextlib.nullcontext()
+    with slot:
+        start = time.monotonic()
+        with trace.span(name, "package", builder=builder.__name__):
+            builder(*args, **kwargs)
+        return time.monotonic() - start
+
+
+def build_in_parallel(
+    pkgorder,
+    dependencies,
+    tasks,
+    package_jobs,
+    cache=None,
+    journal=None,
+    keys=None,
+    pip_batch=None,
+    durations=None,
+    jobserver=None,
+):
+    """Run the build tasks of a release concurrently.
+
+    A package is started as soon as all of its dependencies have been built,
+    and at most package_jobs packages are built at the same time. Packages
+    that are ready at the same time are started in the order they have in
+    pkgorder. After the first failure no new package is started; the packages
+    that are already running are allowed to finish before the error is
+    re-raised.
+
+    The builders run their commands in the ExecutionContext they are given
+    and leave the working directory and environment of the process alone, so
+    the packages are built in worker threads.
+
+    Args:
+        pkgorder: All packages in a valid sequential build order.
+        dependencies: Mapping from package to the packages it depends on.
+        tasks: Mapping from package to a (function, args, kwargs) tuple.
+        package_jobs: The maximum number of packages to build concurrently.
+        cache: An optional FakerootCache. Cache hits are restored instead of
+            built, and builds that ran alone are stored.
+        journal: An optional BuildJournal. Packages it has recorded with
+            their current key are skipped, and completed packages are
+            recorded.
+        keys: Mapping from package to its package key, required with journal.
+        pip_batch: An optional PipBatch. All of its packages that are ready
+            at the same time are installed together in one task.
+        durations: An optional dict that is filled with the number of
+            seconds each package that was built took. A batch is divided
+            evenly between its packages.
+        jobserver: An optional Jobserver. Every task holds one of its slots
+            while it runs, so a task only starts when the packages that are
+            already building leave a job free.
+    """
+    if durations is None:
+        durations = {}
+    position = {pkg: index for index, pkg in enumerate(pkgorder)}
+    remaining = {pkg: set(dependencies.get(pkg, [])) for pkg in pkgorder}
+    dependents = {pkg: [] for pkg in pkgorder}
+    for pkg in pkgorder:
+        for dependency in remaining[pkg]:
+            dependents[dependency].append(pkg)
+
+    ready = [position[pkg] for pkg in pkgorder if not remaining[pkg]]
+    heapq.heapify(ready)
+    running = {}
+    failure = None
+
+    def finished(pkg):
+        if journal is not None:
+            journal.record(pkg, keys[pkg])
+        for dependent in dependents[pkg]:
+            remaining[dependent].discard(pkg)
+            if not remaining[dependent]:
+                heapq.heappush(ready, position[dependent])
+
+    def skip(pkg):
+        """Finish pkg without building it, if the journal or cache allow."""
+        if journal is not None and journal.is_done(pkg, keys[pkg]):
+            print(f"Skipping {pkg}, it was installed by a previous run")
+        elif cache is None or not cache.restore(pkg):
+            return False
+        finished(pkg)
+        return True
+
+    with ThreadPoolExecutor(max_workers=package_jobs) as executor:
+        while ready or running:
+            while ready and failure is None and len(running) < package_jobs:
+                pkg = pkgorder[heapq.heappop(ready)]
+                if cache is not None:
+                    for group in running.values():
+                        for other in group:
+                            cache.forget(other)
+                if skip(pkg):
+                    continue
+
+                group = [pkg]
+                if pip_batch is not None and pkg in pip_batch:
+                    others = [pkgorder[index] for index in ready]
+                    ready.clear()
+                    for other in others:
+                        if other in pip_batch and not skip(other):
+                            group.append(other)
+                        elif other not in pip_batch:
+                            heapq.heappush(ready, position[other])
+                    builder, args, kwargs = pip_batch.task(group)
+                else:
+                    if cache is not None and not running:
+                        cache.begin(pkg)
+                    builder, args, kwargs = tasks[pkg]
+                future = executor.submit(
+                    run_task, ", ".join(group), builder, args, kwargs, jobserver
+                )
+                running[future] = group
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                group = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    print(
+                        f"error: building {', '.join(group)} failed: {err}",
+                        file=sys.stderr,
+                    )
+                    if failure is None:
+                        failure = err
+                    continue
+
+                for pkg in group:
+                    durations[pkg] = seconds / len(group)
+                    if cache is not None:
+                        cache.end(pkg)
+                    finished(pkg)
+
+    if failure is not None:
+        raise failure
+
+
+class PipBatch(object):
+    def __init__(self, packages, **kwargs):
+        """The pip packages of a release that may be installed together.
+
+        packages maps each package to its (pypi name, version) and kwargs are
+        passed on to pip_install_batch. Packages with makeopts of their own
+        are left out and installed one by one."""
+        self.packages = packages
+        self.kwargs = kwargs
+
+    def __contains__(self, pkg):
+        return pkg in self.packages
+
+    def task(self, pkgs):
+        requirements = [self.packages[pkg] for pkg in pkgs]
+        return pip_install_batch, (requirements,), self.kwargs
@@ -0,0 +1,237 @@
+import contextlib
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+import time
+
+from komodo.package_version import LATEST_PACKAGE_ALIAS, get_git_revision_hash
+
+_ARCHIVE_SUFFIX = ".tar.gz"
+
+
+def package_key(pkg, ver, entry, prefix, dependency_keys, data=None, pkgpath=None):
+    """Compute the cache key of a package build.
+
+    The key covers everything that decides what the builder installs: the
+    package version and repository entry (including the resolved makeopts),
+    the install prefix, the contents of the build script used by `make: sh`,
+    the commit of git sources and the keys of all dependencies, which makes
+    the key depend on the transitive dependencies as well.
+
+    Returns None for packages that cannot be cached because their version
+    is only resolved at build time.
+    """
+    if ver == LATEST_PACKAGE_ALIAS or None in dependency_keys:
+        return None
+
+    inputs = {
+        "package": pkg,
+        "version": ver,
+        "entry": entry,
+        "prefix": prefix,
+        "dependencies": sorted(dependency_keys),
+    }
+    if data is not None and entry.get("makefile"):
+        with open(data.get(entry["makefile"]), "rb") as script:
+            inputs["makefile"] = hashlib.sha256(script.read()).hexdigest()
+    if entry.get("fetch") == "git" and pkgpath and os.path.isdir(pkgpath):
+        inputs["revision"] = get_git_revision_hash(path=pkgpath)
+
+    serialized = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+# directories modified this long before a snapshot was taken are listed again
+# by the next one, as the clock of file times can lag behind time.time_ns()
+_RACY_NS = 1_000_000_000
+
+
+class Snapshot(object):
+    def __init__(self, entries, directories, time_ns):
+        """The state of every file, link and directory below a root, taken at
+        time_ns. entries maps each path relative to the root to the mtime,
+        size and inode of a file or link, or to None for a directory.
+        directories maps each directory to its mtime and inode and the names
+        in it."""
+        self.entries = entries
+        self.directories = directories
+        self.time_ns = time_ns
+
+
+def snapshot(root, previous=None):
+    """Record the state of every file, link and directory below root.
+
+    Creating, removing or renaming an entry changes the mtime of its
+    directory. With previous, an earlier snapshot of root, only the
+    directories whose mtime changed since are listed again, and the names in
+    the others are taken from previous. Every file is still stat'ed, so
+    files rewritten in place are found wherever they are."""
+    time_ns = time.time_ns()
+    entries = {}
+    directories = {}
+    pending = [""]
+    while pending:
+        relpath = pending.pop()
+        try:
+            stat = os.lstat(os.path.join(root, relpath))
+        except FileNotFoundError:
+            # like os.walk, skip directories that are gone, and a missing root
+            continue
+        stamp = (stat.st_mtime_ns, stat.st_ino)
+        known = previous.directories.get(relpath) if previous is not None else None
+        if (
+            known is not None
+            and known[0] == stamp
+            and stamp[0] < previous.time_ns - _RACY_NS
+        ):
+            names = known[1]
+            for name in names:
+                path = os.path.join(relpath, name)
+                if previous.entries[path] is None:
+                    entries[path] = None
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    stat = os.lstat(os.path.join(root, path))
+                    entries[path] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        else:
+            names = []
+            with os.scandir(os.path.join(root, relpath)) as listing:
+                for entry in listing:
+                    path = os.path.join(relpath, entry.name)
+                    names.append(entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        entries[path] = None
+                    else:
+                        stat = entry.stat(follow_symlinks=False)
+                        entries[path] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        directories[relpath] = (stamp, names)
+        pending.extend(
+            os.path.join(relpath, name)
+            for name in names
+            if os.path.join(relpath, name) in entries
+            and entries[os.path.join(relpath, name)] is None
+        )
+    return Snapshot(entries, directories, time_ns)
+
+
+def changed_paths(before, after):
+    """The paths that were created or modified between two snapshots."""
+    return sorted(
+        path
+        for path, state in after.entries.items()
+        if path not in before.entries or before.entries[path] != state
+    )
+
+
+class BuildCache(object):
+    def __init__(self, path, max_size=None):
+        """A directory of compressed archives, one per package build, holding
+        the files the build installed into the fakeroot. Archives are named by
+        their package key. When max_size (in bytes) is given, the least
+        recently used archives are evicted to stay below it."""
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        os.makedirs(self.path, exist_ok=True)
+
+    def _archive(self, key):
+        return os.path.join(self.path, key + _ARCHIVE_SUFFIX)
+
+    def __contains__(self, key):
+        return key is not None and os.path.exists(self._archive(key))
+
+    def restore(self, key, fakeroot):
+        """Unpack the archive for key into fakeroot. Returns False on a miss."""
+        if key not in self:
+            return False
+        archive = self._archive(key)
+        with tarfile.open(archive, "r:gz") as tar:
+            if hasattr(tarfile, "tar_filter"):
+                tar.extractall(fakeroot, filter="tar")
+            else:
+                tar.extractall(fakeroot)
+        # the modification time of an archive is its last use
+        os.utime(archive)
+        return True
+
+    def store(self, key, fakeroot, paths):
+        """Archive paths, relative to fakeroot, under key."""
+        if key is None or not paths:
+            return
+        handle, partial = tempfile.mkstemp(
+            dir=self.path, prefix=f".{key}.", suffix=_ARCHIVE_SUFFIX
+        )
+        os.close(handle)
+        try:
+            with tarfile.open(partial, "w:gz") as tar:
+                for path in paths:
+                    tar.add(os.path.join(fakeroot, path), arcname=path, recursive=False)
+            os.replace(partial, self._archive(key))
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used archives until the cache fits in
+        max_size."""
+        if self.max_size is None:
+            return
+        archives = []
+        for name in os.listdir(self.path):
+            if name.startswith(".") or not name.endswith(_ARCHIVE_SUFFIX):
+                continue
+            stat = os.stat(os.path.join(self.path, name))
+            archives.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in archives)
+        for _, size, name in sorted(archives):
+            if total <= self.max_size:
+                break
+            print(f"Evicting {name} from the build cache")
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+
+class FakerootCache(object):
+    def __init__(self, cache, keys, fakeroot):
+        """Use a BuildCache for the packages of one release. keys maps each
+        package to its package key.
+
+        The files a build installed are found by comparing snapshots of the
+        fakeroot taken before and after the build, so a build is only stored
+        when nothing else wrote to the fakeroot while it ran. Each snapshot
+        starts from the one before it, and only lists the directories that
+        changed since, but compares every file. Call begin() before a build
+        starts alone, forget() when another build starts next to it, and
+        end() when it has succeeded."""
+        self.cache = cache
+        self.keys = keys
+        self.fakeroot = fakeroot
+        self._before = {}
+        self._last = None
+
+    def _snapshot(self):
+        self._last = snapshot(self.fakeroot, self._last)
+        return self._last
+
+    def restore(self, pkg):
+        if not self.cache.restore(self.keys.get(pkg), self.fakeroot):
+            return False
+        print(f"Restored {pkg} from the build cache")
+        return True
+
+    def begin(self, pkg):
+        if self.keys.get(pkg) is not None:
+            self._before[pkg] = self._snapshot()
+
+    def forget(self, pkg):
+        self._before.pop(pkg, None)
+
+    def end(self, pkg):
+        before = self._before.pop(pkg, None)
+        if before is None:
+            return
+        paths = changed_paths(before, self._snapshot())
+        self.cache.store(self.keys[pkg], self.fakeroot, paths)
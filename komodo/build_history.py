@@ -0,0 +1,79 @@
+import json
+import os
+import time
+
+# only the most recent builds of a package are used for estimates
+_RECENT_BUILDS = 5
+
+
+class BuildHistory(object):
+    def __init__(self, path):
+        """Durations of earlier package builds, appended as lines of JSON to
+        the file at path by make(), which compacts the file to the most recent
+        builds of each package version afterwards."""
+        self.path = path
+
+    def record(self, pkg, version, builder, seconds):
+        entry = {
+            "package": pkg,
+            "version": version,
+            "builder": builder,
+            "seconds": round(seconds, 3),
+            "time": int(time.time()),
+        }
+        with open(self.path, "a", encoding="utf-8") as history:
+            history.write(json.dumps(entry) + "\n")
+
+    def compact(self):
+        """Drop all but the most recent builds of each package version, which
+        are all that durations() uses."""
+        entries = self.entries()
+        kept, counts = [], {}
+        for entry in reversed(entries):
+            key = (entry["package"], entry["version"])
+            counts[key] = counts.get(key, 0) + 1
+            if counts[key] <= _RECENT_BUILDS:
+                kept.append(entry)
+        if len(kept) == len(entries):
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as history:
+            for entry in reversed(kept):
+                history.write(json.dumps(entry) + "\n")
+        os.replace(tmp, self.path)
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, "r", encoding="utf-8") as history:
+            for line in history:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        return entries
+
+    def durations(self, pkgs):
+        """Estimate the build duration in seconds of each package in pkgs, a
+        mapping from package to version.
+
+        The estimate is the mean of the most recent builds of the same version,
+        falling back to the most recent builds of any version. Packages that
+        have never been built are left out."""
+        same_version, any_version = {}, {}
+        for entry in self.entries():
+            pkg = entry["package"]
+            if pkg not in pkgs:
+                continue
+            any_version.setdefault(pkg, []).append(entry["seconds"])
+            if entry["version"] == pkgs[pkg]:
+                same_version.setdefault(pkg, []).append(entry["seconds"])
+
+        durations = {}
+        for pkg in pkgs:
+            seconds = same_version.get(pkg) or any_version.get(pkg)
+            if seconds:
+                recent = seconds[-_RECENT_BUILDS:]
+                durations[pkg] = sum(recent) / len(recent)
+        return durations
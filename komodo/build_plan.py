@@ -0,0 +1,123 @@
+import json
+import os
+import sys
+
+from komodo.build import build_order, package_path, resolve_makeopts
+from komodo.build_cache import package_key
+from komodo.build_report import simulate
+from komodo.package_version import LATEST_PACKAGE_ALIAS
+
+
+def plan(
+    pkgs,
+    repo,
+    data,
+    prefix,
+    dlprefix=None,
+    build_cache=None,
+    history=None,
+    package_jobs=1,
+    pypi_versions=None,
+):
+    """Work out what make() would do for a release, without fetching or
+    building anything.
+
+    Returns a dict with the packages in build order, each with its version,
+    builder, whether the build cache has it ("hit" or "miss"; None without a
+    cache) and its estimated build time from the history, and the estimated
+    build time of the whole release with package_jobs packages building at
+    the same time. pip packages with version * are planned with their
+    version in pypi_versions, as make() builds them.
+
+    Git sources that have not been fetched yet are planned as cache misses,
+    as their commit is part of the key.
+    """
+    prefix = os.path.abspath(prefix)
+    order = build_order(pkgs, repo)
+    versions = {}
+    for pkg, ver in pkgs.items():
+        if ver == LATEST_PACKAGE_ALIAS and repo[pkg][ver]["make"] == "pip":
+            if pkg not in (pypi_versions or {}):
+                raise ValueError(
+                    f"{pkg} has version {LATEST_PACKAGE_ALIAS}, "
+                    "but no resolved version is given in pypi_versions"
+                )
+            versions[pkg] = pypi_versions[pkg]
+        else:
+            versions[pkg] = ver
+    durations = history.durations(versions) if history is not None else {}
+
+    keys = {}
+    packages = []
+    for pkg in order:
+        ver = versions[pkg]
+        entry = dict(repo[pkg][pkgs[pkg]])
+        entry["makeopts"] = resolve_makeopts(entry, prefix)
+
+        cache = None
+        if build_cache is not None:
+            keys[pkg] = package_key(
+                pkg,
+                ver,
+                entry,
+                prefix,
+                [keys[dep] for dep in entry.get("depends", [])],
+                data=data,
+                pkgpath=package_path(pkg, ver, dlprefix),
+            )
+            cache = "hit" if keys[pkg] in build_cache else "miss"
+        if cache == "hit":
+            durations[pkg] = 0.0
+
+        packages.append(
+            {
+                "package": pkg,
+                "version": ver,
+                "builder": entry["make"],
+                "cache": cache,
+                "estimated_seconds": durations.get(pkg),
+            }
+        )
+
+    dependencies = {pkg: repo[pkg][pkgs[pkg]].get("depends", []) for pkg in order}
+    return {
+        "packages": packages,
+        "package_jobs": package_jobs,
+        "estimated_seconds": simulate(order, dependencies, durations, package_jobs),
+        "unestimated": [pkg for pkg in order if pkg not in durations],
+    }
+
+
+def write_plan(build_plan, fmt="text", out=sys.stdout):
+    if fmt == "json":
+        json.dump(build_plan, out, indent=2)
+        out.write("\n")
+        return
+
+    packages = build_plan["packages"]
+    out.write(f"Build order of {len(packages)} packages:\n")
+    for number, entry in enumerate(packages, start=1):
+        details = [entry["builder"]]
+        if entry["cache"] is not None:
+            details.append(f"cache {entry['cache']}")
+        if entry["estimated_seconds"] is not None:
+            details.append(f"~{entry['estimated_seconds']:.1f} s")
+        out.write(
+            f"  {number}. {entry['package']} ({entry['version']}): "
+            + ", ".join(details)
+            + "\n"
+        )
+
+    hits = sum(1 for entry in packages if entry["cache"] == "hit")
+    to_build = len(packages) - hits
+    out.write(f"Packages to build: {to_build}, from the build cache: {hits}\n")
+    out.write(
+        f"Estimated build time with {build_plan['package_jobs']} package jobs: "
+        f"{build_plan['estimated_seconds']:.1f} s\n"
+    )
+    if build_plan["unestimated"]:
+        out.write(
+            "Packages without recorded builds: "
+            + ", ".join(build_plan["unestimated"])
+            + "\n"
+        )
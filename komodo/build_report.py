@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+import argparse
+import heapq
+import sys
+
+from komodo.build import build_order
+from komodo.build_history import BuildHistory
+from komodo.yaml_file_type import YamlFile
+
+
+def _dependencies(pkgs, repo):
+    return {pkg: repo[pkg][ver].get("depends", []) for pkg, ver in pkgs.items()}
+
+
+def critical_path(order, dependencies, durations):
+    """Return the length of the longest chain of dependent builds, and the
+    chain itself, in build order."""
+    finish, previous = {}, {}
+    for pkg in order:
+        start, previous[pkg] = 0.0, None
+        for dependency in dependencies[pkg]:
+            if finish[dependency] > start:
+                start, previous[pkg] = finish[dependency], dependency
+        finish[pkg] = start + durations.get(pkg, 0.0)
+
+    if not finish:
+        return 0.0, []
+    last = max(order, key=finish.get)
+    path = []
+    while last is not None:
+        path.append(last)
+        last = previous[last]
+    return finish[path[0]], path[::-1]
+
+
+def simulate(order, dependencies, durations, workers):
+    """Return the build time with a number of parallel workers, using the
+    same policy as make(): a package starts as soon as its dependencies are
+    built and a worker is free, earliest in the build order first."""
+    position = {pkg: index for index, pkg in enumerate(order)}
+    remaining = {pkg: set(dependencies[pkg]) for pkg in order}
+    dependents = {pkg: [] for pkg in order}
+    for pkg in order:
+        for dependency in remaining[pkg]:
+            dependents[dependency].append(pkg)
+
+    ready = [position[pkg] for pkg in order if not remaining[pkg]]
+    heapq.heapify(ready)
+    running = []
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < workers:
+            pkg = order[heapq.heappop(ready)]
+            heapq.heappush(running, (now + durations.get(pkg, 0.0), position[pkg]))
+        now, index = heapq.heappop(running)
+        for dependent in dependents[order[index]]:
+            remaining[dependent].discard(order[index])
+            if not remaining[dependent]:
+                heapq.heappush(ready, position[dependent])
+    return now
+
+
+def bottlenecks(order, dependencies, durations, top=10):
+    """Return the packages whose build time matters most for the build as a
+    whole: how much the critical path would shrink if each one took no time,
+    largest first."""
+    length, path = critical_path(order, dependencies, durations)
+    savings = []
+    for pkg in path:
+        if not durations.get(pkg):
+            continue
+        without = dict(durations)
+        without[pkg] = 0.0
+        shorter, _ = critical_path(order, dependencies, without)
+        savings.append((length - shorter, pkg))
+    savings.sort(key=lambda saving: (-saving[0], saving[1]))
+    return [(pkg, saving) for saving, pkg in savings[:top]]
+
+
+def report(pkgs, repo, history, workers=(1, 2, 4, 8, 16), top=10, out=sys.stdout):
+    order = build_order(pkgs, repo)
+    dependencies = _dependencies(pkgs, repo)
+    durations = history.durations(pkgs)
+
+    unknown = [pkg for pkg in order if pkg not in durations]
+    total = sum(durations.values())
+    length, path = critical_path(order, dependencies, durations)
+
+    out.write(f"Packages: {len(order)} ({len(unknown)} without recorded builds)\n")
+    out.write(f"Total build time: {total:.1f} s\n")
+    out.write(f"Critical path: {length:.1f} s\n")
+    for pkg in path:
+        out.write(f"  {pkg} ({pkgs[pkg]}): {durations.get(pkg, 0.0):.1f} s\n")
+
+    out.write("Best build time with N workers:\n")
+    for count in workers:
+        bound = max(length, total / count)
+        scheduled = simulate(order, dependencies, durations, count)
+        out.write(
+            f"  {count}: {scheduled:.1f} s scheduled, {bound:.1f} s lower bound\n"
+        )
+
+    out.write("Packages that would shorten the build most if faster:\n")
+    for pkg, saving in bottlenecks(order, dependencies, durations, top=top):
+        out.write(f"  {pkg}: up to {saving:.1f} s\n")
+
+    if unknown:
+        out.write("Packages without recorded builds: " + ", ".join(unknown) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report the critical path and the best possible build time "
+        "of a release, from the build durations recorded by kmd --build-history.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "pkgs",
+        type=YamlFile(),
+        help="A Komodo release file mapping package name to version, "
+        "in YAML format.",
+    )
+    parser.add_argument(
+        "repo",
+        type=YamlFile(),
+        help="A Komodo repository file, in YAML format.",
+    )
+    parser.add_argument(
+        "--history",
+        type=str,
+        required=True,
+        help="The build history file written by kmd --build-history.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16],
+        help="Numbers of parallel package builds to estimate the build time for.",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="The number of packages to list as the largest bottlenecks.",
+    )
+    args = parser.parse_args()
+    report(
+        args.pkgs,
+        args.repo,
+        BuildHistory(args.history),
+        workers=args.workers,
+        top=args.top,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,17 +8,29 @@ from typing import List
 import jinja2
 import yaml as yml
 
-from komodo import local, switch
+from komodo import local, switch, trace
 from komodo.build import make
+from komodo.build_cache import BuildCache
+from komodo.build_history import BuildHistory
+from komodo.build_plan import plan, write_plan
+from komodo.compiler_cache import CompilerCache
+from komodo.copy_tree import COPY_MODES, copy_tree
 from komodo.data import Data
 from komodo.fetch import fetch
+from komodo.git_mirror import GitMirrors
+from komodo.journal import BuildJournal
 from komodo.package_version import (
     LATEST_PACKAGE_ALIAS,
     latest_pypi_version,
     strip_version,
 )
+from komodo.relocate import relocate_pip_packages
 from komodo.shebang import fixup_python_shebangs
-from komodo.shell import pushd, shell
+from komodo.shell import forward_signals, pushd, shell
+from komodo.simple_index import pip_source_options
+from komodo.source_lock import SourceLock
+from komodo.source_store import SourceStore
+from komodo.wheel_cache import WheelCache
 from komodo.yaml_file_type import YamlFile
 
 
@@ -53,36 +65,109 @@ def _main(args):
 
     data = Data(extra_data_dirs=args.extra_data_dirs)
 
+    if args.plan:
+        _plan(args, data, abs_prefix / args.release / "root")
+        return
+
+    lock = SourceLock()
+    from_lock = SourceLock.load(args.from_lock) if args.from_lock else None
+    fetched = False
     if args.download or (not args.build and not args.install):
-        git_hashes = fetch(args.pkgs, args.repo, outdir=args.cache, pip=args.pip)
+        source_store = None
+        if args.source_store:
+            source_store = SourceStore(args.source_store)
+        git_mirrors = None
+        if args.git_mirrors:
+            git_mirrors = GitMirrors(args.git_mirrors)
+        wheel_cache = None
+        if args.wheel_cache:
+            wheel_cache = WheelCache(args.wheel_cache, pip=args.pip)
+        with trace.span("fetch", "phase"):
+            git_hashes = fetch(
+                args.pkgs,
+                args.repo,
+                outdir=args.cache,
+                pip=args.pip,
+                wheel_cache=wheel_cache,
+                wheel_jobs=args.wheel_jobs,
+                fetch_jobs=args.fetch_jobs,
+                source_store=source_store,
+                git_mirrors=git_mirrors,
+                pypi_jobs=args.pypi_jobs,
+                lock=lock,
+                from_lock=from_lock,
+            )
+        fetched = True
 
     if args.download and not args.build:
         sys.exit(0)
 
+    pypi_versions = _pypi_versions(args, lock if fetched else from_lock or SourceLock())
+
     # append root to the temporary build dir, as we want a named root/
     # directory as the distribution root, organised under the distribution name
     # (release)
     tmp_prefix = abs_prefix / args.release / "root"
     fakeroot = Path(args.release).resolve()
     if args.build or not args.install:
-        make(
-            args.pkgs,
-            args.repo,
-            data,
-            prefix=str(tmp_prefix),
-            dlprefix=args.cache,
-            builddir=args.tmp,
-            jobs=args.jobs,
-            cmk=args.cmake,
-            pip=args.pip,
-            virtualenv=args.virtualenv,
-            fakeroot=str(fakeroot),
-        )
+        build_cache = None
+        if args.build_cache:
+            build_cache = BuildCache(
+                args.build_cache,
+                max_size=int(args.build_cache_size * 1024**3),
+            )
+        journal = BuildJournal(f"{args.release}.journal", resume=args.resume)
+        history = BuildHistory(args.build_history) if args.build_history else None
+        compiler_cache = None
+        if args.compiler_cache:
+            compiler_cache = CompilerCache(
+                args.compiler_cache,
+                max_size=args.compiler_cache_size,
+                launcher=args.compiler_launcher,
+                # the workspace, which holds the fakeroot and the sources
+                basedir=os.getcwd(),
+            )
+        with trace.span("build", "phase"):
+            make(
+                args.pkgs,
+                args.repo,
+                data,
+                prefix=str(tmp_prefix),
+                dlprefix=args.cache,
+                builddir=args.tmp,
+                jobs=args.jobs,
+                package_jobs=args.package_jobs,
+                cmk=args.cmake,
+                pip=args.pip,
+                virtualenv=args.virtualenv,
+                fakeroot=str(fakeroot),
+                build_cache=build_cache,
+                journal=journal,
+                batch_pip=args.batch_pip,
+                history=history,
+                compiler_cache=compiler_cache,
+                cmake_generator=args.cmake_generator,
+                cmake_build_dirs=args.cmake_build_dirs,
+                copy_mode=args.copy_mode,
+                download_store=args.download_store,
+                stream_output=args.stream_output,
+                log_dir=args.log_dir,
+                command_timeout=args.command_timeout,
+                pypi_versions=pypi_versions,
+            )
+        # the fakeroot is moved away below, so there is nothing left to resume
+        journal.clear()
         shell(f"mv {args.release + str(tmp_prefix)} {args.release}")
         shell(
             "rmdir -p --ignore-fail-on-non-empty "
             f"{args.release + str(tmp_prefix.parent)}"
         )
+        if args.pip_install == "relocate":
+            relocate_pip_packages(
+                Path(args.release) / "root",
+                old_prefix=str(fakeroot) + str(tmp_prefix),
+                new_prefix=str(tmp_prefix),
+            )
 
     if args.build and not args.install:
         sys.exit(0)
@@ -104,10 +189,9 @@ def _main(args):
     with open(releasedoc, "w", encoding="utf-8") as filehandle:
         release = {}
         for pkg, ver in args.pkgs.items():
-            entry = args.repo[pkg][ver]
             maintainer = args.repo[pkg][ver]["maintainer"]
             if ver == LATEST_PACKAGE_ALIAS:
-                ver = latest_pypi_version(entry.get("pypi_package_name", pkg))
+                ver = pypi_versions[pkg]
             elif args.repo[pkg][ver].get("fetch") == "git":
                 ver = git_hashes[pkg]
             release[pkg] = {
@@ -115,14 +199,67 @@ def _main(args):
                 "maintainer": maintainer,
             }
         yml.dump(release, filehandle, default_flow_style=False)
+    if lock.packages:
+        lock.write(Path(args.release) / f"{args.release}.lock")
 
     if args.dry_run:
         return
 
+    with trace.span("install", "phase"):
+        _install(args, data, pypi_versions)
+
+
+def _pypi_versions(args, lock):
+    """The version of each package of the release pinned to *, as recorded
+    in lock: the lock fetch wrote, or the --from-lock one when nothing was
+    fetched. The latest on PyPI for packages that lock does not have."""
+    versions = {}
+    for pkg, ver in args.pkgs.items():
+        if ver == LATEST_PACKAGE_ALIAS:
+            entry = args.repo[pkg][ver]
+            versions[pkg] = lock.get(pkg).get("version") or latest_pypi_version(
+                entry.get("pypi_package_name", pkg)
+            )
+    return versions
+
+
+def _plan(args, data, prefix):
+    build_cache = None
+    if args.build_cache and Path(args.build_cache).is_dir():
+        build_cache = BuildCache(args.build_cache)
+    history = None
+    if args.build_history:
+        history = BuildHistory(args.build_history)
+    build_plan = plan(
+        args.pkgs,
+        args.repo,
+        data,
+        prefix=str(prefix),
+        dlprefix=args.cache,
+        build_cache=build_cache,
+        history=history,
+        package_jobs=args.package_jobs,
+        pypi_versions=_pypi_versions(
+            args,
+            SourceLock.load(args.from_lock) if args.from_lock else SourceLock(),
+        ),
+    )
+    write_plan(build_plan, fmt=args.plan)
+
+
+def _install(args, data, pypi_versions):
     print(f"Installing {args.release} to {args.prefix}")
 
     shell(f"mv {args.release} .{args.release}")
-    shell(f"rsync -a .{args.release} {args.prefix}", sudo=args.sudo)
+    if args.copy_mode == "rsync" or args.sudo:
+        shell(f"rsync -a .{args.release} {args.prefix}", sudo=args.sudo)
+    else:
+        copy_tree(
+            f".{args.release}",
+            os.path.join(args.prefix, f".{args.release}"),
+            mode=args.copy_mode,
+            prune=False,
+        )
 
     if Path(f"{args.prefix}/{args.release}").exists():
         shell(
@@ -145,22 +282,21 @@ def _main(args):
     release_root = release_path / "root"
     for pkg, ver in args.pkgs.items():
         current = args.repo[pkg][ver]
-        if current["make"] != "pip":
+        if current["make"] != "pip" or args.pip_install != "reinstall":
             continue
 
         package_name = current.get("pypi_package_name", pkg)
         if ver == LATEST_PACKAGE_ALIAS:
-            ver = latest_pypi_version(package_name)
+            ver = pypi_versions[pkg]
         shell_input = [
             args.pip,
             f"install {package_name}=={strip_version(ver)}",
             "--prefix",
             str(release_root),
-            "--no-index",
             "--no-deps",
             "--ignore-installed",
             f"--cache-dir {args.cache}",
-            f"--find-links {args.cache}",
+            *pip_source_options(args.cache),
         ]
         shell_input.append(current.get("makeopts"))
 
@@ -186,12 +322,21 @@ def cli_main():
     Pass the command-line args to argparse, then set up the workspace.
     """
     args = parse_args(sys.argv[1:])
+    forward_signals()
 
     if args.workspace and not Path(args.workspace).exists():
         Path(args.workspace).mkdir()
 
-    with pushd(args.workspace):
-        _main(args)
+    if args.trace:
+        trace_file = Path(args.trace).resolve()
+        trace.start()
+
+    try:
+        with pushd(args.workspace):
+            _main(args)
+    finally:
+        if args.trace:
+            trace.stop(trace_file)
 
 
 def parse_args(args: List[str]) -> argparse.Namespace:
@@ -271,12 +416,139 @@ def parse_args(args: List[str]) -> argparse.Namespace:
         default="pip-cache",
         help="The temporary directory used for downloads, e.g. by pip.",
     )
+    optional_args.add_argument(
+        "--source-store",
+        type=str,
+        default=None,
+        help="Directory of downloaded tarballs, rpms and git checkouts shared "
+        "by all releases. Sources are downloaded into it once and linked "
+        "into --cache. komodo-clean-source-store limits its size. None "
+        "disables it.",
+    )
+    optional_args.add_argument(
+        "--git-mirrors",
+        type=str,
+        default=None,
+        help="Directory of bare mirrors of the git repositories of packages, "
+        "kept up to date incrementally. Git packages are checked out shallowly "
+        "from their mirror instead of being cloned in full from the remote. "
+        "None disables it.",
+    )
+    optional_args.add_argument(
+        "--from-lock",
+        type=str,
+        default=None,
+        help="A lockfile written next to the manifest of a release, to fetch "
+        "exactly the versions, commits and files in it. Sources already in "
+        "--cache with the locked hash are not downloaded again.",
+    )
+    optional_args.add_argument(
+        "--fetch-jobs",
+        type=int,
+        default=1,
+        help="The number of packages to download and unpack concurrently. "
+        "PyPI packages are downloaded together afterwards.",
+    )
+    optional_args.add_argument(
+        "--pypi-jobs",
+        type=int,
+        default=None,
+        help="Download PyPI packages straight from the PyPI JSON API, this many "
+        "at a time, picking the artifact --pip would. Packages it cannot "
+        "handle are left to pip download. None downloads them all with pip "
+        "download.",
+    )
+    optional_args.add_argument(
+        "--wheel-cache",
+        type=str,
+        default=None,
+        help="Directory of wheels built from downloaded sdists. Wheels are "
+        "built once per package version, Python version and platform, and "
+        "replace the sdists in the download cache. None disables it.",
+    )
+    optional_args.add_argument(
+        "--wheel-jobs",
+        type=int,
+        default=None,
+        help="The number of wheels to build from sdists in parallel. None "
+        "means the number of processors.",
+    )
+    optional_args.add_argument(
+        "--download-store",
+        type=str,
+        default=None,
+        help="Directory of the files of 'make: download' packages, stored by "
+        "their sha256. A file that any release has downloaded before is "
+        "copied from there instead of downloaded again. None disables it.",
+    )
     optional_args.add_argument(
         "--jobs",
         "-j",
         type=int,
         default=1,
-        help="The number of parallel jobs to use for builds by cmake.",
+        help="The number of parallel jobs to use for builds by cmake. With "
+        "--package-jobs, this is the total shared by all packages that build "
+        "at the same time, through a make jobserver.",
+    )
+    optional_args.add_argument(
+        "--package-jobs",
+        type=int,
+        default=1,
+        help="The number of packages to build concurrently. A package is "
+        "built as soon as all of its dependencies have been built.",
+    )
+    optional_args.add_argument(
+        "--build-cache",
+        type=str,
+        default=None,
+        help="Directory of archived package builds. A package whose version, "
+        "repository entry, build script and dependencies are unchanged is "
+        "unpacked from the cache instead of being built. None disables the "
+        "cache.",
+    )
+    optional_args.add_argument(
+        "--build-cache-size",
+        type=float,
+        default=50,
+        help="The size limit of the build cache in GiB. The least recently "
+        "used builds are evicted to stay below it.",
+    )
+    optional_args.add_argument(
+        "--compiler-cache",
+        type=str,
+        default=None,
+        help="Directory of the compiler cache used by cmake and sh builds. "
+        "Compilers are run through --compiler-launcher, so unchanged object "
+        "files are not compiled again. Paths below the working directory are "
+        "hashed relative to it, so releases built under new names in the same "
+        "workspace share hits. None disables it.",
+    )
+    optional_args.add_argument(
+        "--compiler-cache-size",
+        type=str,
+        default="20G",
+        help="The size limit of the compiler cache, in the format of "
+        "ccache --max-size.",
+    )
+    optional_args.add_argument(
+        "--compiler-launcher",
+        type=str,
+        default="ccache",
+        help="The compiler launcher to use with --compiler-cache.",
+    )
+    optional_args.add_argument(
+        "--build-history",
+        type=str,
+        default=None,
+        help="File to append the build duration of every package to, for "
+        "komodo-build-report. None means durations are not recorded.",
+    )
+    optional_args.add_argument(
+        "--resume",
+        action="store_true",
+        help="Flag to choose whether to continue an interrupted build. "
+        "Packages the previous run installed into the release directory are "
+        "skipped as long as their inputs have not changed.",
     )
     optional_args.add_argument(
         "--download",
@@ -303,18 +575,73 @@ def parse_args(args: List[str]) -> argparse.Namespace:
         help="Flag to choose whether stop before installing the environment. "
         "to the `prefix` location.",
     )
+    optional_args.add_argument(
+        "--plan",
+        nargs="?",
+        const="text",
+        choices=["text", "json"],
+        default=None,
+        help="Print the build order, the builder of every package, which "
+        "packages the build cache has and the estimated build times from "
+        "--build-history, as text or JSON, without fetching, building or "
+        "installing anything.",
+    )
     optional_args.add_argument(
         "--cmake",
         type=str,
         default="cmake",
         help="The command to use for cmake builds.",
     )
+    optional_args.add_argument(
+        "--cmake-generator",
+        type=str,
+        default=None,
+        help="The cmake generator to use for cmake builds, e.g. Ninja. None "
+        "means the default generator of cmake, built with make.",
+    )
+    optional_args.add_argument(
+        "--cmake-build-dirs",
+        type=str,
+        default=None,
+        help="Directory to keep the build directories of cmake packages in "
+        "across runs. A build directory is reused by a package with the same "
+        "version, options and generator, also by other releases, so an "
+        "unchanged package is only built incrementally. None means every "
+        "build is configured from scratch in --tmp.",
+    )
     optional_args.add_argument(
         "--pip",
         type=str,
         default="pip",
         help="The command to use for pip builds.",
     )
+    optional_args.add_argument(
+        "--batch-pip",
+        action="store_true",
+        help="Flag to choose whether to install pip packages that are ready "
+        "at the same time with a single pip command. Packages with makeopts "
+        "are still installed one by one.",
+    )
+    optional_args.add_argument(
+        "--pip-install",
+        choices=["relocate", "reinstall"],
+        default="relocate",
+        help="How pip packages end up in the installed release. 'relocate' "
+        "rewrites the paths in the packages built into the fakeroot, "
+        "'reinstall' installs them again into the prefix.",
+    )
+    optional_args.add_argument(
+        "--copy-mode",
+        choices=COPY_MODES,
+        default="rsync",
+        help="How the files of rsync packages and the finished release are "
+        "copied. 'rsync' runs rsync, 'copy' copies in parallel threads with "
+        "copy_file_range, 'reflink' shares data blocks between the copies "
+        "and 'hardlink' links them, where the file system allows, falling "
+        "back to copying. With 'hardlink', changing a file in place changes "
+        "the source as well. rsync packages with makeopts and installs with "
+        "--sudo always use rsync.",
+    )
     optional_args.add_argument(
         "--virtualenv",
         type=str,
@@ -347,6 +674,35 @@ def parse_args(args: List[str]) -> argparse.Namespace:
         help="Directories containing extra data files for `sh` builds. "
         "Multiple directores can be given, separated with space.",
     )
+    optional_args.add_argument(
+        "--stream-output",
+        action="store_true",
+        help="Flag to choose whether to show the output of build commands "
+        "line by line while they run, instead of when they are done. Only "
+        "the last lines are kept in memory for error messages.",
+    )
+    optional_args.add_argument(
+        "--log-dir",
+        type=str,
+        default=None,
+        help="Directory to write the output of the build commands of every "
+        "package to, one log file per package. Implies --stream-output.",
+    )
+    optional_args.add_argument(
+        "--command-timeout",
+        type=float,
+        default=None,
+        help="The number of seconds after which a build command is killed "
+        "and the build fails. None means no limit.",
+    )
+    optional_args.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="Write a timeline of the fetch, build and install phases, every "
+        "package and every shell command to this file, in the Chrome "
+        "trace-event format that Perfetto and chrome://tracing can open.",
+    )
     optional_args.add_argument(
         "--postinst",
         "-P",
@@ -0,0 +1,71 @@
+import os
+import shutil
+
+from komodo.shell import shell
+
+# compilers that are routed through the launcher in sh builds
+_COMPILERS = ("cc", "c++", "gcc", "g++", "clang", "clang++")
+
+
+class CompilerCache(object):
+    def __init__(self, path, max_size="20G", launcher="ccache", basedir=None):
+        """A ccache directory shared by the cmake and sh builds of a release.
+
+        cmake builds get the launcher through CMAKE_<LANG>_COMPILER_LAUNCHER.
+        sh builds get a directory of compiler names linked to the launcher in
+        front of their PATH, so setup.py, make and b2 builds go through it
+        as well. max_size is passed on to ccache --max-size.
+
+        Absolute paths below basedir, such as the fakeroot and the sources of
+        a release, are made relative to the directory of each compile, and
+        that directory is left out of the hash. A nightly release under a
+        new name in the same workspace then gets hits from earlier nights.
+        Paths that include the release name still differ, for example the
+        include directory of the fakeroot."""
+        self.path = os.path.abspath(path)
+        self.max_size = max_size
+        self.launcher = launcher
+        self.basedir = os.path.abspath(basedir) if basedir is not None else None
+        self.bindir = os.path.join(self.path, "bin")
+
+    def environment(self):
+        environment = {"CCACHE_DIR": self.path, "CCACHE_MAXSIZE": self.max_size}
+        if self.basedir is not None:
+            environment["CCACHE_BASEDIR"] = self.basedir
+            environment["CCACHE_NOHASHDIR"] = "1"
+        return environment
+
+    def cmake_flags(self):
+        return [
+            f"-DCMAKE_C_COMPILER_LAUNCHER={self.launcher}",
+            f"-DCMAKE_CXX_COMPILER_LAUNCHER={self.launcher}",
+        ]
+
+    def path_with_compilers(self, path):
+        """Prepend the directory of compiler links to a PATH value."""
+        return ":".join([self.bindir, path])
+
+    def start(self, context):
+        """Set up the cache and the compiler links, cap the size of the cache
+        and reset its statistics, so that the report covers this run only."""
+        launcher = shutil.which(self.launcher, path=context.env.get("PATH"))
+        if launcher is None:
+            raise ValueError(f"compiler cache launcher {self.launcher} not found")
+
+        os.makedirs(self.bindir, exist_ok=True)
+        for compiler in _COMPILERS:
+            link = os.path.join(self.bindir, compiler)
+            if os.path.islink(link) and os.readlink(link) == launcher:
+                continue
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(launcher, link)
+
+        shell([launcher, f"--max-size {self.max_size}"], context=context)
+        shell([launcher, "--zero-stats"], context=context)
+
+    def report(self, context):
+        """Print the hit and miss statistics of the cache since start()."""
+        print(f"Compiler cache statistics for {self.path}:")
+        stats = shell([self.launcher, "--show-stats"], context=context, stream=False)
+        print(stats.decode("utf-8"))
@@ -0,0 +1,165 @@
+import errno
+import fcntl
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+COPY_MODES = ("rsync", "copy", "reflink", "hardlink")
+
+# ioctl request to share the extents of one file with another, from linux/fs.h
+_FICLONE = 0x40049409
+_CHUNK_SIZE = 8 * 1024 * 1024
+# errors meaning the file system cannot do the faster kind of copy
+_UNSUPPORTED = (
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EPERM,
+)
+
+
+def _existing_parent(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def same_filesystem(src, dst):
+    """Whether src and dst, which need not exist yet, are on one file system."""
+    return os.stat(src).st_dev == os.stat(_existing_parent(dst)).st_dev
+
+
+def _copy_data(source, target, size):
+    """Copy size bytes between two open files, in the kernel when possible
+    (copy_file_range, which file systems like XFS and btrfs may turn into
+    a reflink), and in large chunks through user space otherwise."""
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                count = os.copy_file_range(source, target, size - copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED or copied:
+                raise
+    while copied < size:
+        chunk = os.read(source, _CHUNK_SIZE)
+        if not chunk:
+            break
+        os.write(target, chunk)
+        copied += len(chunk)
+
+
+def copy_file(src, dst, mode="copy", same_fs=True):
+    """Copy the regular file src to dst with its mode and times.
+
+    With mode "hardlink" dst becomes a hard link to src, and with "reflink"
+    it shares the data blocks of src, as long as both are on the same file
+    system and the file system supports it. Otherwise the data is copied.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == "hardlink" and same_fs:
+        try:
+            os.link(src, dst)
+            return
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED + (errno.EMLINK,):
+                raise
+
+    source = os.open(src, os.O_RDONLY)
+    try:
+        target = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            cloned = False
+            if mode == "reflink" and same_fs:
+                try:
+                    fcntl.ioctl(target, _FICLONE, source)
+                    cloned = True
+                except OSError as err:
+                    if err.errno not in _UNSUPPORTED:
+                        raise
+            if not cloned:
+                _copy_data(source, target, os.fstat(source).st_size)
+        finally:
+            os.close(target)
+    finally:
+        os.close(source)
+    shutil.copystat(src, dst)
+
+
+def copy_tree(src, dst, mode="copy", jobs=None, prune=True):
+    """Copy the contents of the directory src into dst, like rsync -am src/
+    dst: symlinks are copied as symlinks, modes and times are kept, and
+    directories without any files in them are left out, unless prune is
+    False.
+
+    Files are copied by a pool of jobs threads (None means the default of
+    ThreadPoolExecutor), with copy_file in the given mode. Returns the number
+    of files copied.
+    """
+    same_fs = same_filesystem(src, dst)
+    directories = []
+    files = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        relpath = os.path.relpath(dirpath, src)
+        target_dir = os.path.normpath(os.path.join(dst, relpath))
+        directories.append((dirpath, target_dir))
+        for name in filenames + [name for name in dirnames if _is_link(dirpath, name)]:
+            files.append((os.path.join(dirpath, name), os.path.join(target_dir, name)))
+
+    created = set()
+    if not prune:
+        for _, target in directories:
+            os.makedirs(target, exist_ok=True)
+            created.add(target)
+    regular = []
+    for source, target in files:
+        parent = os.path.dirname(target)
+        if parent not in created:
+            os.makedirs(parent, exist_ok=True)
+            created.add(parent)
+        if os.path.islink(source):
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(os.readlink(source), target)
+        elif stat.S_ISREG(os.lstat(source).st_mode):
+            regular.append((source, target))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(
+            executor.map(
+                lambda pair: copy_file(*pair, mode=mode, same_fs=same_fs), regular
+            )
+        )
+
+    # directory times last, as creating files in them changes their times
+    created = _with_parents(created, dst)
+    for source, target in reversed(directories):
+        if target in created:
+            shutil.copystat(source, target)
+    return len(regular)
+
+
+def _is_link(dirpath, name):
+    return os.path.islink(os.path.join(dirpath, name))
+
+
+def _with_parents(directories, root):
+    """The directories and all their parents up to and including root."""
+    root = os.path.normpath(root)
+    parents = set()
+    for directory in directories:
+        directory = os.path.normpath(directory)
+        while directory not in parents:
+            parents.add(directory)
+            if directory in (root, os.path.dirname(directory)):
+                break
+            directory = os.path.dirname(directory)
+    return parents
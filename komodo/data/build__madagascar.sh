@@ -53,5 +53,5 @@ popd
 export DESTDIR=$FAKEROOT
 
 ./configure --prefix=$PREFIX API=$API MATLAB=$MATLAB MEX=$MEX
-make -j$JOBS
+make ${MAKE_JOBS--j$JOBS}
 make install
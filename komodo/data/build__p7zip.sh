@@ -35,7 +35,7 @@ done
 
 
 cp -f makefile.linux_amd64_asm makefile.linux
-make -j$JOBS all_test
+make ${MAKE_JOBS--j$JOBS} all_test
 
 DEST_BIN=$PREFIX/bin
 DEST_SHARE=$PREFIX/lib/p7zip
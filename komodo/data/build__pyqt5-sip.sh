@@ -45,5 +45,5 @@ done
 python configure.py \
     --sip-module PyQt5.sip \
     $OPTS
-make -j$JOBS
-DESTDIR= make install -j$JOBS
+make ${MAKE_JOBS--j$JOBS}
+DESTDIR= make install ${MAKE_JOBS--j$JOBS}
@@ -50,5 +50,5 @@ python configure.py \
     --qmake=$FAKEROOT$PREFIX/bin/qmake \
     --no-dist-info \
     $OPTS
-make -j$JOBS
-make -j$JOBS install
+make ${MAKE_JOBS--j$JOBS}
+make ${MAKE_JOBS--j$JOBS} install
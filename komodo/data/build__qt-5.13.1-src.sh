@@ -47,5 +47,5 @@ export INSTALL_ROOT=$FAKEROOT
 
 ../qt5-5.13.1/configure -prefix $PREFIX -datadir $PREFIX/share -I /project/res/komodo/repository/xkbcommon/root/include -L /project/res/komodo/repository/xkbcommon/root/lib64 $OPTS
 
-make -j$JOBS 
-make -j$JOBS install
+make ${MAKE_JOBS--j$JOBS} 
+make ${MAKE_JOBS--j$JOBS} install
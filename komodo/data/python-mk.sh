@@ -46,5 +46,5 @@ set -x
             "LDFLAGS=-Wl,-rpath=$PREFIX/lib"    \
             $OPTS
 
-make -j$JOBS
-make -j$JOBS install
+make ${MAKE_JOBS--j$JOBS}
+make ${MAKE_JOBS--j$JOBS} install
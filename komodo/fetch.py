@@ -4,16 +4,24 @@
 import argparse
 import os
 import sys
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 
 import jinja2
 
+from komodo.build import resolve_makeopts
 from komodo.package_version import (
+    COMMIT_RE,
     LATEST_PACKAGE_ALIAS,
     get_git_revision_hash,
     latest_pypi_version,
     strip_version,
 )
-from komodo.shell import pushd, shell
+from komodo.pypi_download import download_pypi, fetch_artifact, find_download
+from komodo.shell import ExecutionContext, shell
+from komodo.simple_index import normalize, parse_artifact, write_simple_index
+from komodo.source_lock import file_sha256
+from komodo.wheel_cache import is_sdist
 from komodo.yaml_file_type import YamlFile
 
 
@@ -21,35 +29,277 @@ def eprint(*args, **kwargs):
     return print(*args, file=sys.stderr, **kwargs)
 
 
-def grab(path, filename=None, version=None, protocol=None, pip="pip"):
+def grab(
+    path,
+    filename=None,
+    version=None,
+    protocol=None,
+    pip="pip",
+    context=None,
+    git_mirrors=None,
+):
     # guess protocol if it's obvious from the url (usually is)
     if protocol is None:
         protocol = path.split(":")[0]
 
     if protocol in ("http", "https", "ftp"):
-        shell(f"wget --quiet {path} -O {filename}")
+        shell(f"wget --quiet {path} -O {filename}", context=context)
+    elif protocol in ("git") and git_mirrors is not None:
+        git_mirrors.checkout(path, strip_version(version), filename, context=context)
+    elif protocol in ("git") and COMMIT_RE.match(version):
+        # a commit, e.g. from a lockfile, cannot be cloned with -b
+        shell(f"git clone --quiet --no-checkout -- {path} {filename}", context=context)
+        shell(f"git -C {filename} checkout --quiet {version}", context=context)
+        shell(
+            f"git -C {filename} submodule update --init --recursive --quiet",
+            context=context,
+        )
     elif protocol in ("git"):
         shell(
             "git clone "
             f"-b {strip_version(version)} "
             "--quiet "
             "--recurse-submodules "
-            f"-- {path} {filename}"
+            f"-- {path} {filename}",
+            context=context,
         )
 
     elif protocol in ("nfs", "fs-ln"):
-        shell(f"cp --recursive --symbolic-link {path} {filename}")
+        shell(f"cp --recursive --symbolic-link {path} {filename}", context=context)
 
     elif protocol in ("fs-cp"):
-        shell(f"cp --recursive {path} {filename}")
+        shell(f"cp --recursive {path} {filename}", context=context)
 
     elif protocol in ("rsync"):
-        shell(f"rsync -a {path}/ {filename}")
+        shell(f"rsync -a {path}/ {filename}", context=context)
     else:
         raise NotImplementedError(f"Unknown protocol {protocol}")
 
 
-def fetch(pkgs, repo, outdir, pip="pip") -> dict:
+def _project(filename):
+    """The normalized project name of a wheel or sdist filename."""
+    parsed = parse_artifact(filename)
+    return normalize(parsed[0]) if parsed is not None else None
+
+
+def _in_cache(path, locked):
+    """Whether path already holds the source of the lock entry locked."""
+    if "commit" in locked:
+        return (
+            os.path.isdir(os.path.join(path, ".git"))
+            and get_git_revision_hash(path) == locked["commit"]
+        )
+    if "sha256" in locked:
+        return os.path.isfile(path) and file_sha256(path) == locked["sha256"]
+    return False
+
+
+def _inside(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+
+def extract_tarball(path, root):
+    """Unpack the tarball at path into root, decompressing it as it is read,
+    and return the top directory of its first member.
+
+    Members that would be written outside of root, by their name, through a
+    symlink unpacked before them, or as a hard link to a file outside of
+    root, are refused with a ValueError."""
+    root = os.path.realpath(root)
+    topdir = []
+
+    def members(tarball):
+        for member in tarball:
+            name = os.path.normpath(member.name)
+            if not _inside(os.path.realpath(os.path.join(root, name)), root):
+                raise ValueError(f"{path}: member {member.name} is outside of {root}")
+            if member.islnk():
+                target = os.path.realpath(os.path.join(root, member.linkname))
+                if not _inside(target, root):
+                    raise ValueError(
+                        f"{path}: link {member.name} points outside of {root}"
+                    )
+            if not topdir and name != os.curdir:
+                topdir.append(name.split(os.sep)[0])
+            yield member
+
+    # the default filter of newer pythons refuses all links out of the
+    # tree, which GNU tar extracted; the checks above are done instead
+    kwargs = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+    with tarfile.open(path, "r|*") as tarball:
+        tarball.extractall(root, members=members(tarball), **kwargs)
+    if not topdir:
+        raise ValueError(f"{path} is empty")
+    return topdir[0]
+
+
+def _fetch_source(
+    name,
+    url,
+    protocol,
+    ver,
+    dst,
+    pkgname,
+    ext,
+    pip,
+    context,
+    source_store=None,
+    git_mirrors=None,
+    locked=None,
+):
+    """Download the sources of one package into the directory of context,
+    and unpack them if they are a tarball. Returns the commit of git
+    sources, None otherwise.
+
+    locked is the entry of the package in a SourceLock to fetch from: the
+    locked commit is checked out, and sources already in the cache with the
+    locked commit or sha256 are not downloaded again."""
+    locked = locked or {}
+    if "commit" in locked:
+        ver = locked["commit"]
+
+    def say(message):
+        print(f"[{context.label}] {message}" if context.label else message)
+
+    def download(filename):
+        grab(
+            url,
+            filename=filename,
+            version=ver,
+            protocol=protocol,
+            pip=pip,
+            context=context,
+            git_mirrors=git_mirrors,
+        )
+
+    path = os.path.join(context.cwd, dst)
+    if _in_cache(path, locked):
+        say(f"Using {dst} from the cache")
+    else:
+        say(f"Downloading {name}")
+        if source_store is None:
+            download(dst)
+        elif protocol == "git":
+            if not source_store.checkout(url, strip_version(ver), path, download):
+                download(dst)
+        elif (protocol or url.split(":")[0]) in ("http", "https", "ftp"):
+            source_store.file(url, locked.get("sha256"), path, download)
+        else:
+            download(dst)
+        if "sha256" in locked and file_sha256(path) != locked["sha256"]:
+            raise ValueError(f"{dst} does not match the sha256 in the lockfile")
+
+    revision = None
+    if protocol == "git":
+        revision = get_git_revision_hash(path=os.path.join(context.cwd, dst))
+
+    if ext in ["tgz", "tar.gz", "tar.bz2", "tar.xz"]:
+        say(f"Extracting {dst} ...")
+        normalised_dir = extract_tarball(path, context.cwd)
+
+        link = os.path.join(context.cwd, pkgname)
+        if not os.path.exists(link):
+            say(f"Creating symlink {normalised_dir} -> {pkgname}")
+            os.symlink(normalised_dir, link)
+    return revision
+
+
+def _fetch_pypi(pypi_packages, pip, pypi_jobs, context, lock, from_lock):
+    """Download the PyPI packages, a dict of package to requirement: from
+    the cache or the URLs of the files in from_lock, directly from PyPI with
+    pypi_jobs and with pip download, in that order, each taking the packages
+    the one before it could not, and record the artifacts in lock."""
+    print(f"Downloading {len(pypi_packages)} pypi packages")
+    artifacts = {}
+    remaining = dict(pypi_packages)
+    if from_lock is not None:
+        locked = {
+            pkg: from_lock.get(pkg)
+            for pkg in remaining
+            if "filename" in from_lock.get(pkg) and "sha256" in from_lock.get(pkg)
+        }
+        # what pip download stored has no URL, but may be in the cache still
+        for pkg, entry in list(locked.items()):
+            if "url" in entry:
+                continue
+            if _in_cache(os.path.join(context.cwd, entry["filename"]), entry):
+                print(f"Using cached {entry['filename']}")
+            else:
+                del locked[pkg]
+        with ThreadPoolExecutor(max_workers=pypi_jobs or 1) as executor:
+            list(
+                executor.map(
+                    lambda entry: fetch_artifact(
+                        entry["filename"], entry["url"], entry["sha256"], context.cwd
+                    ),
+                    [entry for entry in locked.values() if "url" in entry],
+                )
+            )
+        for pkg, entry in locked.items():
+            artifacts[pkg] = entry
+            del remaining[pkg]
+
+    if pypi_jobs is not None and remaining:
+        downloads = download_pypi(
+            list(remaining.values()),
+            context.cwd,
+            pip=pip,
+            jobs=pypi_jobs,
+            context=context,
+        )
+        for pkg, requirement in list(remaining.items()):
+            artifact = downloads[requirement]
+            if artifact is not None:
+                artifacts[pkg] = {
+                    "filename": artifact["filename"],
+                    "url": artifact["url"],
+                    "sha256": artifact["digests"]["sha256"],
+                }
+                del remaining[pkg]
+        if remaining:
+            print(f"Downloading {len(remaining)} pypi packages with pip")
+
+    if remaining:
+        shell(
+            [pip, "download", "--no-deps", "--dest .", " ".join(remaining.values())],
+            context=context,
+        )
+
+    if lock is None:
+        return
+    filenames = os.listdir(context.cwd)
+    for pkg, requirement in pypi_packages.items():
+        artifact = artifacts.get(pkg)
+        if artifact is None:
+            filename = find_download(requirement, filenames)
+            if filename is not None:
+                path = os.path.join(context.cwd, filename)
+                artifact = {"filename": filename, "sha256": file_sha256(path)}
+        if artifact is not None:
+            lock.record(pkg, **artifact)
+
+
+def fetch(
+    pkgs,
+    repo,
+    outdir,
+    pip="pip",
+    wheel_cache=None,
+    wheel_jobs=None,
+    fetch_jobs=1,
+    source_store=None,
+    git_mirrors=None,
+    pypi_jobs=None,
+    lock=None,
+    from_lock=None,
+) -> dict:
+    """Download the sources of the packages in pkgs into outdir, and return
+    the commits of the git sources.
+
+    What was fetched is recorded in the SourceLock lock, if given. With the
+    SourceLock from_lock, the versions, commits and artifacts in it are
+    fetched instead of asking remotes and indexes, and anything already in
+    outdir with the locked hash is kept."""
     missingpkg = [pkg for pkg in pkgs if pkg not in repo]
     missingver = [
         pkg for pkg, ver in pkgs.items() if pkg in repo and ver not in repo[pkg]
@@ -76,76 +326,126 @@ def fetch(pkgs, repo, outdir, pip="pip") -> dict:
     if not os.path.exists(outdir):
         os.mkdir(outdir)
 
-    pypi_packages = []
-
-    git_hashes = {}
-    with pushd(outdir):
-        for pkg, ver in pkgs.items():
-            current = repo[pkg][ver]
-            if "pypi_package_name" in current and current["make"] != "pip":
-                raise ValueError(
-                    "pypi_package_name is only valid when building with pip"
-                )
-
-            if "source" in current:
-                templater = jinja2.Environment(loader=jinja2.BaseLoader).from_string(
-                    current.get("source")
-                )
-                url = templater.render(os.environ)
-            else:
-                url = None
-
-            protocol = current.get("fetch")
-            pkg_alias = current.get("pypi_package_name", pkg)
-
-            if url == "pypi" and ver == LATEST_PACKAGE_ALIAS:
-                ver = latest_pypi_version(pkg_alias)
-
-            name = f"{pkg_alias} ({ver}): {url}"
-            pkgname = f"{pkg_alias}-{ver}"
-
-            if url is None and protocol is None:
-                package_folder = os.path.abspath(pkgname)
-                print(
-                    f"Nothing to fetch for {pkgname}, "
-                    f"but created folder {package_folder}"
-                )
-                os.mkdir(pkgname)
-                continue
-
-            dst = pkgname
-
-            spliturl = url.split("?")[0].split(".")
-            ext = spliturl[-1]
-
-            if len(spliturl) > 1 and spliturl[-2] == "tar":
-                ext = f"tar.{spliturl[-1]}"
-
-            if ext in ["rpm", "tar", "gz", "tgz", "tar.gz", "tar.bz2", "tar.xz"]:
-                dst = f"{dst}.{ext}"
-
-            if url == "pypi":
-                print(f"Deferring download of {name}")
-                pypi_packages.append(f"{pkg_alias}=={ver.split('+')[0]}")
-                continue
-
-            print(f"Downloading {name}")
-            grab(url, filename=dst, version=ver, protocol=protocol, pip=pip)
-
-            if protocol == "git":
-                git_hashes[pkg] = get_git_revision_hash(path=dst)
-
-            if ext in ["tgz", "tar.gz", "tar.bz2", "tar.xz"]:
-                print(f"Extracting {dst} ...")
-                topdir = shell(f"tar -xvf {dst}").decode("utf-8").split()[0]
-                normalised_dir = topdir.split("/")[0]
-
-                if not os.path.exists(pkgname):
-                    print(f"Creating symlink {normalised_dir} -> {pkgname}")
-                    os.symlink(normalised_dir, pkgname)
-
-        print(f"Downloading {len(pypi_packages)} pypi packages")
-        shell([pip, "download", "--no-deps", "--dest .", " ".join(pypi_packages)])
+    pypi_packages = {}
+    # projects pip installs with options of their own, which a plain pip
+    # wheel would not build with
+    own_build_options = set()
+    sources = []
+
+    context = ExecutionContext(cwd=outdir)
+    for pkg, ver in pkgs.items():
+        current = repo[pkg][ver]
+        if "pypi_package_name" in current and current["make"] != "pip":
+            raise ValueError("pypi_package_name is only valid when building with pip")
+
+        if "source" in current:
+            templater = jinja2.Environment(loader=jinja2.BaseLoader).from_string(
+                current.get("source")
+            )
+            url = templater.render(os.environ)
+        else:
+            url = None
+
+        protocol = current.get("fetch")
+        pkg_alias = current.get("pypi_package_name", pkg)
+
+        locked = from_lock.get(pkg) if from_lock is not None else {}
+        if url == "pypi" and ver == LATEST_PACKAGE_ALIAS:
+            ver = locked.get("version") or latest_pypi_version(pkg_alias)
+
+        name = f"{pkg_alias} ({ver}): {url}"
+        pkgname = f"{pkg_alias}-{ver}"
+
+        if url is None and protocol is None:
+            package_folder = os.path.join(context.cwd, pkgname)
+            print(
+                f"Nothing to fetch for {pkgname}, "
+                f"but created folder {package_folder}"
+            )
+            os.makedirs(package_folder, exist_ok=True)
+            continue
+
+        dst = pkgname
+
+        spliturl = url.split("?")[0].split(".")
+        ext = spliturl[-1]
+
+        if len(spliturl) > 1 and spliturl[-2] == "tar":
+            ext = f"tar.{spliturl[-1]}"
+
+        if ext in ["rpm", "tar", "gz", "tgz", "tar.gz", "tar.bz2", "tar.xz"]:
+            dst = f"{dst}.{ext}"
+
+        if url == "pypi":
+            print(f"Deferring download of {name}")
+            pypi_packages[pkg] = f"{pkg_alias}=={ver.split('+')[0]}"
+            if resolve_makeopts(current, outdir).strip():
+                own_build_options.add(normalize(pkg_alias))
+            if lock is not None:
+                lock.record(pkg, version=ver, source="pypi")
+            continue
+
+        sources.append((pkg, (name, url, protocol, ver, dst, pkgname, ext)))
+        if lock is not None:
+            lock.record(pkg, version=ver, source=current["source"], fetch=protocol)
+
+    def fetch_source(source):
+        pkg, arguments = source
+        package_context = context
+        if fetch_jobs > 1:
+            package_context = context.logging_to(None, label=pkg)
+        revision = _fetch_source(
+            *arguments,
+            pip=pip,
+            context=package_context,
+            source_store=source_store,
+            git_mirrors=git_mirrors,
+            locked=from_lock.get(pkg) if from_lock is not None else None,
+        )
+        if lock is not None:
+            _, _, _, _, dst, _, _ = arguments
+            path = os.path.join(context.cwd, dst)
+            if revision is not None:
+                lock.record(pkg, commit=revision)
+            elif os.path.isfile(path):
+                lock.record(pkg, filename=dst, sha256=file_sha256(path))
+        return pkg, revision
+
+    if fetch_jobs > 1:
+        with ThreadPoolExecutor(max_workers=fetch_jobs) as executor:
+            revisions = dict(executor.map(fetch_source, sources))
+    else:
+        revisions = dict(map(fetch_source, sources))
+    # in the order of the release, however the downloads finished
+    git_hashes = {
+        pkg: revisions[pkg] for pkg, _ in sources if revisions[pkg] is not None
+    }
+
+    downloaded = set(os.listdir(context.cwd))
+    _fetch_pypi(pypi_packages, pip, pypi_jobs, context, lock, from_lock)
+
+    if wheel_cache is not None:
+        sdists = [
+            os.path.join(context.cwd, filename)
+            for filename in sorted(set(os.listdir(context.cwd)) - downloaded)
+            if is_sdist(filename) and _project(filename) not in own_build_options
+        ]
+        wheels = wheel_cache.replace_sdists(sdists, context.cwd, jobs=wheel_jobs)
+        if lock is not None:
+            # record what is left in outdir, for --from-lock to find; the
+            # wheel is built here, so it has no URL
+            for pkg in pypi_packages:
+                wheel = wheels.get(lock.get(pkg).get("filename"))
+                if wheel is not None:
+                    lock.discard(pkg, "url")
+                    lock.record(
+                        pkg,
+                        filename=wheel,
+                        sha256=file_sha256(os.path.join(context.cwd, wheel)),
+                    )
+
+    projects = write_simple_index(context.cwd)
+    print(f"Wrote the simple index of {projects} projects in {context.cwd}")
 
     return git_hashes
 
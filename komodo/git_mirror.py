@@ -0,0 +1,166 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+
+from komodo.package_version import COMMIT_RE
+from komodo.shell import ExecutionContext, shell
+
+
+class GitMirrors(object):
+    def __init__(self, path, submodule_jobs=8):
+        """A directory of bare mirrors of git repositories, one per URL,
+        shared by all releases and workspaces on a machine.
+
+        A mirror is cloned in full once and then brought up to date with
+        git remote update, which only transfers new objects. Packages are
+        checked out from the mirror instead of the remote, in clones without
+        blobs (--filter=blob:none), so only the files of the one commit that
+        is checked out are copied. Submodules are checked out from mirrors
+        as well, submodule_jobs at a time. Mirrors are cloned
+        and updated under an exclusive file lock, and updated at most once
+        per run."""
+        self.path = os.path.abspath(path)
+        self.submodule_jobs = submodule_jobs
+        self._updated = set()
+        self._updated_lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def mirror_path(self, url):
+        name = os.path.basename(url.rstrip("/"))
+        if not name.endswith(".git"):
+            name += ".git"
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.path, f"{key}-{name}")
+
+    @contextlib.contextmanager
+    def _lock(self, mirror):
+        with open(f"{mirror}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def update(self, url, context=None):
+        """Clone or update the mirror of url, and return its path."""
+        mirror = self.mirror_path(url)
+        with self._lock(mirror):
+            with self._updated_lock:
+                if mirror in self._updated:
+                    return mirror
+            if os.path.isdir(mirror):
+                shell(
+                    ["git", f"--git-dir={mirror}", "remote update --prune"],
+                    context=context,
+                )
+            else:
+                partial = f"{mirror}.partial"
+                shutil.rmtree(partial, ignore_errors=True)
+                shell(["git clone --mirror --quiet --", url, partial], context=context)
+                # lets checkouts of commits leave out the blobs of other commits
+                shell(
+                    [
+                        "git",
+                        f"--git-dir={partial}",
+                        "config uploadpack.allowFilter true",
+                    ],
+                    context=context,
+                )
+                os.rename(partial, mirror)
+            with self._updated_lock:
+                self._updated.add(mirror)
+        return mirror
+
+    def checkout(self, url, ref, dst, context=None):
+        """Check out ref (a branch, tag or commit) of the git repository at
+        url, with its submodules, at dst, which is relative to the directory
+        of context.
+
+        The checkout has the history and tags of the repository, for git
+        describe and setuptools_scm, but only the blobs of ref. Its remote
+        mirror is the mirror, which stays the promisor remote blobs are
+        fetched from later, and its remote origin is url."""
+        context = context or ExecutionContext()
+        source = "file://" + self.update(url, context)
+        shell(
+            [
+                "git clone --quiet --filter=blob:none --origin mirror --no-checkout",
+                "--",
+                source,
+                dst,
+            ],
+            context=context,
+        )
+        # a branch is checked out as the branch, tags and commits detached
+        if COMMIT_RE.match(ref):
+            shell(["git -C", dst, "checkout --quiet", ref], context=context)
+        else:
+            shell(["git -C", dst, "checkout --quiet", ref, "--"], context=context)
+        shell(["git -C", dst, "remote add origin", url], context=context)
+        self._submodules(url, dst, context)
+
+    def _submodules(self, url, dst, context):
+        """Check out the submodules of the checkout of url at dst, and
+        theirs, from mirrors of their repositories."""
+        gitmodules = os.path.join(context.cwd or os.curdir, dst, ".gitmodules")
+        if not os.path.exists(gitmodules):
+            return
+        output = shell(
+            ["git config --file", gitmodules, "--get-regexp ^submodule\\."],
+            context=context,
+            stream=False,
+        )
+        submodules = {}
+        for line in output.decode("utf-8").splitlines():
+            key, value = line.split(" ", 1)
+            name, variable = key.split(".", 1)[1].rsplit(".", 1)
+            submodules.setdefault(name, {})[variable] = value
+        for name, submodule in submodules.items():
+            submodule["url"] = submodule_url_of(url, submodule["url"])
+            mirror = "file://" + self.update(submodule["url"], context)
+            shell(
+                ["git -C", dst, "config", f"submodule.{name}.url", mirror],
+                context=context,
+            )
+        # git only clones submodules over file:// when told to, which is
+        # safe for the mirrors komodo made itself
+        shell(
+            [
+                "git -C",
+                dst,
+                "-c protocol.file.allow=always",
+                "submodule update --init --quiet",
+                f"--jobs {self.submodule_jobs}",
+            ],
+            context=context,
+        )
+        for name, submodule in submodules.items():
+            path = os.path.join(dst, submodule["path"])
+            shell(
+                ["git -C", dst, "config", f"submodule.{name}.url", submodule["url"]],
+                context=context,
+            )
+            shell(
+                ["git -C", path, "remote set-url origin", submodule["url"]],
+                context=context,
+            )
+            self._submodules(submodule["url"], path, context)
+
+
+def submodule_url_of(url, submodule_url):
+    """The URL of a submodule of the repository at url, whose URL in
+    .gitmodules may be relative (./ or ../) to url, like git resolves it."""
+    if not submodule_url.startswith(("./", "../")):
+        return submodule_url
+    base = url.rstrip("/")
+    separator = "/"
+    parts = submodule_url.split("/")
+    while parts and parts[0] in (".", ".."):
+        if parts.pop(0) == "..":
+            cut = max(base.rfind("/"), base.rfind(":"))
+            separator = base[cut]
+            base = base[:cut]
+    return base + separator + "/".join(parts)
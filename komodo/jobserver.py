@@ -0,0 +1,109 @@
+import contextlib
+import os
+import threading
+
+# how often packages waiting for a slot look for tokens that make and ninja
+# put back, which does not wake them
+_POLL_SECONDS = 0.05
+
+
+class Jobserver(object):
+    def __init__(self, jobs):
+        """A GNU make jobserver with jobs slots, shared by all packages that
+        build at the same time.
+
+        The slots are tokens in a pipe whose ends are handed to make and
+        ninja through MAKEFLAGS. komodo holds one implicit slot, like every
+        jobserver client, so the pipe starts with jobs - 1 tokens. The pipe
+        form of --jobserver-auth is used, rather than a named fifo, because
+        it is understood by make 4.2 and later."""
+        self.jobs = jobs
+        self._read, self._write = os.pipe()
+        os.write(self._write, b"+" * (jobs - 1))
+        # a second open file description of the read end, for taking the
+        # free tokens without blocking, and without changing the read end
+        # that make and ninja use
+        self._read_free = os.open(
+            f"/proc/self/fd/{self._read}", os.O_RDONLY | os.O_NONBLOCK
+        )
+        self._condition = threading.Condition()
+        self._implicit_free = True
+        self._holders = 0
+
+    @property
+    def fds(self):
+        return (self._read, self._write)
+
+    def makeflags(self):
+        return f"-j{self.jobs} --jobserver-auth={self._read},{self._write}"
+
+    def apply(self, context):
+        """A copy of context whose commands are clients of this jobserver."""
+        return context.setenv(MAKEFLAGS=self.makeflags()).with_fds(*self.fds)
+
+    def _take(self, count):
+        try:
+            return os.read(self._read_free, count)
+        except BlockingIOError:
+            return b""
+
+    def _refill(self):
+        """Put the pipe back to jobs - 1 tokens. Only when no package holds a
+        slot, so that no command is using the pipe, and tokens that commands
+        killed on a timeout never put back are not lost for good."""
+        while self._take(self.jobs):
+            pass
+        os.write(self._write, b"+" * (self.jobs - 1))
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold one slot while the block runs, waiting for one if needed.
+
+        A package takes the implicit slot if it is free, and a token from
+        the pipe otherwise. Both are tracked under one condition, so that a
+        package waiting for a slot gets a released one right away."""
+        with self._condition:
+            while True:
+                token = None
+                if self._implicit_free:
+                    self._implicit_free = False
+                    break
+                token = self._take(1)
+                if token:
+                    break
+                self._condition.wait(_POLL_SECONDS)
+            self._holders += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                if token is None:
+                    self._implicit_free = True
+                else:
+                    os.write(self._write, token)
+                self._holders -= 1
+                if self._holders == 0:
+                    self._refill()
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def share(self, jobs):
+        """Hold the slots that are free now, up to jobs - 1 of them, while the
+        block runs, for a tool that runs jobs in parallel but is no client of
+        the jobserver, like ninja before 1.13. Yields the number of jobs the
+        tool may run: the tokens taken, plus the slot held by the package.
+        Never waits, so that packages taking a share cannot block each
+        other."""
+        tokens = self._take(jobs - 1) if jobs > 1 else b""
+        try:
+            yield 1 + len(tokens)
+        finally:
+            if tokens:
+                with self._condition:
+                    os.write(self._write, tokens)
+                    self._condition.notify_all()
+
+    def close(self):
+        os.close(self._read_free)
+        os.close(self._read)
+        os.close(self._write)
@@ -0,0 +1,47 @@
+import json
+import os
+
+
+class BuildJournal(object):
+    def __init__(self, path, resume=False):
+        """A record of the packages make() has installed into the fakeroot.
+
+        Every completed package is appended to the file at path as a line of
+        JSON together with the fingerprint (the package key) of its inputs.
+        With resume, the packages of an earlier run are read back, so a
+        package whose fingerprint still matches does not have to be built
+        again. Without resume, any earlier journal is discarded."""
+        self.path = path
+        self._done = {}
+        if not os.path.exists(path):
+            return
+        if not resume:
+            os.remove(path)
+            return
+        with open(path, "r", encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short when the previous run was killed
+                    continue
+                self._done[entry["package"]] = entry["fingerprint"]
+
+    def is_done(self, pkg, fingerprint):
+        return fingerprint is not None and self._done.get(pkg) == fingerprint
+
+    def record(self, pkg, fingerprint):
+        if fingerprint is None or self.is_done(pkg, fingerprint):
+            return
+        self._done[pkg] = fingerprint
+        with open(self.path, "a", encoding="utf-8") as journal:
+            journal.write(json.dumps({"package": pkg, "fingerprint": fingerprint}))
+            journal.write("\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def clear(self):
+        """Forget everything, e.g. once the fakeroot has been moved away."""
+        self._done = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
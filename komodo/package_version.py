@@ -8,6 +8,8 @@ _PYPI_LATEST_VERSION_RE = r".+from\ versions\:\ (.+)\)"
 # This command is deprecated. Hopefully it is not removed until a replacement
 # is made. For updates on this, see https://github.com/pypa/pip/issues/9139
 _PYPI_LATEST_VERSION_CMD = "python -m pip install --use-deprecated=legacy-resolver {}=="
+# a full git commit hash
+COMMIT_RE = re.compile(r"^[0-9a-f]{40}$")
 
 
 def strip_version(version):
@@ -42,7 +44,50 @@ def latest_pypi_version(package):
     raise ValueError(f"{cmd} did not raise CalledProcessError")
 
 
+def _read_ref(git_dir, ref):
+    """The commit of ref (e.g. refs/heads/main) in git_dir, from its loose
+    ref file or from packed-refs, or None."""
+    try:
+        with open(os.path.join(git_dir, ref), encoding="utf-8") as ref_file:
+            return ref_file.read().strip()
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(git_dir, "packed-refs"), encoding="utf-8") as packed:
+            for line in packed:
+                if line.startswith(("#", "^")):
+                    continue
+                commit, name = line.split()
+                if name == ref:
+                    return commit
+    except OSError:
+        pass
+    return None
+
+
 def get_git_revision_hash(path):
+    """The commit checked out in the git repository at path. HEAD is read
+    from the repository files where possible, and by git rev-parse for
+    anything else, e.g. a linked worktree."""
+    git_dir = os.path.join(path, ".git")
+    if os.path.isfile(git_dir):
+        # submodules have a file pointing to the repository
+        with open(git_dir, encoding="utf-8") as gitfile:
+            content = gitfile.read().strip()
+        if content.startswith("gitdir:"):
+            git_dir = os.path.join(path, content.split(":", 1)[1].strip())
+
+    revision = None
+    try:
+        with open(os.path.join(git_dir, "HEAD"), encoding="utf-8") as head:
+            revision = head.read().strip()
+    except OSError:
+        pass
+    if revision is not None and revision.startswith("ref:"):
+        revision = _read_ref(git_dir, revision.split(":", 1)[1].strip())
+    if revision is not None and COMMIT_RE.match(revision):
+        return revision
+
     env = os.environ.copy()
     env["GIT_DIR"] = f"{path}/.git"
     return (
@@ -0,0 +1,138 @@
+"""Downloads of pinned PyPI packages without pip.
+
+The artifact pip download would pick for name==version, the wheel with the
+most preferred tag of the target pip and otherwise the sdist, is looked up
+in the PyPI JSON API, and downloaded over the pooled session of the
+download builder with its sha256 verified. Packages this cannot handle are
+left for pip download.
+"""
+
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from komodo.build import download_session, fetch_url
+from komodo.shell import shell
+from komodo.simple_index import SDIST_EXTENSIONS, normalize, parse_artifact
+from komodo.source_lock import file_sha256
+
+PYPI_JSON_URL = "https://pypi.org/pypi"
+
+
+def compatible_tags(pip="pip", context=None):
+    """The wheel tags pip installs, most preferred first, from the output of
+    pip debug --verbose, or None if pip does not tell."""
+    try:
+        output = shell([pip, "debug --verbose"], context=context, stream=False)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    tags = []
+    listing = False
+    for line in output.decode("utf-8").splitlines():
+        if line.startswith("Compatible tags:"):
+            listing = True
+        elif listing and line.startswith(" "):
+            tags.append(line.strip())
+        elif listing:
+            break
+    return tags or None
+
+
+def wheel_tags(filename):
+    """The tags of a wheel, e.g. py2-none-any and py3-none-any for
+    six-1.16.0-py2.py3-none-any.whl."""
+    python, abi, platform = os.path.splitext(filename)[0].split("-")[-3:]
+    return [
+        f"{py}-{ab}-{plat}"
+        for py in python.split(".")
+        for ab in abi.split(".")
+        for plat in platform.split(".")
+    ]
+
+
+def select_artifact(files, tags):
+    """The release file pip download would pick among files, the "urls" of
+    the PyPI JSON API: the wheel with the most preferred tag, or the sdist if
+    no wheel is compatible. None if there is neither."""
+    rank = {tag: index for index, tag in enumerate(tags)}
+    wheels = []
+    for artifact in files:
+        if artifact["filename"].endswith(".whl"):
+            ranks = [
+                rank[tag] for tag in wheel_tags(artifact["filename"]) if tag in rank
+            ]
+            if ranks:
+                wheels.append((min(ranks), artifact["filename"], artifact))
+    if wheels:
+        return min(wheels, key=lambda wheel: wheel[:2])[2]
+    sdists = [artifact for artifact in files if artifact["packagetype"] == "sdist"]
+    for extension in SDIST_EXTENSIONS:
+        for artifact in sdists:
+            if artifact["filename"].endswith(extension):
+                return artifact
+    return None
+
+
+def resolve(requirement, tags, index_url=PYPI_JSON_URL):
+    """The artifact to download for requirement (name==version), as a dict
+    with filename, url and the sha256 in digests, or None if the index does
+    not have a suitable one."""
+    name, version = requirement.split("==")
+    response = download_session().get(f"{index_url}/{name}/{version}/json")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return select_artifact(response.json()["urls"], tags)
+
+
+def fetch_artifact(filename, url, sha256_hex, dest):
+    """Download url to dest/filename, unless it is there already with the
+    right hash."""
+    path = os.path.join(dest, filename)
+    if os.path.exists(path) and file_sha256(path) == sha256_hex:
+        print(f"Using cached {filename}")
+        return
+    print(f"Downloading {filename}")
+    fetch_url(url, path, sha256_hex)
+
+
+def download_pypi(
+    requirements, dest, pip="pip", jobs=8, index_url=PYPI_JSON_URL, context=None
+):
+    """Download the artifacts of requirements into dest, jobs at a time.
+    Artifacts already in dest with the right hash are kept. Returns the
+    artifact downloaded for each requirement, None for those left to pip
+    download."""
+    tags = compatible_tags(pip, context=context)
+    if tags is None:
+        print(f"{pip} does not list its compatible tags, using pip download")
+        return dict.fromkeys(requirements)
+
+    def download(requirement):
+        artifact = resolve(requirement, tags, index_url=index_url)
+        if artifact is not None:
+            fetch_artifact(
+                artifact["filename"],
+                artifact["url"],
+                artifact["digests"]["sha256"],
+                dest,
+            )
+        return requirement, artifact
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(executor.map(download, requirements))
+
+
+def find_download(requirement, filenames):
+    """The one of filenames that pip download stored for requirement, or None
+    if that cannot be told from the names."""
+    name, version = requirement.split("==")
+    matches = []
+    for filename in filenames:
+        parsed = parse_artifact(filename)
+        if parsed is not None and (normalize(parsed[0]), parsed[1]) == (
+            normalize(name),
+            version,
+        ):
+            matches.append(filename)
+    return matches[0] if len(matches) == 1 else None
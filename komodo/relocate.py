@@ -0,0 +1,102 @@
+import base64
+import csv
+import hashlib
+import io
+import os
+from pathlib import Path
+
+
+def _record_hash(content):
+    digest = hashlib.sha256(content).digest()
+    return "sha256=" + base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+
+def _relocate_file(path, old, new, python):
+    """Replace old with new in a text file, and point a Python shebang at
+    python. Returns the new content, or None if the file was left alone."""
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+    if b"\0" in content:
+        # compiled files are left alone
+        return None
+
+    relocated = content.replace(old, new)
+    if python is not None and relocated.startswith(b"#!"):
+        shebang, newline, rest = relocated.partition(b"\n")
+        if b"python" in shebang and shebang != b"#!" + python:
+            relocated = b"#!" + python + newline + rest
+
+    if relocated == content:
+        return None
+    with open(path, "wb") as f:
+        f.write(relocated)
+    return relocated
+
+
+def relocate_dist_info(dist_info, root, old_prefix, new_prefix, python=None):
+    """Make the files of one installed distribution refer to new_prefix.
+
+    The distribution is installed below root, which will be deployed as
+    new_prefix. Every file listed in RECORD (including RECORD itself, direct_url.json
+    and console scripts) has old_prefix replaced by new_prefix, Python
+    shebangs are pointed at python, and RECORD is updated with the new
+    hashes and sizes of the files that changed.
+
+    Returns the number of files that were changed.
+    """
+    record = Path(dist_info) / "RECORD"
+    if not record.exists():
+        return 0
+    site_packages = record.parent.parent
+    old, new = os.fsencode(old_prefix), os.fsencode(new_prefix)
+    python = os.fsencode(python) if python is not None else None
+
+    rows = list(csv.reader(io.StringIO(record.read_text(encoding="utf-8"))))
+    changed = 0
+    for row in rows:
+        if not row or row[0] == f"{record.parent.name}/RECORD":
+            continue
+        path = site_packages / row[0]
+        if row[0].startswith(old_prefix + os.sep):
+            relpath = os.path.relpath(row[0], old_prefix)
+            row[0] = os.path.join(new_prefix, relpath)
+            path = Path(root) / relpath
+        script = path.parent.name == "bin"
+        content = _relocate_file(path, old, new, python if script else None)
+        if content is None:
+            continue
+        changed += 1
+        if len(row) >= 3 and row[1]:
+            row[1] = _record_hash(content)
+            row[2] = str(len(content))
+
+    out = io.StringIO()
+    csv.writer(out, lineterminator="\n").writerows(rows)
+    record.write_bytes(os.fsencode(out.getvalue()).replace(old, new))
+    return changed
+
+
+def relocate_pip_packages(root, old_prefix, new_prefix):
+    """Make the pip packages built into a fakeroot work from their final
+    location, without installing them again.
+
+    root is the directory tree as it will be deployed, while the packages
+    were installed below old_prefix. Every dist-info directory below root is
+    relocated to new_prefix, with console scripts pointing at the python of
+    the release.
+    """
+    python = os.path.join(new_prefix, "bin", "python")
+    if not os.path.exists(os.path.join(root, "bin", "python")):
+        python = None
+
+    dist_infos = sorted(Path(root).glob("lib*/python*/site-packages/*.dist-info"))
+    changed = 0
+    for dist_info in dist_infos:
+        changed += relocate_dist_info(dist_info, root, old_prefix, new_prefix, python)
+    print(
+        f"Relocated {changed} files of {len(dist_infos)} pip packages "
+        f"from {old_prefix} to {new_prefix}"
+    )
@@ -0,0 +1,194 @@
+"""Extraction of the files in an rpm, without rpm2cpio and cpio.
+
+An rpm is a 96 byte lead, a signature header padded to 8 bytes, the main
+header and a compressed cpio archive in the "newc" format. The headers are
+read only as far as needed to find the compressor of the archive, which is
+then decompressed and unpacked as it is read, straight to where the files
+belong, so every file is written once.
+"""
+
+import bz2
+import gzip
+import lzma
+import os
+import stat
+import struct
+import subprocess
+
+_LEAD_SIZE = 96
+_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+_PAYLOADCOMPRESSOR_TAG = 1125
+_STRING_TYPE = 6
+
+_CPIO_MAGIC = b"070701"
+_CPIO_HEADER_SIZE = 110
+_CPIO_TRAILER = "TRAILER!!!"
+_CHUNK_SIZE = 1024 * 1024
+
+_DECOMPRESSORS = {
+    "gzip": lambda stream: gzip.GzipFile(fileobj=stream, mode="rb"),
+    "bzip2": bz2.BZ2File,
+    "xz": lzma.LZMAFile,
+    "lzma": lzma.LZMAFile,
+}
+
+
+def _read_exactly(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ValueError("unexpected end of rpm")
+        data += chunk
+    return data
+
+
+def _read_header(stream):
+    """Read a header structure and return its string tags as a dict of tag
+    to value, along with the number of bytes it took up."""
+    intro = _read_exactly(stream, 16)
+    if intro[:4] != _HEADER_MAGIC:
+        raise ValueError("bad rpm header magic")
+    count, size = struct.unpack(">II", intro[8:])
+    index = _read_exactly(stream, 16 * count)
+    store = _read_exactly(stream, size)
+
+    tags = {}
+    for entry in range(count):
+        tag, kind, offset, _ = struct.unpack_from(">iiii", index, 16 * entry)
+        if kind == _STRING_TYPE:
+            end = store.index(b"\0", offset)
+            tags[tag] = store[offset:end].decode("utf-8")
+    return tags, 16 + 16 * count + size
+
+
+def payload_compressor(stream):
+    """Read the lead and headers of the rpm in stream, leaving it at the
+    start of the payload, and return the name of the payload compressor."""
+    if _read_exactly(stream, _LEAD_SIZE)[:4] != _LEAD_MAGIC:
+        raise ValueError("not an rpm")
+    _, size = _read_header(stream)
+    # the signature header is padded to a multiple of 8 bytes
+    _read_exactly(stream, -size % 8)
+    tags, _ = _read_header(stream)
+    # rpms older than the tag are compressed with gzip
+    return tags.get(_PAYLOADCOMPRESSOR_TAG, "gzip")
+
+
+def _destination(name, root):
+    """Where a member of the archive goes: below root, with a leading usr/
+    left out. Members outside of root are refused."""
+    name = os.path.normpath(name.lstrip("/"))
+    if name in (".", "usr"):
+        return None
+    if name.startswith("usr" + os.sep):
+        name = os.path.relpath(name, "usr")
+    if name == ".." or name.startswith(".." + os.sep):
+        raise ValueError(f"rpm member {name} is outside of the prefix")
+    return os.path.join(root, name)
+
+
+def _copy(stream, path, size):
+    if os.path.lexists(path) and not os.path.isdir(path):
+        os.remove(path)
+    with open(path, "wb") as out:
+        while size:
+            chunk = stream.read(min(size, _CHUNK_SIZE))
+            if not chunk:
+                raise ValueError("unexpected end of rpm payload")
+            out.write(chunk)
+            size -= len(chunk)
+
+
+def _create_empty_links(links):
+    """Create the hard linked files whose data never came, which are the
+    empty ones, as no member carries data for them. Returns the number of
+    files created."""
+    for paths in links.values():
+        first, mode, mtime = paths[0]
+        _copy(None, first, 0)
+        os.chmod(first, stat.S_IMODE(mode))
+        os.utime(first, (mtime, mtime))
+        for link, _, _ in paths[1:]:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.link(first, link)
+    return len(links)
+
+
+def extract_cpio(stream, root):
+    """Unpack a newc cpio archive from stream into root, with the usr/
+    prefix of the members removed. Returns the number of files written."""
+    directories = []
+    links = {}
+    files = 0
+    while True:
+        header = _read_exactly(stream, _CPIO_HEADER_SIZE)
+        if header[:6] != _CPIO_MAGIC:
+            raise ValueError("unsupported cpio format in rpm payload")
+        fields = [int(field, 16) for field in struct.unpack("8s" * 13, header[6:])]
+        ino, mode, _, _, nlink, mtime, size, _, _, _, _, namesize, _ = fields
+        name = _read_exactly(stream, namesize)[:-1].decode("utf-8")
+        _read_exactly(stream, -(_CPIO_HEADER_SIZE + namesize) % 4)
+        if name == _CPIO_TRAILER:
+            files += _create_empty_links(links)
+            break
+
+        path = _destination(name, root)
+        if path is None or stat.S_ISDIR(mode):
+            if path is not None:
+                os.makedirs(path, exist_ok=True)
+                directories.append((path, mode, mtime))
+            _read_exactly(stream, size + -size % 4)
+            continue
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if stat.S_ISLNK(mode):
+            target = _read_exactly(stream, size).decode("utf-8")
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(target, path)
+        elif stat.S_ISREG(mode):
+            if nlink > 1 and size == 0:
+                # the data of hard linked files comes with the last link
+                links.setdefault(ino, []).append((path, mode, mtime))
+            else:
+                _copy(stream, path, size)
+                os.chmod(path, stat.S_IMODE(mode))
+                os.utime(path, (mtime, mtime))
+                files += 1
+                for link, _, _ in links.pop(ino, []):
+                    if os.path.lexists(link):
+                        os.remove(link)
+                    os.link(path, link)
+        else:
+            # device files and fifos have no place in a prefix
+            _read_exactly(stream, size)
+        _read_exactly(stream, -size % 4)
+
+    # directories last, as they may be read only
+    for path, mode, mtime in reversed(directories):
+        os.chmod(path, stat.S_IMODE(mode) | stat.S_IWUSR)
+        os.utime(path, (mtime, mtime))
+    return files
+
+
+def extract_rpm(path, root):
+    """Install the files of the rpm at path into root, with usr/ stripped,
+    i.e. usr/lib64/libz.so ends up as root/lib64/libz.so.
+
+    Payloads compressed with gzip, bzip2 or xz are unpacked in process;
+    anything else (e.g. zstd) is decompressed by rpm2cpio."""
+    with open(path, "rb") as rpm_file:
+        compressor = payload_compressor(rpm_file)
+        if compressor in _DECOMPRESSORS:
+            with _DECOMPRESSORS[compressor](rpm_file) as payload:
+                return extract_cpio(payload, root)
+
+    with subprocess.Popen(["rpm2cpio", path], stdout=subprocess.PIPE) as rpm2cpio:
+        files = extract_cpio(rpm2cpio.stdout, root)
+        rpm2cpio.stdout.read()
+    if rpm2cpio.returncode != 0:
+        raise subprocess.CalledProcessError(rpm2cpio.returncode, rpm2cpio.args)
+    return files
@@ -1,7 +1,13 @@
+import collections
 import contextlib
+import copy
 import os
+import signal
 import subprocess
 import sys
+import threading
+
+from komodo import trace
 
 
 @contextlib.contextmanager
@@ -15,7 +21,212 @@ def pushd(path):
     os.chdir(prev)
 
 
-def shell(cmd, sudo=False):
+# the number of lines of output kept for error messages when streaming
+_TAIL_LINES = 200
+
+
+class ExecutionContext(object):
+    def __init__(
+        self,
+        cwd=None,
+        env=None,
+        pass_fds=(),
+        stream=False,
+        log=None,
+        label=None,
+        timeout=None,
+    ):
+        """The working directory and environment shell commands run in.
+
+        Builders and fetchers pass a context to shell() instead of changing
+        the working directory or os.environ of the process, so that several
+        of them can run at the same time in different threads. cwd defaults
+        to the current working directory and env to a copy of os.environ, both
+        taken when the context is created. pass_fds are file descriptors the
+        commands inherit, e.g. the pipe of a jobserver.
+
+        The other arguments are defaults for shell(): whether the output of
+        commands is streamed, the log file streamed output is appended to,
+        the label put in front of streamed lines on the console and the
+        timeout of every command in seconds."""
+        self.cwd = os.path.abspath(cwd if cwd is not None else os.getcwd())
+        self.env = dict(os.environ if env is None else env)
+        self.pass_fds = tuple(pass_fds)
+        self.stream = stream
+        self.log = log
+        self.label = label
+        self.timeout = timeout
+
+    def _replace(self, **changes):
+        context = copy.copy(self)
+        context.__dict__.update(changes)
+        return context
+
+    def chdir(self, path):
+        """A copy of this context in path, which may be relative to cwd."""
+        if path is None:
+            return self
+        return self._replace(cwd=os.path.abspath(os.path.join(self.cwd, path)))
+
+    def setenv(self, **variables):
+        """A copy of this context with the given environment variables set."""
+        env = dict(self.env)
+        env.update(variables)
+        return self._replace(env=env)
+
+    def with_fds(self, *fds):
+        """A copy of this context whose commands also inherit fds."""
+        return self._replace(pass_fds=self.pass_fds + fds)
+
+    def logging_to(self, log, label=None):
+        """A copy of this context whose commands stream their output to the
+        console, prefixed with label, and to the file log."""
+        return self._replace(stream=True, log=log, label=label)
+
+
+# the process groups of the commands running in sessions of their own,
+# which signals to komodo from the terminal do not reach
+_groups = set()
+_groups_lock = threading.Lock()
+
+
+def _forward(signum):
+    with _groups_lock:
+        groups = list(_groups)
+    for group in groups:
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+            os.killpg(group, signum)
+
+
+def forward_signals():
+    """Pass SIGINT, SIGTERM and SIGHUP on to the commands running in
+    sessions of their own, so that they end with komodo. SIGINT then raises
+    KeyboardInterrupt, and the other signals end komodo as they would
+    without a handler. Call from the main thread."""
+
+    def interrupt(signum, frame):
+        _forward(signum)
+        signal.default_int_handler(signum, frame)
+
+    def terminate(signum, _):
+        _forward(signum)
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, terminate)
+
+
+@contextlib.contextmanager
+def _process(cmdlist, cwd, env, pass_fds, timeout, own_group, **kwargs):
+    """Start a command, and yield it with an event that is set if it is
+    killed for running longer than timeout seconds.
+
+    A command in its own_group runs in a session of its own, and the whole
+    process group is killed on a timeout, so nothing the command started is
+    left running. Signals to komodo reach the group through
+    forward_signals(). Otherwise the command keeps the terminal of komodo,
+    for password and host key prompts, and only the command itself is
+    killed on a timeout."""
+    with subprocess.Popen(
+        cmdlist,
+        cwd=cwd,
+        env=env,
+        pass_fds=pass_fds,
+        start_new_session=own_group,
+        **kwargs,
+    ) as process:
+
+        def send(signum):
+            with contextlib.suppress(ProcessLookupError, PermissionError):
+                if own_group:
+                    os.killpg(process.pid, signum)
+                else:
+                    process.send_signal(signum)
+
+        if own_group:
+            with _groups_lock:
+                _groups.add(process.pid)
+        timed_out = threading.Event()
+        timer = None
+        if timeout is not None:
+
+            def kill():
+                timed_out.set()
+                send(signal.SIGKILL)
+
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+        try:
+            yield process, timed_out
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if own_group:
+                with _groups_lock:
+                    _groups.discard(process.pid)
+
+
+def _check(process, timed_out, cmdlist, timeout, output):
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmdlist, timeout, output=output)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmdlist, output)
+    return output
+
+
+def _capture(cmdlist, cwd, env, pass_fds, timeout, own_group):
+    """Run a command and return all of its stdout."""
+    with _process(
+        cmdlist, cwd, env, pass_fds, timeout, own_group, stdout=subprocess.PIPE
+    ) as (process, timed_out):
+        output = process.stdout.read()
+        process.wait()
+    return _check(process, timed_out, cmdlist, timeout, output)
+
+
+def _stream(cmdlist, cwd, env, pass_fds, log, label, timeout, own_group):
+    """Run a command, copying its output line by line to the console and to
+    log while it runs. Only the last lines are kept, and returned."""
+    tail = collections.deque(maxlen=_TAIL_LINES)
+    prefix = f"[{label}] " if label else ""
+    with contextlib.ExitStack() as stack:
+        log_file = stack.enter_context(open(log, "ab")) if log else None
+        process, timed_out = stack.enter_context(
+            _process(
+                cmdlist,
+                cwd,
+                env,
+                pass_fds,
+                timeout,
+                own_group,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+        )
+        for line in process.stdout:
+            tail.append(line)
+            if log_file is not None:
+                log_file.write(line)
+            sys.stdout.write(prefix + line.decode("utf-8", errors="replace"))
+            sys.stdout.flush()
+        process.wait()
+
+    return _check(process, timed_out, cmdlist, timeout, b"".join(tail))
+
+
+def shell(cmd, sudo=False, context=None, stream=None, timeout=None):
+    """Run cmd and return its output.
+
+    With stream (by default that of the context) stdout and stderr are
+    written to the console and to the log of the context line by line as the
+    command runs, and only the last lines of output are kept and returned,
+    so output of any size takes bounded memory. Otherwise the whole of stdout
+    is returned when the command is done. A command still running after
+    timeout seconds (by default that of the context) is killed, along with
+    everything it started, and raises subprocess.TimeoutExpired. Only such
+    commands run in a session of their own."""
     try:
         cmdlist = cmd.split(" ")
     except AttributeError:
@@ -26,11 +237,28 @@ def shell(cmd, sudo=False):
     if sudo:
         cmdlist = ["sudo"] + cmdlist
 
-    prompt = f"[{os.getcwd()}]>"
+    cwd = env = log = label = None
+    pass_fds = ()
+    if context is not None:
+        cwd, env, pass_fds = context.cwd, context.env, context.pass_fds
+        log, label = context.log, context.label
+        stream = context.stream if stream is None else stream
+        timeout = context.timeout if timeout is None else timeout
+
+    prompt = f"[{cwd or os.getcwd()}]>"
     print(prompt, " ".join(cmdlist))
 
+    command = " ".join(filter(None, cmdlist))
+    cmdlist = tuple(filter(None, cmdlist))
+    # sudo may ask for a password on the terminal
+    own_group = timeout is not None and not sudo
     try:
-        return subprocess.check_output(tuple(filter(None, cmdlist)))
+        with trace.span(command[:80], "shell", command=command, cwd=cwd):
+            if stream:
+                return _stream(
+                    cmdlist, cwd, env, pass_fds, log, label, timeout, own_group
+                )
+            return _capture(cmdlist, cwd, env, pass_fds, timeout, own_group)
     except subprocess.CalledProcessError as e:
         print(e.output, file=sys.stderr)
         raise
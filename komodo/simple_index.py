@@ -0,0 +1,103 @@
+"""A PEP 503 simple index of the pip packages in a download cache.
+
+With --find-links pip lists and parses the name of every file in the cache
+for every install. The index has a page per project linking to the files of
+that project only, so pip reads one small page instead, however large the
+cache grows.
+"""
+
+import html
+import os
+import re
+import shutil
+import tempfile
+from urllib.parse import quote
+
+SIMPLE_INDEX = ".simple"
+# in the order pip download prefers them
+SDIST_EXTENSIONS = (".tar.gz", ".zip", ".tar.bz2", ".tgz")
+_SDIST_RE = re.compile(
+    r"^(.+)-([^-]+?)(" + "|".join(re.escape(ext) for ext in SDIST_EXTENSIONS) + ")$"
+)
+
+
+def normalize(name):
+    """The PEP 503 normalized form of a project name."""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def parse_artifact(filename):
+    """The project name and version of a wheel or sdist filename, or None if
+    filename is neither."""
+    if filename.endswith(".whl"):
+        parts = filename.split("-")
+        return tuple(parts[:2]) if len(parts) >= 5 else None
+    sdist = _SDIST_RE.match(filename)
+    return sdist.groups()[:2] if sdist else None
+
+
+def _page(title, links):
+    anchors = "".join(
+        f'    <a href="{html.escape(href)}">{html.escape(text)}</a><br/>\n'
+        for href, text in links
+    )
+    return (
+        "<!DOCTYPE html>\n<html>\n  <head>\n"
+        f"    <title>{html.escape(title)}</title>\n"
+        "  </head>\n  <body>\n"
+        f"{anchors}"
+        "  </body>\n</html>\n"
+    )
+
+
+def _write(path, content):
+    with open(path, "w", encoding="utf-8") as page:
+        page.write(content)
+
+
+def write_simple_index(cache):
+    """(Re)generate the index of the wheels and sdists in cache, in the
+    directory SIMPLE_INDEX of it. The new index replaces the old one in two
+    renames, so pip never sees a half written one. Returns the number of
+    projects in it."""
+    projects = {}
+    for filename in sorted(os.listdir(cache)):
+        parsed = parse_artifact(filename)
+        if parsed is not None and os.path.isfile(os.path.join(cache, filename)):
+            projects.setdefault(normalize(parsed[0]), []).append(filename)
+
+    index = os.path.join(cache, SIMPLE_INDEX)
+    partial = tempfile.mkdtemp(dir=cache, prefix=f"{SIMPLE_INDEX}-")
+    for project, filenames in projects.items():
+        os.mkdir(os.path.join(partial, project))
+        _write(
+            os.path.join(partial, project, "index.html"),
+            _page(
+                f"Links for {project}",
+                [(f"../../{quote(filename)}", filename) for filename in filenames],
+            ),
+        )
+    _write(
+        os.path.join(partial, "index.html"),
+        _page("Simple index", [(f"{project}/", project) for project in projects]),
+    )
+    os.chmod(partial, 0o755)
+
+    if os.path.isdir(index):
+        old = tempfile.mkdtemp(dir=cache, prefix=f"{SIMPLE_INDEX}-old-")
+        os.rename(index, os.path.join(old, SIMPLE_INDEX))
+        os.rename(partial, index)
+        shutil.rmtree(old)
+    else:
+        os.rename(partial, index)
+    return len(projects)
+
+
+def pip_source_options(cache):
+    """The options for pip install to find packages in cache: its simple
+    index if fetch wrote one, and the files in it otherwise."""
+    if cache is not None:
+        index = os.path.abspath(os.path.join(cache, SIMPLE_INDEX))
+        if os.path.isdir(index):
+            return [f"--index-url file://{index}"]
+    return ["--no-index", f"--find-links {cache}"]
@@ -0,0 +1,46 @@
+import hashlib
+
+import yaml as yml
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class SourceLock(object):
+    def __init__(self, packages=None):
+        """What was fetched for each package of a release: the version, the
+        source as written in the repository, and the commit of git sources
+        or the filename and sha256 of downloaded files, with the URL of PyPI
+        artifacts.
+
+        Sources are kept as templates, so that secrets in the environment do
+        not end up in the lockfile. kmd writes the lockfile next to the
+        release manifest, and --from-lock fetches the same sources again,
+        without asking git remotes or package indexes for anything that is
+        already in the cache."""
+        self.packages = packages if packages is not None else {}
+
+    def record(self, pkg, **fields):
+        entry = self.packages.setdefault(pkg, {})
+        entry.update({key: value for key, value in fields.items() if value is not None})
+
+    def discard(self, pkg, *fields):
+        for field in fields:
+            self.packages.get(pkg, {}).pop(field, None)
+
+    def get(self, pkg):
+        return self.packages.get(pkg, {})
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as filehandle:
+            yml.dump(self.packages, filehandle, default_flow_style=False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as filehandle:
+            return cls(yml.safe_load(filehandle) or {})
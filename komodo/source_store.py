@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+from komodo.copy_tree import copy_tree
+from komodo.package_version import COMMIT_RE
+from komodo.source_lock import file_sha256
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    return sum(
+        os.lstat(os.path.join(dirpath, name)).st_size
+        for dirpath, _, filenames in os.walk(path)
+        for name in filenames
+    )
+
+
+def remote_commit(url, ref):
+    """The commit that ref (a branch or tag) of the git repository at url
+    points to, or None if it cannot be found."""
+    if COMMIT_RE.match(ref):
+        return ref
+    try:
+        output = subprocess.check_output(
+            ["git", "ls-remote", url, ref, f"{ref}^{{}}"], stderr=subprocess.DEVNULL
+        ).decode("utf-8")
+    except subprocess.CalledProcessError:
+        return None
+    commits = dict(reversed(line.split("\t")) for line in output.splitlines())
+    # git clone -b prefers a branch; an annotated tag points to a tag object,
+    # its peeled ^{} entry to the commit
+    for name in (f"refs/heads/{ref}", f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}"):
+        if name in commits:
+            return commits[name]
+    return None
+
+
+class SourceStore(object):
+    def __init__(self, path):
+        """A directory of downloaded sources shared by all releases and
+        workspaces on a machine.
+
+        Files (tarballs and rpms) are stored by their URL, and git checkouts
+        by their commit, so a source is only ever downloaded once. A file
+        whose sha256 is known, from the lockfile of --from-lock, is checked
+        against the stored one, which is downloaded again if upstream
+        replaced the file since. The cache directory of a release gets hard links to files,
+        falling back to symbolic links across file systems, as they are only
+        read. Git checkouts are copied instead, sharing data blocks with the
+        store where the file system can reflink, since builds may write into
+        their sources and an in place write to a hard link would change the
+        store entry of every release. Entries are filled under an exclusive
+        file lock, so concurrent runs wait for each other instead of
+        downloading the same source twice. The modification time of an
+        entry is its last use, for evict()."""
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.join(self.path, ".locks"), exist_ok=True)
+
+    def _entry(self, kind, key):
+        return os.path.join(self.path, kind, key[:2], key)
+
+    @contextlib.contextmanager
+    def _lock(self, key):
+        with open(os.path.join(self.path, ".locks", key), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _fill(self, kind, key, download, valid=None):
+        """Return the entry for key, calling download(path) to create it at
+        path if the store does not have it yet, or if valid(entry) is
+        false."""
+        entry = self._entry(kind, key)
+        with self._lock(key):
+            if os.path.lexists(entry) and valid is not None and not valid(entry):
+                print(f"The {key} in the source store is outdated")
+                _remove(entry)
+            if not os.path.lexists(entry):
+                os.makedirs(os.path.dirname(entry), exist_ok=True)
+                partial = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix=".")
+                try:
+                    download(os.path.join(partial, key))
+                    os.rename(os.path.join(partial, key), entry)
+                finally:
+                    shutil.rmtree(partial, ignore_errors=True)
+            else:
+                print(f"Using {key} from the source store")
+            os.utime(entry, follow_symlinks=False)
+        return entry
+
+    def file(self, url, sha256, dst, download):
+        """Put the file downloaded from url at dst. sha256 is the hash of
+        its content, if known; a stored file with another hash is replaced
+        by a new download."""
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        entry = self._fill(
+            "files",
+            key,
+            download,
+            None if sha256 is None else lambda entry: file_sha256(entry) == sha256,
+        )
+        _remove(dst)
+        try:
+            os.link(entry, dst)
+        except OSError:
+            os.symlink(entry, dst)
+
+    def checkout(self, url, ref, dst, clone):
+        """Put a checkout of ref of the git repository at url at dst. Returns
+        False, without doing anything, if the commit of ref is unknown."""
+        commit = remote_commit(url, ref)
+        if commit is None:
+            return False
+        entry = self._fill("git", commit, clone)
+        _remove(dst)
+        # each release gets its own tree, as builds may write to it
+        copy_tree(entry, dst, mode="reflink", prune=False)
+        return True
+
+    def entries(self):
+        """All entries, as (last use, size, path) tuples."""
+        entries = []
+        for kind in ("files", "git"):
+            top = os.path.join(self.path, kind)
+            if not os.path.isdir(top):
+                continue
+            for shard in os.listdir(top):
+                for name in os.listdir(os.path.join(top, shard)):
+                    if name.startswith("."):
+                        continue
+                    path = os.path.join(top, shard, name)
+                    mtime = os.lstat(path).st_mtime
+                    entries.append((mtime, _size(path), path))
+        return entries
+
+    def evict(self, max_size):
+        """Remove the least recently used entries until the store takes up
+        at most max_size bytes. Returns the number of bytes freed."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for _, size, path in entries:
+            if total - freed <= max_size:
+                break
+            key = os.path.basename(path)
+            with self._lock(key):
+                print(f"Evicting {key} from the source store")
+                _remove(path)
+            freed += size
+        return freed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Remove the least recently used sources from a source "
+        "store of kmd --source-store until it fits in a size limit.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "store",
+        type=str,
+        help="The source store directory.",
+    )
+    parser.add_argument(
+        "--max-size",
+        type=float,
+        required=True,
+        help="The size limit of the source store in GiB.",
+    )
+    args = parser.parse_args()
+    freed = SourceStore(args.store).evict(int(args.max_size * 1024**3))
+    print(f"Freed {freed / 1024**3:.1f} GiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Timeline tracing of kmd runs in the Chrome trace-event format.
+
+Tracing is off until start() is called. After that every span() is recorded
+as a complete ("X") event with its wall-clock start and duration and the CPU
+time spent by child processes during the span, as reported by
+getrusage(RUSAGE_CHILDREN). Spans in different threads end up on different
+tracks. The file written by write()
+can be opened in Perfetto or chrome://tracing.
+
+Child CPU time is accounted to a span when the child is waited for, so with
+concurrent builds a span may include time of children of a neighbouring span
+that finished while it ran.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+_tracer = None
+
+
+class Tracer(object):
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def _now(self):
+        return (time.perf_counter() - self._origin) * 1e6
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        start = self._now()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            args.update(
+                {
+                    "children_user_cpu_s": round(after.ru_utime - before.ru_utime, 6),
+                    "children_system_cpu_s": round(after.ru_stime - before.ru_stime, 6),
+                }
+            )
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": self._now() - start,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def write(self, path):
+        with self._lock:
+            events = list(self.events)
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+
+def start():
+    """Start recording spans, discarding anything recorded before."""
+    global _tracer  # pylint: disable=global-statement
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop(path):
+    """Stop recording and write the trace to path."""
+    global _tracer  # pylint: disable=global-statement
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.write(path)
+
+
+def span(name, category, **args):
+    """A context manager recording the block it wraps, if tracing is on."""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, category, **args)
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from komodo.pypi_download import compatible_tags
+from komodo.shell import ExecutionContext, shell
+from komodo.simple_index import SDIST_EXTENSIONS
+
+
+def is_sdist(filename):
+    return filename.endswith(SDIST_EXTENSIONS)
+
+
+class WheelCache(object):
+    def __init__(self, path, pip="pip"):
+        """A persistent directory of wheels built from sdists.
+
+        Wheels are stored per sdist file name (which holds the package name and
+        version) and the most specific wheel tag of the target pip, e.g.
+        cp38-cp38-manylinux_2_17_x86_64, which names the Python, its ABI and
+        the platform of the Python pip installs into, rather than those of
+        komodo. So a C extension is only compiled once for every
+        combination. Wheels are built with
+        plain pip wheel, so fetch leaves out packages whose makeopts ask for
+        something else, e.g. --no-build-isolation."""
+        self.path = os.path.abspath(path)
+        self.pip = pip
+        self._tag = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry(self, sdist):
+        """The directory holding the wheels built from sdist."""
+        if self._tag is None:
+            tags = compatible_tags(self.pip) or []
+            if not tags:
+                raise ValueError(f"{self.pip} does not list its compatible tags")
+            self._tag = tags[0]
+        return os.path.join(self.path, f"{os.path.basename(sdist)}-{self._tag}")
+
+    def wheel(self, sdist):
+        """Return the path of the wheel built from sdist, building it first if
+        it is not in the cache."""
+        entry = self.entry(sdist)
+        if not os.path.isdir(entry):
+            print(f"Building a wheel from {os.path.basename(sdist)}")
+            build_dir = tempfile.mkdtemp(dir=self.path, prefix=".build-")
+            try:
+                shell(
+                    [
+                        self.pip,
+                        "wheel",
+                        "--no-deps",
+                        f"--wheel-dir {build_dir}",
+                        os.path.abspath(sdist),
+                    ],
+                    context=ExecutionContext(cwd=build_dir),
+                )
+                os.rename(build_dir, entry)
+            except OSError:
+                # another run stored the same wheel first
+                if not os.path.isdir(entry):
+                    raise
+            finally:
+                shutil.rmtree(build_dir, ignore_errors=True)
+
+        wheels = [name for name in os.listdir(entry) if name.endswith(".whl")]
+        if len(wheels) != 1:
+            raise ValueError(f"expected one wheel in {entry}, found {wheels}")
+        return os.path.join(entry, wheels[0])
+
+    def replace_sdists(self, sdists, outdir, jobs=None):
+        """Build wheels from sdists in parallel, then put each wheel in outdir
+        in place of its sdist, so pip only ever installs wheels. Returns the
+        file name of the wheel that replaced each sdist, by the file name of
+        the sdist."""
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            wheels = list(executor.map(self.wheel, sdists))
+
+        for sdist, wheel in zip(sdists, wheels):
+            shutil.copy2(wheel, outdir)
+            os.remove(sdist)
+        return {
+            os.path.basename(sdist): os.path.basename(wheel)
+            for sdist, wheel in zip(sdists, wheels)
+        }
@@ -1,16 +1,26 @@
-from unittest.mock import patch
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
-from komodo.build import make
+import komodo.build
+from komodo.build import build_in_parallel, build_order
+from komodo.build import cmake as build_cmake
+from komodo.build import download, make, run_task
+from komodo.build import sh as build_sh
+from komodo.compiler_cache import CompilerCache
+from komodo.jobserver import Jobserver
 from komodo.package_version import LATEST_PACKAGE_ALIAS
+from komodo.shell import ExecutionContext
 
 
 @pytest.fixture
 def captured_shell_commands(monkeypatch):
     commands = []
     with monkeypatch.context() as m:
-        m.setattr("komodo.build.shell", lambda cmd: commands.append(cmd))
+        m.setattr("komodo.build.shell", lambda cmd, **kwargs: commands.append(cmd))
         yield commands
 
 
@@ -75,13 +85,13 @@ def test_make_pip_package_from_latest(captured_shell_commands, tmpdir):
         }
     }
 
-    with patch("komodo.build.latest_pypi_version") as mock_latest_version:
-        mock_latest_version.return_value = "1.0.0"
+    with pytest.raises(ValueError, match="no resolved version"):
         make(packages, repositories, {}, str(tmpdir))
-        mock_latest_version.assert_called_once_with("PyYaml")
-    assert len(captured_shell_commands) == 2
-    assert "mkdir" in " ".join(captured_shell_commands[0])
-    assert "pip install PyYaml==1.0.0" in " ".join(captured_shell_commands[1])
+
+    make(packages, repositories, {}, str(tmpdir), pypi_versions={"yaml": "1.0.0"})
+    assert len(captured_shell_commands) == 3
+    assert "mkdir" in " ".join(captured_shell_commands[1])
+    assert "pip install PyYaml==1.0.0" in " ".join(captured_shell_commands[2])
 
 
 def test_make_sh_does_not_accept_pypi_package_name(captured_shell_commands, tmpdir):
@@ -101,3 +111,504 @@ def test_make_sh_does_not_accept_pypi_package_name(captured_shell_commands, tmpd
 
     with pytest.raises(ValueError, match="pypi_package_name"):
         make(packages, repositories, {}, str(tmpdir))
+
+
+def _record_build(pkg, logfile, fail=False):
+    with open(logfile, "a") as log:
+        log.write(f"start {pkg}\n")
+    if fail:
+        raise RuntimeError(f"{pkg} failed")
+    with open(logfile, "a") as log:
+        log.write(f"end {pkg}\n")
+
+
+def test_build_in_parallel_respects_dependencies(tmpdir):
+    logfile = str(tmpdir / "log")
+    dependencies = {
+        "python": [],
+        "setuptools": ["python"],
+        "numpy": ["python", "setuptools"],
+        "pyaml": ["python"],
+        "scipy": ["numpy", "setuptools"],
+    }
+    pkgorder = ["python", "setuptools", "numpy", "pyaml", "scipy"]
+    tasks = {pkg: (_record_build, (pkg, logfile), {}) for pkg in pkgorder}
+
+    build_in_parallel(pkgorder, dependencies, tasks, package_jobs=3)
+
+    with open(logfile) as log:
+        events = log.read().splitlines()
+    assert sorted(events) == sorted(
+        [f"start {pkg}" for pkg in pkgorder] + [f"end {pkg}" for pkg in pkgorder]
+    )
+    for pkg, deps in dependencies.items():
+        for dep in deps:
+            assert events.index(f"end {dep}") < events.index(f"start {pkg}")
+
+
+def test_build_in_parallel_stops_after_failure(tmpdir):
+    logfile = str(tmpdir / "log")
+    dependencies = {"python": [], "setuptools": ["python"], "numpy": ["setuptools"]}
+    pkgorder = ["python", "setuptools", "numpy"]
+    tasks = {pkg: (_record_build, (pkg, logfile), {}) for pkg in pkgorder}
+    tasks["setuptools"] = (_record_build, ("setuptools", logfile), {"fail": True})
+
+    with pytest.raises(RuntimeError, match="setuptools failed"):
+        build_in_parallel(pkgorder, dependencies, tasks, package_jobs=2)
+
+    with open(logfile) as log:
+        events = log.read().splitlines()
+    assert "start numpy" not in events
+
+
+def test_build_order_puts_dependencies_first():
+    packages = {"scipy": "1", "pyaml": "1", "numpy": "1", "python": "1"}
+    repositories = {
+        "scipy": {"1": {"depends": ["numpy", "python"]}},
+        "pyaml": {"1": {"depends": ["python"]}},
+        "numpy": {"1": {"depends": ["python"]}},
+        "python": {"1": {}},
+    }
+
+    assert build_order(packages, repositories) == ["python", "numpy", "scipy", "pyaml"]
+
+
+def test_build_order_handles_deep_diamonds():
+    packages = {f"pkg{i}": "1" for i in range(2000)}
+    repositories = {
+        f"pkg{i}": {"1": {"depends": [f"pkg{j}" for j in range(max(0, i - 3), i)]}}
+        for i in range(2000)
+    }
+
+    order = build_order(dict(reversed(list(packages.items()))), repositories)
+
+    assert order == [f"pkg{i}" for i in range(2000)]
+
+
+def test_build_order_reports_cycles(capsys):
+    packages = {"a": "1", "b": "1", "c": "1"}
+    repositories = {
+        "a": {"1": {"depends": ["b"]}},
+        "b": {"1": {"depends": ["c"]}},
+        "c": {"1": {"depends": ["a"]}},
+    }
+
+    with pytest.raises(SystemExit):
+        build_order(packages, repositories)
+
+    assert "dependency cycle: a -> b -> c -> a" in capsys.readouterr().err
+
+
+def test_make_in_parallel_leaves_process_environment_alone(monkeypatch, tmpdir):
+    packages = {"python": "3.8.6", "numpy": "1.23.5", "pyaml": "20.4.0"}
+    repositories = {
+        "python": {"3.8.6": {"make": "noop", "maintainer": "someone"}},
+        "numpy": {
+            "1.23.5": {
+                "source": "pypi",
+                "make": "pip",
+                "maintainer": "someone",
+                "depends": ["python"],
+            }
+        },
+        "pyaml": {
+            "20.4.0": {
+                "source": "pypi",
+                "make": "pip",
+                "maintainer": "someone",
+                "depends": ["python"],
+            }
+        },
+    }
+    contexts = []
+    monkeypatch.delenv("DESTDIR", raising=False)
+    monkeypatch.setattr(
+        "komodo.build.shell", lambda cmd, context=None: contexts.append(context)
+    )
+
+    make(packages, repositories, {}, str(tmpdir), package_jobs=2)
+
+    assert "DESTDIR" not in os.environ
+    builds = [context for context in contexts if context is not None]
+    assert len(builds) == 2
+    assert all(context.env["DESTDIR"] == "." for context in builds)
+
+
+def _pip_repository():
+    def pip_package(**entry):
+        return {"source": "pypi", "make": "pip", "maintainer": "someone", **entry}
+
+    return {
+        "python": {"3.8.6": {"make": "noop", "maintainer": "someone"}},
+        "setuptools": {"44.0.1": pip_package(depends=["python"])},
+        "pyaml": {"20.4.0": pip_package(depends=["python"])},
+        "numpy": {"1.23.5": pip_package(depends=["python"], makeopts="--pre")},
+        "scipy": {"1.9.3": pip_package(depends=["numpy", "setuptools"])},
+        "pandas": {"1.5.2": pip_package(depends=["setuptools"])},
+    }
+
+
+@pytest.fixture
+def captured_pip_installs(monkeypatch):
+    installs = []
+
+    def shell(cmd, **kwargs):
+        cmd = " ".join(filter(None, cmd))
+        if " -r " in cmd:
+            with open(cmd.split(" -r ")[1].split()[0]) as requirements:
+                installs.append(sorted(requirements.read().split()))
+        elif "pip install" in cmd:
+            installs.append([cmd.split("pip install ")[1].split()[0]])
+
+    monkeypatch.setattr("komodo.build.shell", shell)
+    yield installs
+
+
+def test_make_batches_consecutive_pip_packages(captured_pip_installs, tmpdir):
+    packages = {
+        "python": "3.8.6",
+        "setuptools": "44.0.1",
+        "pyaml": "20.4.0",
+        "numpy": "1.23.5",
+        "scipy": "1.9.3",
+        "pandas": "1.5.2",
+    }
+
+    make(packages, _pip_repository(), {}, str(tmpdir), batch_pip=True)
+
+    assert captured_pip_installs == [
+        ["pyaml==20.4.0", "setuptools==44.0.1"],
+        ["numpy==1.23.5"],
+        ["pandas==1.5.2", "scipy==1.9.3"],
+    ]
+
+
+def test_make_batches_ready_pip_packages_in_parallel(captured_pip_installs, tmpdir):
+    packages = {
+        "python": "3.8.6",
+        "setuptools": "44.0.1",
+        "pyaml": "20.4.0",
+        "numpy": "1.23.5",
+        "scipy": "1.9.3",
+        "pandas": "1.5.2",
+    }
+
+    make(
+        packages,
+        _pip_repository(),
+        {},
+        str(tmpdir),
+        batch_pip=True,
+        package_jobs=2,
+    )
+
+    installed = sorted(pin for install in captured_pip_installs for pin in install)
+    assert installed == sorted(
+        f"{pkg}=={ver}" for pkg, ver in packages.items() if pkg != "python"
+    )
+    assert ["numpy==1.23.5"] in captured_pip_installs
+    assert len(captured_pip_installs) < len(installed)
+
+
+def test_make_routes_compilers_through_compiler_cache(monkeypatch, tmpdir):
+    launcher = tmpdir / "ccache"
+    launcher.write("#!/bin/sh\n")
+    launcher.chmod(0o755)
+    packages = {"opm-common": "2023.04", "boost": "1.65"}
+    repositories = {
+        "opm-common": {
+            "2023.04": {"make": "cmake", "maintainer": "someone", "depends": ["boost"]}
+        },
+        "boost": {
+            "1.65": {"make": "sh", "makefile": "boost165.sh", "maintainer": "someone"}
+        },
+    }
+    commands = []
+
+    def shell(cmd, context=None, **kwargs):
+        commands.append((" ".join(filter(None, cmd)), context))
+        return b""
+
+    monkeypatch.setattr("komodo.build.shell", shell)
+    monkeypatch.setattr("komodo.compiler_cache.shell", shell)
+    cache = CompilerCache(
+        str(tmpdir / "ccache-dir"), "5G", launcher=str(launcher), basedir=str(tmpdir)
+    )
+
+    make(
+        packages,
+        repositories,
+        {"boost165.sh": "boost165.sh"},
+        str(tmpdir / "prefix"),
+        fakeroot=str(tmpdir),
+        builddir=str(tmpdir),
+        compiler_cache=cache,
+    )
+
+    lines = [cmd for cmd, _ in commands]
+    assert lines[1:3] == [f"{launcher} --max-size 5G", f"{launcher} --zero-stats"]
+    assert lines[-1] == f"{launcher} --show-stats"
+    sh_build = next(cmd for cmd in lines if cmd.startswith("bash boost165.sh"))
+    assert f"--path {cache.bindir}:" in sh_build
+    cmake_build = next(cmd for cmd in lines if cmd.startswith("cmake "))
+    assert f"-DCMAKE_CXX_COMPILER_LAUNCHER={launcher}" in cmake_build
+    assert all(
+        context.env["CCACHE_DIR"] == cache.path
+        # paths in the workspace are relative, so they hash the same for
+        # every release name
+        and context.env["CCACHE_BASEDIR"] == str(tmpdir)
+        and context.env["CCACHE_NOHASHDIR"] == "1"
+        for _, context in commands
+        if context is not None
+    )
+    assert os.readlink(os.path.join(cache.bindir, "g++")) == str(launcher)
+
+
+def test_cmake_reuses_kept_build_directory(monkeypatch, tmpdir):
+    commands = []
+
+    def shell(cmd, context=None):
+        commands.append(" ".join(filter(None, cmd)))
+        if cmd[1] == "source":
+            (tmpdir / "builds").listdir()[0].join("CMakeCache.txt").write("")
+        return b""
+
+    monkeypatch.setattr("komodo.build.shell", shell)
+    kwargs = {
+        "fakeroot": str(tmpdir),
+        "context": ExecutionContext(cwd=str(tmpdir)),
+        "cmake_generator": "Ninja",
+        "cmake_build_dirs": str(tmpdir / "builds"),
+    }
+
+    build_cmake("opm-common", "2023.04", "source", {}, "/prefix", None, "", 4, **kwargs)
+    # another release, with its own prefix and fakeroot
+    kwargs["fakeroot"] = str(tmpdir / "other")
+    build_cmake("opm-common", "2023.04", "source", {}, "/other", None, "", 4, **kwargs)
+
+    assert commands[0].startswith("cmake source ")
+    assert "-GNinja" in commands[0]
+    assert commands[1:3] == [
+        "cmake --build . -- -j4",
+        "cmake --install . --prefix /prefix",
+    ]
+    assert commands[3].startswith("cmake source ")
+    assert f"-DDEST_PREFIX={tmpdir / 'other'}" in commands[3]
+    assert "-DCMAKE_INSTALL_PREFIX=/other" in commands[3]
+    assert commands[4:] == [
+        "cmake --build . -- -j4",
+        "cmake --install . --prefix /other",
+    ]
+    build_dirs = (tmpdir / "builds").listdir()
+    assert len(build_dirs) == 1
+    assert build_dirs[0].basename.startswith("opm-common-2023.04-")
+
+    build_cmake(
+        "opm-common", "2023.04", "source", {}, "/prefix", None, "-DX=1", 4, **kwargs
+    )
+    assert len((tmpdir / "builds").listdir()) == 2
+
+
+@pytest.mark.parametrize(
+    "ninja_version, build_command",
+    [(b"1.11.1\n", "cmake --build . -- -j3"), (b"1.13.0\n", "cmake --build . --")],
+)
+def test_cmake_gives_old_ninja_a_share_of_the_jobserver(
+    monkeypatch, tmpdir, ninja_version, build_command
+):
+    commands = []
+
+    def shell(cmd, context=None, **kwargs):
+        if cmd == "ninja --version":
+            return ninja_version
+        commands.append(" ".join(filter(None, cmd)))
+        return b""
+
+    monkeypatch.setattr("komodo.build.shell", shell)
+    jobserver = Jobserver(4)
+    try:
+        with jobserver.slot(), jobserver.slot():
+            build_cmake(
+                "opm-common",
+                "2023.04",
+                "source",
+                {},
+                "/prefix",
+                str(tmpdir),
+                "",
+                4,
+                fakeroot=str(tmpdir),
+                context=ExecutionContext(cwd=str(tmpdir)),
+                cmake_generator="Ninja",
+                jobserver=jobserver,
+            )
+    finally:
+        jobserver.close()
+
+    assert commands[1] == build_command
+
+
+@pytest.mark.parametrize(
+    "with_jobserver, make_jobs, jobs", [(False, "-j4", "4"), (True, "", "1")]
+)
+def test_sh_passes_the_jobserver_to_scripts(
+    monkeypatch, tmpdir, with_jobserver, make_jobs, jobs
+):
+    commands = []
+
+    def shell(cmd, context=None, **kwargs):
+        commands.append((" ".join(filter(None, cmd)), context))
+
+    monkeypatch.setattr("komodo.build.shell", shell)
+    jobserver = Jobserver(4)
+    try:
+        build_sh(
+            "tool",
+            "1.0",
+            str(tmpdir),
+            {"build.sh": str(tmpdir / "build.sh")},
+            "/prefix",
+            "build.sh",
+            fakeroot=str(tmpdir),
+            jobs=4,
+            pythonpath="",
+            binpath="",
+            pip="pip",
+            virtualenv=None,
+            ld_lib_path="",
+            context=ExecutionContext(cwd=str(tmpdir)),
+            jobserver=jobserver if with_jobserver else None,
+        )
+    finally:
+        jobserver.close()
+
+    assert len(commands) == 1
+    command, context = commands[0]
+    assert f"--jobs {jobs} " in command
+    assert context.env["MAKE_JOBS"] == make_jobs
+
+
+def test_run_task_does_not_count_waiting_for_a_slot():
+    jobserver = Jobserver(1)
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with jobserver.slot():
+                future = executor.submit(
+                    run_task, "tool", lambda: None, (), {}, jobserver
+                )
+                time.sleep(0.3)
+            assert future.result() < 0.2
+    finally:
+        jobserver.close()
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        content = self.content
+        while content:
+            yield content[:chunk_size]
+            content = content[chunk_size:]
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    content = b"binary artifact" * 1000
+    requests = []
+
+    class Session(object):
+        def get(self, url, stream, headers):
+            requests.append(headers)
+            if "Range" in headers:
+                offset = int(headers["Range"].strip("bytes=-"))
+                return FakeResponse(206, content[offset:])
+            return FakeResponse(200, content)
+
+    monkeypatch.setattr("komodo.build.download_session", Session)
+    yield content, requests
+
+
+def _download(tmpdir, content, **kwargs):
+    download(
+        "tool",
+        "1.0",
+        None,
+        None,
+        "/prefix",
+        url="https://example.com/tool",
+        hash="sha256:" + hashlib.sha256(content).hexdigest(),
+        fakeroot=str(tmpdir),
+        destination="bin/tool",
+        **kwargs,
+    )
+
+
+def test_download_resumes_partial_file(fake_server, tmpdir):
+    content, requests = fake_server
+    (tmpdir / "prefix" / "bin").ensure(dir=True)
+    (tmpdir / "prefix" / "bin" / "tool.partial").write_binary(content[:100])
+
+    _download(tmpdir, content)
+
+    assert requests == [{"Range": "bytes=100-"}]
+    assert (tmpdir / "prefix" / "bin" / "tool").read_binary() == content
+    assert not (tmpdir / "prefix" / "bin" / "tool.partial").exists()
+    assert os.access(tmpdir / "prefix" / "bin" / "tool", os.X_OK)
+
+
+def test_download_uses_store(fake_server, tmpdir):
+    content, requests = fake_server
+    (tmpdir / "release1" / "prefix" / "bin").ensure(dir=True)
+    (tmpdir / "release2" / "prefix" / "bin").ensure(dir=True)
+    store = str(tmpdir / "store")
+
+    _download(tmpdir / "release1", content, download_store=store)
+    _download(tmpdir / "release2", content, download_store=store)
+
+    assert len(requests) == 1
+    assert (tmpdir / "release2" / "prefix" / "bin" / "tool").read_binary() == content
+
+
+def test_concurrent_downloads_share_store(fake_server, tmpdir, monkeypatch):
+    content, requests = fake_server
+    fetch_url = komodo.build.fetch_url
+
+    def slow_fetch_url(*args):
+        time.sleep(0.05)
+        fetch_url(*args)
+
+    monkeypatch.setattr("komodo.build.fetch_url", slow_fetch_url)
+    store = str(tmpdir / "store")
+    releases = [tmpdir / f"release{number}" for number in range(4)]
+    for release in releases:
+        (release / "prefix" / "bin").ensure(dir=True)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(
+            executor.map(
+                lambda release: _download(release, content, download_store=store),
+                releases,
+            )
+        )
+
+    assert len(requests) == 1
+    for release in releases:
+        assert (release / "prefix" / "bin" / "tool").read_binary() == content
+
+
+def test_download_rejects_wrong_hash(fake_server, tmpdir):
+    (tmpdir / "prefix" / "bin").ensure(dir=True)
+
+    with pytest.raises(ValueError, match="not equal to expected hash"):
+        _download(tmpdir, b"something else")
+
+    assert (tmpdir / "prefix" / "bin").listdir() == []
@@ -0,0 +1,135 @@
+import os
+
+from komodo.build import make
+from komodo.build_cache import BuildCache, changed_paths, package_key, snapshot
+from komodo.package_version import LATEST_PACKAGE_ALIAS
+
+REPOSITORY = {
+    "python": {"3.8.6": {"make": "noop", "maintainer": "someone"}},
+    "pyaml": {
+        "20.4.0": {
+            "source": "pypi",
+            "make": "pip",
+            "maintainer": "someone",
+            "depends": ["python"],
+        }
+    },
+}
+
+
+def _fake_pip(commands):
+    def shell(cmd, **kwargs):
+        commands.append(cmd)
+        cmd = " ".join(filter(None, cmd))
+        if "pip install" not in cmd:
+            return
+        args = cmd.split()
+        root = args[args.index("--root") + 1]
+        prefix = args[args.index("--prefix") + 1]
+        site_packages = os.path.join(root + prefix, "lib", "site-packages")
+        os.makedirs(site_packages, exist_ok=True)
+        with open(os.path.join(site_packages, "pyaml.py"), "w") as module:
+            module.write("")
+
+    return shell
+
+
+def test_changed_paths_finds_new_and_modified_files(tmpdir):
+    tmpdir.join("old").write("old")
+    tmpdir.join("same").write("same")
+    before = snapshot(str(tmpdir))
+
+    tmpdir.mkdir("lib").join("new").write("new")
+    os.utime(str(tmpdir.join("old")), ns=(0, 0))
+
+    assert changed_paths(before, snapshot(str(tmpdir))) == ["lib", "lib/new", "old"]
+
+
+def test_snapshot_lists_only_changed_directories(monkeypatch, tmpdir):
+    tmpdir.mkdir("lib").join("old").write("old")
+    tmpdir.mkdir("share").join("doc").write("doc")
+    for directory in (tmpdir, tmpdir / "lib", tmpdir / "share"):
+        os.utime(str(directory), ns=(0, 0))
+    before = snapshot(str(tmpdir))
+
+    tmpdir.join("lib", "new").write("new")
+    with open(str(tmpdir / "share" / "doc"), "a") as doc:
+        doc.write(" rewritten in place")
+    listed = []
+    scandir = os.scandir
+
+    def listing(path):
+        listed.append(os.path.relpath(path, str(tmpdir)))
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", listing)
+    after = snapshot(str(tmpdir), before)
+
+    assert listed == ["lib"]
+    assert changed_paths(before, after) == ["lib/new", "share/doc"]
+    monkeypatch.undo()
+    assert after.entries == snapshot(str(tmpdir)).entries
+
+
+def test_store_and_restore(tmpdir):
+    cache = BuildCache(str(tmpdir / "cache"))
+    fakeroot = tmpdir.mkdir("fakeroot")
+    fakeroot.mkdir("bin").join("tool").write("#!/bin/sh")
+
+    cache.store("somekey", str(fakeroot), ["bin", "bin/tool"])
+    assert "somekey" in cache
+
+    restored = tmpdir.mkdir("restored")
+    assert cache.restore("somekey", str(restored))
+    assert restored.join("bin", "tool").read() == "#!/bin/sh"
+    assert not cache.restore("otherkey", str(restored))
+
+
+def test_evicts_least_recently_used(tmpdir):
+    fakeroot = tmpdir.mkdir("fakeroot")
+    fakeroot.join("data").write(os.urandom(4096), mode="wb")
+    cache = BuildCache(str(tmpdir / "cache"))
+    cache.store("first", str(fakeroot), ["data"])
+    cache.store("second", str(fakeroot), ["data"])
+    os.utime(os.path.join(cache.path, "first.tar.gz"), (1, 1))
+
+    cache.max_size = os.path.getsize(os.path.join(cache.path, "second.tar.gz"))
+    cache.evict()
+
+    assert "first" not in cache
+    assert "second" in cache
+
+
+def test_package_key_depends_on_dependencies():
+    entry = REPOSITORY["pyaml"]["20.4.0"]
+    key = package_key("pyaml", "20.4.0", entry, "/prefix", ["a"])
+
+    assert key == package_key("pyaml", "20.4.0", entry, "/prefix", ["a"])
+    assert key != package_key("pyaml", "20.4.0", entry, "/prefix", ["b"])
+    assert key != package_key("pyaml", "20.4.0", entry, "/other", ["a"])
+    assert package_key("pyaml", LATEST_PACKAGE_ALIAS, entry, "/prefix", []) is None
+    assert package_key("pyaml", "20.4.0", entry, "/prefix", [None]) is None
+
+
+def test_make_restores_cached_packages(monkeypatch, tmpdir):
+    packages = {"python": "3.8.6", "pyaml": "20.4.0"}
+    prefix = str(tmpdir / "prefix")
+    cache = BuildCache(str(tmpdir / "cache"))
+
+    commands = []
+    monkeypatch.setattr("komodo.build.shell", _fake_pip(commands))
+    for fakeroot in ("first", "second"):
+        commands.clear()
+        make(
+            packages,
+            REPOSITORY,
+            {},
+            prefix,
+            fakeroot=str(tmpdir / fakeroot),
+            build_cache=cache,
+        )
+        built = any("pip install" in " ".join(cmd) for cmd in commands)
+        assert built == (fakeroot == "first")
+
+    site_packages = str(tmpdir / "second") + prefix + "/lib/site-packages"
+    assert os.path.exists(os.path.join(site_packages, "pyaml.py"))
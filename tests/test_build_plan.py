@@ -0,0 +1,105 @@
+import io
+import json
+
+from komodo.build import make
+from komodo.build_cache import BuildCache
+from komodo.build_history import BuildHistory
+from komodo.build_plan import plan, write_plan
+
+SCRIPT = """
+while test $# -gt 0; do
+    if test "$1" = --fakeroot; then shift; FAKEROOT=$1; fi
+    shift
+done
+touch $FAKEROOT/built
+"""
+
+
+def _release(tmpdir):
+    (tmpdir / "build.sh").write(SCRIPT)
+    packages = {"python": "3.8.6", "tool": "1.0", "pyaml": "*"}
+    repositories = {
+        "python": {"3.8.6": {"make": "noop", "maintainer": "someone"}},
+        "tool": {
+            "1.0": {
+                "make": "sh",
+                "makefile": "build.sh",
+                "maintainer": "someone",
+                "depends": ["python"],
+            }
+        },
+        "pyaml": {
+            "*": {
+                "source": "pypi",
+                "make": "pip",
+                "maintainer": "someone",
+                "depends": ["python"],
+            }
+        },
+    }
+    data = {"build.sh": str(tmpdir / "build.sh")}
+    return packages, repositories, data
+
+
+def test_plan_finds_builds_in_the_cache(tmpdir):
+    packages, repositories, data = _release(tmpdir)
+    cache = BuildCache(str(tmpdir / "cache"))
+    (tmpdir / "fakeroot").mkdir()
+    (tmpdir / "tool-1.0").mkdir()
+    prefix = str(tmpdir / "prefix")
+    make(
+        {"python": "3.8.6", "tool": "1.0"},
+        repositories,
+        data,
+        prefix,
+        dlprefix=str(tmpdir),
+        fakeroot=str(tmpdir / "fakeroot"),
+        build_cache=cache,
+    )
+    history = BuildHistory(str(tmpdir / "history"))
+    history.record("python", "3.8.6", "noop", 2.0)
+    history.record("tool", "1.0", "sh", 30.0)
+
+    build_plan = plan(
+        packages,
+        repositories,
+        data,
+        prefix,
+        build_cache=cache,
+        history=history,
+        pypi_versions={"pyaml": "21.10.1"},
+    )
+
+    assert [
+        (entry["package"], entry["builder"], entry["cache"])
+        for entry in build_plan["packages"]
+    ] == [
+        ("python", "noop", "miss"),
+        ("tool", "sh", "hit"),
+        ("pyaml", "pip", "miss"),
+    ]
+    assert build_plan["packages"][2]["version"] == "21.10.1"
+    assert build_plan["packages"][0]["estimated_seconds"] == 2.0
+    assert build_plan["packages"][1]["estimated_seconds"] == 0.0
+    assert build_plan["estimated_seconds"] == 2.0
+    assert build_plan["unestimated"] == ["pyaml"]
+
+
+def test_write_plan(tmpdir):
+    packages, repositories, data = _release(tmpdir)
+    build_plan = plan(
+        packages,
+        repositories,
+        data,
+        str(tmpdir / "prefix"),
+        pypi_versions={"pyaml": "21.10.1"},
+    )
+
+    text = io.StringIO()
+    write_plan(build_plan, out=text)
+    assert "  2. tool (1.0): sh\n" in text.getvalue()
+    assert "Packages without recorded builds: python, tool, pyaml\n" in text.getvalue()
+
+    as_json = io.StringIO()
+    write_plan(build_plan, fmt="json", out=as_json)
+    assert json.loads(as_json.getvalue()) == build_plan
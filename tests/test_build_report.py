@@ -0,0 +1,108 @@
+import io
+
+from komodo.build import make
+from komodo.build_history import BuildHistory
+from komodo.build_report import bottlenecks, critical_path, report, simulate
+
+DEPENDENCIES = {
+    "python": [],
+    "numpy": ["python"],
+    "scipy": ["numpy"],
+    "pyaml": ["python"],
+    "opm": ["python"],
+}
+ORDER = ["python", "numpy", "scipy", "pyaml", "opm"]
+DURATIONS = {"python": 10.0, "numpy": 5.0, "scipy": 20.0, "pyaml": 1.0, "opm": 30.0}
+
+
+def test_critical_path():
+    length, path = critical_path(ORDER, DEPENDENCIES, DURATIONS)
+
+    assert length == 40.0
+    assert path == ["python", "opm"]
+
+
+def test_simulate():
+    assert simulate(ORDER, DEPENDENCIES, DURATIONS, 1) == sum(DURATIONS.values())
+    assert simulate(ORDER, DEPENDENCIES, DURATIONS, 2) == 41.0
+    assert simulate(ORDER, DEPENDENCIES, DURATIONS, 4) == 40.0
+
+
+def test_bottlenecks_are_on_the_critical_path():
+    assert bottlenecks(ORDER, DEPENDENCIES, DURATIONS) == [
+        ("python", 10.0),
+        ("opm", 5.0),
+    ]
+
+
+def test_history_prefers_same_version(tmpdir):
+    history = BuildHistory(str(tmpdir / "history"))
+    history.record("numpy", "1.23.5", "pip", 100)
+    history.record("numpy", "1.24.0", "pip", 4)
+    history.record("numpy", "1.24.0", "pip", 6)
+    history.record("scipy", "1.9.3", "pip", 7)
+
+    durations = history.durations({"numpy": "1.24.0", "scipy": "1.10.0", "opm": "1"})
+
+    assert durations == {"numpy": 5.0, "scipy": 7.0}
+
+
+def test_compact_keeps_the_recent_builds_of_each_version(tmpdir):
+    history = BuildHistory(str(tmpdir / "history"))
+    for seconds in range(10):
+        history.record("numpy", "1.24.0", "pip", seconds)
+    history.record("numpy", "1.23.5", "pip", 100)
+    before = history.durations({"numpy": "1.24.0", "scipy": "1.10.0"})
+
+    history.compact()
+
+    assert [entry["seconds"] for entry in history.entries()] == [5, 6, 7, 8, 9, 100]
+    assert history.durations({"numpy": "1.24.0", "scipy": "1.10.0"}) == before
+
+
+def test_make_appends_to_history(monkeypatch, tmpdir):
+    monkeypatch.setattr("komodo.build.shell", lambda cmd, **kwargs: None)
+    history = BuildHistory(str(tmpdir / "history"))
+    packages = {"python": "3.8.6", "pyaml": "20.4.0"}
+    repositories = {
+        "python": {"3.8.6": {"make": "noop", "maintainer": "someone"}},
+        "pyaml": {
+            "20.4.0": {
+                "source": "pypi",
+                "make": "pip",
+                "maintainer": "someone",
+                "depends": ["python"],
+            }
+        },
+    }
+
+    make(packages, repositories, {}, str(tmpdir), history=history)
+
+    assert [(e["package"], e["builder"]) for e in history.entries()] == [
+        ("python", "noop"),
+        ("pyaml", "pip"),
+    ]
+
+    out = io.StringIO()
+    report(packages, repositories, history, workers=[2], out=out)
+    assert "Critical path" in out.getvalue()
+    assert "Packages: 2 (0 without recorded builds)" in out.getvalue()
+
+
+def test_make_records_the_resolved_version(monkeypatch, tmpdir):
+    monkeypatch.setattr("komodo.build.shell", lambda cmd, **kwargs: None)
+    history = BuildHistory(str(tmpdir / "history"))
+    repositories = {
+        "pyaml": {"*": {"source": "pypi", "make": "pip", "maintainer": "someone"}}
+    }
+
+    make(
+        {"pyaml": "*"},
+        repositories,
+        {},
+        str(tmpdir),
+        history=history,
+        pypi_versions={"pyaml": "21.10.1"},
+    )
+
+    assert [entry["version"] for entry in history.entries()] == ["21.10.1"]
@@ -0,0 +1,67 @@
+import errno
+import os
+
+import pytest
+
+from komodo.copy_tree import copy_tree
+
+
+@pytest.fixture
+def tree(tmpdir):
+    src = tmpdir / "src"
+    (src / "bin").ensure(dir=True)
+    (src / "lib").ensure(dir=True)
+    (src / "share" / "empty").ensure(dir=True)
+    (src / "bin" / "tool").write("#!/bin/sh\n")
+    (src / "bin" / "tool").chmod(0o750)
+    os.utime(src / "bin" / "tool", (1600000000, 1600000000))
+    (src / "lib" / "libtool.so.1").write_binary(b"\0" * 100000)
+    os.symlink("libtool.so.1", src / "lib" / "libtool.so")
+    return src
+
+
+@pytest.mark.parametrize("mode", ["copy", "reflink", "hardlink"])
+def test_copy_tree_like_rsync(tree, tmpdir, mode):
+    dst = tmpdir / "dst"
+
+    assert copy_tree(str(tree), str(dst), mode=mode) == 2
+
+    assert (dst / "bin" / "tool").read() == "#!/bin/sh\n"
+    assert (dst / "bin" / "tool").stat().mode & 0o777 == 0o750
+    assert (dst / "bin" / "tool").mtime() == 1600000000
+    assert (dst / "lib" / "libtool.so.1").size() == 100000
+    assert os.readlink(dst / "lib" / "libtool.so") == "libtool.so.1"
+    assert not (dst / "share").exists()
+    hardlinked = os.path.samefile(dst / "bin" / "tool", tree / "bin" / "tool")
+    assert hardlinked == (mode == "hardlink")
+
+
+def test_copy_tree_without_copy_file_range(tree, tmpdir, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, "cross-device link")
+
+    monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+
+    copy_tree(str(tree), str(tmpdir / "dst"))
+
+    assert (tmpdir / "dst" / "lib" / "libtool.so.1").read_binary() == b"\0" * 100000
+
+
+def test_copy_tree_replaces_existing_files(tree, tmpdir):
+    dst = tmpdir / "dst"
+    (dst / "bin").ensure(dir=True)
+    (dst / "bin" / "tool").write("old")
+    (dst / "bin" / "other").write("kept")
+
+    copy_tree(str(tree), str(dst))
+
+    assert (dst / "bin" / "tool").read() == "#!/bin/sh\n"
+    assert (dst / "bin" / "other").read() == "kept"
+
+
+def test_copy_tree_keeps_empty_directories_like_rsync_a(tree, tmpdir):
+    dst = tmpdir / "dst"
+
+    copy_tree(str(tree), str(dst), prune=False)
+
+    assert (dst / "share" / "empty").isdir()
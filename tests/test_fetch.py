@@ -1,9 +1,12 @@
+import io
 import os
+import tarfile
+import time
 from unittest.mock import patch
 
 import pytest
 
-from komodo.fetch import fetch
+from komodo.fetch import extract_tarball, fetch
 from komodo.package_version import LATEST_PACKAGE_ALIAS
 
 
@@ -11,7 +14,7 @@ from komodo.package_version import LATEST_PACKAGE_ALIAS
 def captured_shell_commands(monkeypatch):
     commands = []
     with monkeypatch.context() as m:
-        m.setattr("komodo.fetch.shell", lambda cmd: commands.append(cmd))
+        m.setattr("komodo.fetch.shell", lambda cmd, **kwargs: commands.append(cmd))
         yield commands
 
 
@@ -192,3 +195,116 @@ def test_expand_jinja2_templates_in_source(captured_shell_commands, tmpdir):
         fetch(packages, repositories, str(tmpdir))
         assert captured_shell_commands[0].startswith("git clone")
         assert "https://VERYSECRETTOKEN@github.com" in captured_shell_commands[0]
+
+
+def test_fetch_concurrently_keeps_release_order(captured_shell_commands, tmpdir):
+    names = ["ert", "resdata", "semeio", "everest", "opm"]
+    packages = {name: "main" for name in names}
+    repositories = {
+        name: {
+            "main": {
+                "source": f"git://github.com/equinor/{name}.git",
+                "fetch": "git",
+                "make": "sh",
+                "maintainer": "someone",
+                "makefile": "setup-py.sh",
+            }
+        }
+        for name in names
+    }
+
+    def revision(path):
+        # the first packages take longest, so they finish last
+        name = os.path.basename(path)[: -len("-main")]
+        time.sleep(0.01 * (len(names) - names.index(name)))
+        return f"hash of {name}"
+
+    with patch("komodo.fetch.get_git_revision_hash", side_effect=revision):
+        git_hashes = fetch(packages, repositories, str(tmpdir), fetch_jobs=4)
+
+    assert list(git_hashes.items()) == [(name, f"hash of {name}") for name in names]
+    clones = sorted(cmd for cmd in captured_shell_commands if "git clone" in cmd)
+    assert len(clones) == len(names)
+
+
+def _tarball(path, members):
+    with tarfile.open(path, "w:xz") as tarball:
+        for name, kind, content in members:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            data = None
+            if kind == tarfile.SYMTYPE:
+                info.linkname = content
+            elif kind == tarfile.REGTYPE:
+                info.size = len(content)
+                data = io.BytesIO(content)
+            elif kind == tarfile.DIRTYPE:
+                info.mode = 0o755
+            tarball.addfile(info, data)
+
+
+def test_extract_tarball_returns_top_directory(tmpdir):
+    path = str(tmpdir / "tool-1.0.tar.xz")
+    _tarball(
+        path,
+        [
+            ("./tool-1.0", tarfile.DIRTYPE, None),
+            ("./tool-1.0/setup.py", tarfile.REGTYPE, b"print('setup')"),
+            ("./tool-1.0/link.py", tarfile.SYMTYPE, "setup.py"),
+        ],
+    )
+    (tmpdir / "out").mkdir()
+
+    assert extract_tarball(path, str(tmpdir / "out")) == "tool-1.0"
+    assert (tmpdir / "out" / "tool-1.0" / "link.py").read() == "print('setup')"
+
+
+@pytest.mark.parametrize(
+    "members",
+    [
+        [("../evil.py", tarfile.REGTYPE, b"")],
+        [
+            ("tool-1.0/etc", tarfile.SYMTYPE, "/etc"),
+            ("tool-1.0/etc/evil.conf", tarfile.REGTYPE, b""),
+        ],
+    ],
+)
+def test_extract_tarball_refuses_members_outside_root(tmpdir, members):
+    path = str(tmpdir / "evil.tar.xz")
+    _tarball(path, members)
+    (tmpdir / "out").mkdir()
+
+    with pytest.raises(ValueError, match="outside"):
+        extract_tarball(path, str(tmpdir / "out"))
+
+
+def test_fetch_downloads_pypi_packages_directly(captured_shell_commands, tmpdir):
+    packages = {"pyaml": "20.4.0", "private": "1.0"}
+    repositories = {
+        name: {
+            ver: {
+                "source": "pypi",
+                "make": "pip",
+                "maintainer": "someone",
+                "depends": [],
+            }
+        }
+        for name, ver in packages.items()
+    }
+
+    pyaml = {
+        "filename": "pyaml-20.4.0-py2.py3-none-any.whl",
+        "url": "https://files.example.com/pyaml-20.4.0-py2.py3-none-any.whl",
+        "digests": {"sha256": "0" * 64},
+    }
+    with patch(
+        "komodo.fetch.download_pypi",
+        return_value={"pyaml==20.4.0": pyaml, "private==1.0": None},
+    ) as download_pypi:
+        fetch(packages, repositories, str(tmpdir), pypi_jobs=4)
+
+    assert download_pypi.call_args[0][0] == ["pyaml==20.4.0", "private==1.0"]
+    assert download_pypi.call_args[1]["jobs"] == 4
+    assert len(captured_shell_commands) == 1
+    command = " ".join(captured_shell_commands[0])
+    assert command == "pip download --no-deps --dest . private==1.0"
@@ -0,0 +1,144 @@
+import os
+import subprocess
+
+import pytest
+
+from komodo.fetch import fetch
+from komodo.git_mirror import GitMirrors, submodule_url_of
+from komodo.shell import ExecutionContext
+
+
+def _git(path, *args):
+    return (
+        subprocess.check_output(
+            ["git", "-c", "user.name=x", "-c", "user.email=x@x", *args], cwd=path
+        )
+        .decode()
+        .strip()
+    )
+
+
+@pytest.fixture
+def git_repository(tmpdir):
+    path = str(tmpdir / "upstream")
+    os.mkdir(path)
+    _git(path, "init", "--quiet", "--initial-branch=main")
+    (tmpdir / "upstream" / "setup.py").write("print('setup')\n")
+    _git(path, "add", "setup.py")
+    _git(path, "commit", "--quiet", "-m", "first")
+    _git(path, "tag", "--annotate", "-m", "release", "1.0")
+    return "file://" + path, _git(path, "rev-parse", "HEAD")
+
+
+def test_checkout_has_history_and_points_to_the_remote(git_repository, tmpdir):
+    url, _ = git_repository
+    upstream = str(tmpdir / "upstream")
+    (tmpdir / "upstream" / "setup.py").write("print('second')\n")
+    _git(upstream, "commit", "--quiet", "-am", "second")
+    second = _git(upstream, "rev-parse", "HEAD")
+    (tmpdir / "cache").mkdir()
+    mirrors = GitMirrors(str(tmpdir / "mirrors"))
+    context = ExecutionContext(cwd=str(tmpdir / "cache"))
+
+    mirrors.checkout(url, "main", "tool-main", context=context)
+
+    checkout = str(tmpdir / "cache" / "tool-main")
+    assert (tmpdir / "cache" / "tool-main" / "setup.py").read() == "print('second')\n"
+    assert _git(checkout, "rev-parse", "HEAD") == second
+    # what setuptools_scm needs for a version
+    assert _git(checkout, "describe", "--tags").startswith("1.0-1-g")
+    assert _git(checkout, "remote", "get-url", "origin") == url
+    # missing blobs come from the mirror, not the remote
+    assert _git(checkout, "config", "remote.mirror.promisor") == "true"
+    assert os.path.isdir(mirrors.mirror_path(url))
+
+
+def test_mirror_is_updated_for_new_commits(git_repository, tmpdir):
+    url, _ = git_repository
+    upstream = str(tmpdir / "upstream")
+    (tmpdir / "cache").mkdir()
+    context = ExecutionContext(cwd=str(tmpdir / "cache"))
+    GitMirrors(str(tmpdir / "mirrors")).checkout(url, "main", "a", context=context)
+
+    (tmpdir / "upstream" / "setup.py").write("print('second')\n")
+    _git(upstream, "commit", "--quiet", "-am", "second")
+    second = _git(upstream, "rev-parse", "HEAD")
+    # a new run, as a run updates each mirror once
+    GitMirrors(str(tmpdir / "mirrors")).checkout(url, second, "b", context=context)
+
+    assert (tmpdir / "cache" / "b" / "setup.py").read() == "print('second')\n"
+    assert _git(str(tmpdir / "cache" / "b"), "rev-parse", "HEAD") == second
+
+
+def test_fetch_checks_out_from_mirrors(git_repository, tmpdir):
+    url, commit = git_repository
+    packages = {"tool": "1.0"}
+    repositories = {
+        "tool": {
+            "1.0": {
+                "source": url,
+                "fetch": "git",
+                "make": "sh",
+                "makefile": "setup-py.sh",
+                "maintainer": "someone",
+            }
+        }
+    }
+
+    git_hashes = fetch(
+        packages,
+        repositories,
+        str(tmpdir / "cache"),
+        pip="true",
+        git_mirrors=GitMirrors(str(tmpdir / "mirrors")),
+    )
+
+    assert git_hashes == {"tool": commit}
+    assert (tmpdir / "cache" / "tool-1.0" / "setup.py").exists()
+
+
+def test_submodules_are_checked_out_from_mirrors(git_repository, tmpdir):
+    url, _ = git_repository
+    upstream = str(tmpdir / "upstream")
+    submodule = str(tmpdir / "submodule")
+    os.mkdir(submodule)
+    _git(submodule, "init", "--quiet", "--initial-branch=main")
+    (tmpdir / "submodule" / "lib.py").write("")
+    _git(submodule, "add", "lib.py")
+    _git(submodule, "commit", "--quiet", "-m", "lib")
+    _git(
+        upstream,
+        "-c",
+        "protocol.file.allow=always",
+        "submodule",
+        "--quiet",
+        "add",
+        "../submodule",
+        "lib",
+    )
+    _git(upstream, "commit", "--quiet", "-m", "submodule")
+    (tmpdir / "cache").mkdir()
+    mirrors = GitMirrors(str(tmpdir / "mirrors"))
+    context = ExecutionContext(cwd=str(tmpdir / "cache"))
+
+    mirrors.checkout(url, "main", "tool-main", context=context)
+
+    assert (tmpdir / "cache" / "tool-main" / "lib" / "lib.py").exists()
+    submodule_url = "file://" + submodule
+    assert os.path.isdir(mirrors.mirror_path(submodule_url))
+    checkout = str(tmpdir / "cache" / "tool-main" / "lib")
+    assert _git(checkout, "remote", "get-url", "origin") == submodule_url
+
+
+@pytest.mark.parametrize(
+    "url, submodule_url, expected",
+    [
+        ("https://host/org/tool.git", "../lib.git", "https://host/org/lib.git"),
+        ("https://host/org/tool/", "./lib", "https://host/org/tool/lib"),
+        ("git@host:org/tool.git", "../lib.git", "git@host:org/lib.git"),
+        ("git@host:tool.git", "../lib.git", "git@host:lib.git"),
+        ("https://host/org/tool.git", "https://other/lib", "https://other/lib"),
+    ],
+)
+def test_submodule_url_of(url, submodule_url, expected):
+    assert submodule_url_of(url, submodule_url) == expected
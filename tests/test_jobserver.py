@@ -0,0 +1,95 @@
+import os
+import threading
+
+from komodo.jobserver import Jobserver
+from komodo.shell import ExecutionContext, shell
+
+
+def _tokens(jobserver):
+    os.set_blocking(jobserver.fds[0], False)
+    try:
+        return len(os.read(jobserver.fds[0], 1024))
+    except BlockingIOError:
+        return 0
+    finally:
+        os.set_blocking(jobserver.fds[0], True)
+
+
+def test_jobserver_holds_one_slot_per_concurrent_package():
+    jobserver = Jobserver(2)
+    try:
+        with jobserver.slot():
+            with jobserver.slot():
+                assert _tokens(jobserver) == 0
+                waiting = threading.Thread(target=jobserver.slot().__enter__)
+                waiting.start()
+                waiting.join(timeout=0.2)
+                assert waiting.is_alive()
+            waiting.join(timeout=5)
+            assert not waiting.is_alive()
+    finally:
+        jobserver.close()
+
+
+def test_released_implicit_slot_goes_to_a_waiting_package():
+    jobserver = Jobserver(2)
+    try:
+        implicit = jobserver.slot()
+        implicit.__enter__()
+        with jobserver.slot():
+            waiting = threading.Thread(target=jobserver.slot().__enter__)
+            waiting.start()
+            implicit.__exit__(None, None, None)
+            waiting.join(timeout=5)
+            assert not waiting.is_alive()
+    finally:
+        jobserver.close()
+
+
+def test_tokens_lost_by_killed_commands_are_put_back():
+    jobserver = Jobserver(2)
+    try:
+        with jobserver.slot():
+            # a make killed on a timeout, holding a token
+            os.read(jobserver.fds[0], 1)
+        with jobserver.slot():
+            waiting = threading.Thread(target=jobserver.slot().__enter__)
+            waiting.start()
+            waiting.join(timeout=5)
+            assert not waiting.is_alive()
+    finally:
+        jobserver.close()
+
+
+def test_share_takes_the_free_slots_without_waiting():
+    jobserver = Jobserver(4)
+    try:
+        with jobserver.slot(), jobserver.slot():
+            with jobserver.share(4) as jobs:
+                assert jobs == 3
+                assert _tokens(jobserver) == 0
+                with jobserver.share(4) as jobs:
+                    assert jobs == 1
+            assert _tokens(jobserver) == 2
+    finally:
+        jobserver.close()
+
+
+def test_make_uses_the_jobserver(tmpdir):
+    (tmpdir / "Makefile").write("all: a b c\na b c:\n\ttouch $@\n")
+    jobserver = Jobserver(3)
+    try:
+        context = jobserver.apply(ExecutionContext(cwd=str(tmpdir)))
+        assert context.env["MAKEFLAGS"].startswith("-j3 --jobserver-auth=")
+
+        shell("make", context=context)
+
+        assert sorted(path.basename for path in tmpdir.listdir()) == [
+            "Makefile",
+            "a",
+            "b",
+            "c",
+        ]
+        assert _tokens(jobserver) == 2
+    finally:
+        jobserver.close()
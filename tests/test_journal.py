@@ -0,0 +1,80 @@
+from komodo.build import make
+from komodo.journal import BuildJournal
+
+
+def test_resume_reads_recorded_packages(tmpdir):
+    path = str(tmpdir / "release.journal")
+    journal = BuildJournal(path)
+    journal.record("python", "abc")
+    journal.record("numpy", "def")
+    with open(path, "a") as partial:
+        partial.write('{"package": "scipy", "fing')
+
+    resumed = BuildJournal(path, resume=True)
+
+    assert resumed.is_done("python", "abc")
+    assert not resumed.is_done("numpy", "changed")
+    assert not resumed.is_done("scipy", "ghi")
+
+
+def test_journal_starts_over_without_resume(tmpdir):
+    path = str(tmpdir / "release.journal")
+    BuildJournal(path).record("python", "abc")
+
+    assert not BuildJournal(path).is_done("python", "abc")
+    assert not BuildJournal(path, resume=True).is_done("python", "abc")
+
+
+def test_unresolved_versions_are_never_done(tmpdir):
+    journal = BuildJournal(str(tmpdir / "release.journal"))
+    journal.record("ert", None)
+
+    assert not journal.is_done("ert", None)
+
+
+def test_make_resumes_after_failure(monkeypatch, tmpdir):
+    packages = {"setuptools": "44.0.1", "pyaml": "20.4.0"}
+    repositories = {
+        "setuptools": {
+            "44.0.1": {"source": "pypi", "make": "pip", "maintainer": "someone"}
+        },
+        "pyaml": {
+            "20.4.0": {
+                "source": "pypi",
+                "make": "pip",
+                "maintainer": "someone",
+                "depends": ["setuptools"],
+            }
+        },
+    }
+    path = str(tmpdir / "release.journal")
+    installed = []
+
+    def failing_shell(cmd, **kwargs):
+        cmd = " ".join(filter(None, cmd))
+        if "pyaml" in cmd:
+            raise RuntimeError("network hiccup")
+        installed.append(cmd)
+
+    monkeypatch.setattr("komodo.build.shell", failing_shell)
+    try:
+        make(packages, repositories, {}, str(tmpdir), journal=BuildJournal(path))
+    except RuntimeError:
+        pass
+    assert any("setuptools" in cmd for cmd in installed)
+
+    installed.clear()
+    monkeypatch.setattr(
+        "komodo.build.shell",
+        lambda cmd, **kwargs: installed.append(" ".join(filter(None, cmd))),
+    )
+    make(
+        packages,
+        repositories,
+        {},
+        str(tmpdir),
+        journal=BuildJournal(path, resume=True),
+    )
+
+    assert not any("setuptools" in cmd for cmd in installed)
+    assert any("pyaml" in cmd for cmd in installed)
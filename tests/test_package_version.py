@@ -1,10 +1,11 @@
+import subprocess
 import sys
 from subprocess import CalledProcessError
 from unittest.mock import patch
 
 import pytest
 
-from komodo.package_version import latest_pypi_version
+from komodo.package_version import get_git_revision_hash, latest_pypi_version
 
 
 @pytest.mark.parametrize(
@@ -36,3 +37,25 @@ def test_latest_pypi_version(cmd_stderr, expected_version):
     with patch("subprocess.check_output") as mock_check_output:
         mock_check_output.side_effect = _raise
         assert latest_pypi_version("equinor_libres") == expected_version
+
+
+@pytest.mark.parametrize("head", ["branch", "packed", "detached"])
+def test_get_git_revision_hash_reads_refs(tmpdir, head):
+    path = str(tmpdir)
+
+    def git(*args):
+        return subprocess.check_output(
+            ["git", "-c", "user.name=x", "-c", "user.email=x@x", *args], cwd=path
+        )
+
+    git("init", "--quiet", "--initial-branch=main")
+    git("commit", "--quiet", "--allow-empty", "-m", "first")
+    if head == "packed":
+        git("pack-refs", "--all")
+    elif head == "detached":
+        git("checkout", "--quiet", "--detach")
+    commit = git("rev-parse", "HEAD").decode().strip()
+
+    with patch("komodo.package_version.subprocess.check_output") as check_output:
+        assert get_git_revision_hash(path) == commit
+    check_output.assert_not_called()
@@ -0,0 +1,85 @@
+import hashlib
+from unittest.mock import patch
+
+from komodo.pypi_download import (
+    compatible_tags,
+    download_pypi,
+    select_artifact,
+    wheel_tags,
+)
+
+TAGS = ["cp311-cp311-manylinux_2_17_x86_64", "cp311-abi3-linux_x86_64", "py3-none-any"]
+
+
+def _artifact(filename, packagetype="bdist_wheel", content=b""):
+    return {
+        "filename": filename,
+        "packagetype": packagetype,
+        "url": f"https://files.example.com/{filename}",
+        "digests": {"sha256": hashlib.sha256(content).hexdigest()},
+    }
+
+
+def test_wheel_tags_expand_compressed_tag_sets():
+    assert wheel_tags("six-1.16.0-py2.py3-none-any.whl") == [
+        "py2-none-any",
+        "py3-none-any",
+    ]
+
+
+def test_compatible_tags_are_read_from_pip_debug():
+    output = (
+        b"pip version: pip 23.0\n"
+        b"Compatible tags: 2\n"
+        b"  cp311-cp311-manylinux_2_17_x86_64\n"
+        b"  py3-none-any\n"
+    )
+    with patch("komodo.pypi_download.shell", return_value=output):
+        assert compatible_tags() == [
+            "cp311-cp311-manylinux_2_17_x86_64",
+            "py3-none-any",
+        ]
+    with patch("komodo.pypi_download.shell", return_value=b"pip version: 9\n"):
+        assert compatible_tags() is None
+
+
+def test_select_artifact_prefers_the_best_wheel():
+    files = [
+        _artifact("numpy-1.26.0.tar.gz", "sdist"),
+        _artifact("numpy-1.26.0-cp311-cp311-macosx_11_0_arm64.whl"),
+        _artifact("numpy-1.26.0-cp311-abi3-linux_x86_64.whl"),
+        _artifact("numpy-1.26.0-cp311-cp311-manylinux_2_17_x86_64.whl"),
+    ]
+
+    artifact = select_artifact(files, TAGS)
+
+    assert artifact["filename"] == "numpy-1.26.0-cp311-cp311-manylinux_2_17_x86_64.whl"
+
+
+def test_select_artifact_falls_back_to_sdist():
+    files = [
+        _artifact("tool-1.0.zip", "sdist"),
+        _artifact("tool-1.0.tar.gz", "sdist"),
+        _artifact("tool-1.0-cp27-cp27m-win32.whl"),
+    ]
+
+    assert select_artifact(files, TAGS)["filename"] == "tool-1.0.tar.gz"
+    assert select_artifact(files[2:], TAGS) is None
+
+
+def test_download_pypi_skips_cached_and_leaves_unknown_to_pip(tmpdir):
+    cached = _artifact("cached-1.0-py3-none-any.whl", content=b"cached")
+    new = _artifact("new-2.0-py3-none-any.whl", content=b"new")
+    (tmpdir / cached["filename"]).write_binary(b"cached")
+    artifacts = {"cached==1.0": cached, "new==2.0": new, "missing==3.0": None}
+
+    with patch("komodo.pypi_download.compatible_tags", return_value=TAGS), patch(
+        "komodo.pypi_download.resolve",
+        side_effect=lambda requirement, *args, **kwargs: artifacts[requirement],
+    ), patch("komodo.pypi_download.fetch_url") as fetch_url:
+        downloaded = download_pypi(list(artifacts), str(tmpdir), jobs=2)
+
+    assert downloaded == artifacts
+    fetch_url.assert_called_once_with(
+        new["url"], str(tmpdir / new["filename"]), new["digests"]["sha256"]
+    )
@@ -0,0 +1,64 @@
+import base64
+import csv
+import hashlib
+
+from komodo.relocate import relocate_pip_packages
+
+OLD_PREFIX = "/workspace/release/prefix/release/root"
+NEW_PREFIX = "/prefix/release/root"
+
+
+def _record_row(root, path):
+    content = (root / path).read_binary()
+    digest = base64.urlsafe_b64encode(hashlib.sha256(content).digest())
+    return [path, "sha256=" + digest.decode().rstrip("="), str(len(content))]
+
+
+def _install_fake_package(root):
+    site_packages = root.mkdir("lib").mkdir("python3.8").mkdir("site-packages")
+    dist_info = site_packages.mkdir("foo-1.0.dist-info")
+    site_packages.mkdir("foo").join("__init__.py").write("import os\n")
+    site_packages.join("foo.pth").write(f"{OLD_PREFIX}/share/foo\n")
+    dist_info.join("direct_url.json").write(f'{{"url": "file://{OLD_PREFIX}/src/foo"}}')
+    root.mkdir("bin").join("foo").write(
+        "#!/build/env/bin/python\nimport foo\nfoo.main()\n"
+    )
+    root.join("bin", "python").write("")
+
+    rows = [
+        _record_row(site_packages, path)
+        for path in ("foo/__init__.py", "foo.pth", "foo-1.0.dist-info/direct_url.json")
+    ]
+    rows.append(_record_row(site_packages, "../../../bin/foo"))
+    rows.append(["foo-1.0.dist-info/RECORD", "", ""])
+    with open(dist_info.join("RECORD"), "w", newline="") as record:
+        csv.writer(record, lineterminator="\n").writerows(rows)
+    return site_packages
+
+
+def test_relocate_rewrites_paths_and_record(tmpdir):
+    site_packages = _install_fake_package(tmpdir)
+
+    relocate_pip_packages(str(tmpdir), OLD_PREFIX, NEW_PREFIX)
+
+    assert site_packages.join("foo.pth").read() == f"{NEW_PREFIX}/share/foo\n"
+    assert (
+        OLD_PREFIX
+        not in site_packages.join("foo-1.0.dist-info", "direct_url.json").read()
+    )
+    assert tmpdir.join("bin", "foo").read().startswith(f"#!{NEW_PREFIX}/bin/python\n")
+
+    with open(site_packages.join("foo-1.0.dist-info", "RECORD")) as record:
+        rows = list(csv.reader(record))
+    for row in rows[:-1]:
+        assert row == _record_row(site_packages, row[0])
+    assert rows[-1] == ["foo-1.0.dist-info/RECORD", "", ""]
+
+
+def test_relocate_leaves_unrelated_files_alone(tmpdir):
+    site_packages = _install_fake_package(tmpdir)
+    before = site_packages.join("foo", "__init__.py").mtime()
+
+    relocate_pip_packages(str(tmpdir), OLD_PREFIX, NEW_PREFIX)
+
+    assert site_packages.join("foo", "__init__.py").mtime() == before
@@ -0,0 +1,115 @@
+import gzip
+import lzma
+import os
+import stat
+import struct
+
+import pytest
+
+from komodo.rpm_payload import extract_rpm
+
+
+def _cpio(members):
+    archive = b""
+    for ino, (name, mode, nlink, data) in enumerate(
+        members + [("TRAILER!!!", 0, 1, b"")], start=1
+    ):
+        name = name.encode() + b"\0"
+        fields = [ino, mode, 0, 0, nlink, 1600000000, len(data)]
+        fields += [0, 0, 0, 0, len(name), 0]
+        header = b"070701" + b"".join(b"%08X" % field for field in fields)
+        archive += header + name + b"\0" * (-(len(header) + len(name)) % 4)
+        archive += data + b"\0" * (-len(data) % 4)
+    return archive
+
+
+def _header(tags):
+    index, store = b"", b""
+    for tag, value in tags.items():
+        index += struct.pack(">iiii", tag, 6, len(store), 1)
+        store += value.encode() + b"\0"
+    return (
+        b"\x8e\xad\xe8\x01\0\0\0\0"
+        + struct.pack(">II", len(tags), len(store))
+        + (index + store)
+    )
+
+
+def _rpm(path, payload, compressor=None):
+    signature = _header({})
+    tags = {1124: "cpio"}
+    if compressor is not None:
+        tags[1125] = compressor
+    with open(path, "wb") as rpm_file:
+        rpm_file.write(b"\xed\xab\xee\xdb" + b"\0" * 92)
+        rpm_file.write(signature + b"\0" * (-len(signature) % 8))
+        rpm_file.write(_header(tags))
+        rpm_file.write(payload)
+
+
+MEMBERS = [
+    ("./usr", stat.S_IFDIR | 0o755, 2, b""),
+    ("./usr/bin", stat.S_IFDIR | 0o755, 2, b""),
+    ("./usr/bin/tool", stat.S_IFREG | 0o755, 1, b"#!/bin/sh\necho tool\n"),
+    ("./usr/lib64/libtool.so.1", stat.S_IFREG | 0o644, 1, b"\x7fELF" * 1000),
+    ("./usr/lib64/libtool.so", stat.S_IFLNK | 0o777, 1, b"libtool.so.1"),
+    ("./etc/tool.conf", stat.S_IFREG | 0o644, 1, b"setting=1\n"),
+]
+
+
+@pytest.mark.parametrize(
+    "compressor, compress",
+    [(None, gzip.compress), ("gzip", gzip.compress), ("xz", lzma.compress)],
+)
+def test_extract_rpm_strips_usr(tmpdir, compressor, compress):
+    _rpm(str(tmpdir / "tool.rpm"), compress(_cpio(MEMBERS)), compressor)
+    prefix = tmpdir / "prefix"
+
+    assert extract_rpm(str(tmpdir / "tool.rpm"), str(prefix)) == 3
+
+    assert (prefix / "bin" / "tool").read_binary() == b"#!/bin/sh\necho tool\n"
+    assert os.access(prefix / "bin" / "tool", os.X_OK)
+    assert os.readlink(prefix / "lib64" / "libtool.so") == "libtool.so.1"
+    assert (prefix / "lib64" / "libtool.so.1").size() == 4000
+    assert (prefix / "etc" / "tool.conf").read() == "setting=1\n"
+    assert (prefix / "bin" / "tool").mtime() == 1600000000
+    assert not (prefix / "usr").exists()
+
+
+def test_extract_rpm_links_hard_links(tmpdir):
+    members = [
+        ("./usr/bin/python3", stat.S_IFREG | 0o755, 2, b""),
+        ("./usr/bin/python3.8", stat.S_IFREG | 0o755, 2, b"python"),
+    ]
+    payload = _cpio(members)
+    # hard links share an inode number
+    payload = payload.replace(b"070701" + b"%08X" % 2, b"070701" + b"%08X" % 1, 1)
+    _rpm(str(tmpdir / "python.rpm"), gzip.compress(payload), "gzip")
+
+    extract_rpm(str(tmpdir / "python.rpm"), str(tmpdir))
+
+    assert os.path.samefile(tmpdir / "bin" / "python3", tmpdir / "bin" / "python3.8")
+
+
+def test_extract_rpm_creates_empty_hard_links(tmpdir):
+    members = [
+        ("./usr/share/tool/a", stat.S_IFREG | 0o644, 2, b""),
+        ("./usr/share/tool/b", stat.S_IFREG | 0o644, 2, b""),
+    ]
+    payload = _cpio(members)
+    payload = payload.replace(b"070701" + b"%08X" % 2, b"070701" + b"%08X" % 1, 1)
+    _rpm(str(tmpdir / "tool.rpm"), gzip.compress(payload), "gzip")
+
+    assert extract_rpm(str(tmpdir / "tool.rpm"), str(tmpdir)) == 1
+
+    share = tmpdir / "share" / "tool"
+    assert (share / "a").read() == ""
+    assert os.path.samefile(share / "a", share / "b")
+
+
+def test_extract_rpm_refuses_members_outside_prefix(tmpdir):
+    members = [("../../evil", stat.S_IFREG | 0o644, 1, b"evil")]
+    _rpm(str(tmpdir / "evil.rpm"), gzip.compress(_cpio(members)), "gzip")
+
+    with pytest.raises(ValueError, match="outside of the prefix"):
+        extract_rpm(str(tmpdir / "evil.rpm"), str(tmpdir / "prefix"))
@@ -0,0 +1,110 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from komodo.shell import ExecutionContext, shell
+
+
+def test_shell_streams_output_to_console_and_log(tmpdir, capsys):
+    (tmpdir / "build.sh").write("echo one\necho two >&2\n")
+    log = str(tmpdir / "pkg.log")
+    context = ExecutionContext(cwd=str(tmpdir)).logging_to(log, label="pkg")
+
+    output = shell("sh build.sh", context=context)
+
+    assert output == b"one\ntwo\n"
+    assert "[pkg] one\n[pkg] two\n" in capsys.readouterr().out
+    with open(log, "rb") as log_file:
+        assert log_file.read() == b"one\ntwo\n"
+
+
+def test_shell_keeps_bounded_tail_of_streamed_output(tmpdir):
+    (tmpdir / "build.sh").write("seq 10000\nexit 3\n")
+    context = ExecutionContext(cwd=str(tmpdir), stream=True)
+
+    with pytest.raises(subprocess.CalledProcessError) as failure:
+        shell("sh build.sh", context=context)
+
+    assert failure.value.returncode == 3
+    lines = failure.value.output.split()
+    assert len(lines) == 200
+    assert lines[-1] == b"10000"
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_shell_timeout(tmpdir, stream):
+    context = ExecutionContext(cwd=str(tmpdir), stream=stream, timeout=0.2)
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        shell("sleep 10", context=context)
+
+
+def _running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # the state follows the parenthesised command name
+            return stat.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_shell_timeout_stops_children(tmpdir, stream):
+    (tmpdir / "build.sh").write("sleep 30 &\necho $! > child.pid\nwait\n")
+    context = ExecutionContext(cwd=str(tmpdir), stream=stream, timeout=0.5)
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        shell("sh build.sh", context=context)
+
+    child = int((tmpdir / "child.pid").read())
+    for _ in range(50):
+        if not _running(child):
+            break
+        time.sleep(0.01)
+    assert not _running(child)
+
+
+@pytest.mark.parametrize("timeout, own_session", [(None, False), (60, True)])
+def test_shell_runs_commands_with_a_timeout_in_their_own_session(
+    tmpdir, timeout, own_session
+):
+    (tmpdir / "sid.py").write("import os\nprint(os.getsid(0))\n")
+    context = ExecutionContext(cwd=str(tmpdir), timeout=timeout)
+
+    sid = int(shell([sys.executable, "sid.py"], context=context))
+
+    assert (sid != os.getsid(0)) == own_session
+
+
+def test_terminating_komodo_stops_commands_in_their_own_session(tmpdir):
+    (tmpdir / "build.sh").write("sleep 30 &\necho $! > child.pid\nwait\n")
+    (tmpdir / "kmd.py").write(
+        "from komodo.shell import ExecutionContext, forward_signals, shell\n"
+        "forward_signals()\n"
+        "shell('sh build.sh', context=ExecutionContext(timeout=60))\n"
+    )
+    with subprocess.Popen([sys.executable, "kmd.py"], cwd=str(tmpdir)) as komodo:
+        for _ in range(500):
+            if (tmpdir / "child.pid").exists() and (tmpdir / "child.pid").read():
+                break
+            time.sleep(0.01)
+        komodo.send_signal(signal.SIGTERM)
+        assert komodo.wait(timeout=10) == -signal.SIGTERM
+
+    child = int((tmpdir / "child.pid").read())
+    for _ in range(50):
+        if not _running(child):
+            break
+        time.sleep(0.01)
+    assert not _running(child)
+
+
+def test_shell_returns_output_without_streaming(tmpdir, capsys):
+    context = ExecutionContext(cwd=str(tmpdir))
+
+    assert shell("echo hello", context=context) == b"hello\n"
+    assert "hello" not in capsys.readouterr().out.splitlines()
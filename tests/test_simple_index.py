@@ -0,0 +1,58 @@
+import os
+
+from komodo.simple_index import (
+    SIMPLE_INDEX,
+    parse_artifact,
+    pip_source_options,
+    write_simple_index,
+)
+
+
+def test_parse_artifact():
+    assert parse_artifact("Tiny_Pkg-1.0+py3-py3-none-any.whl") == (
+        "Tiny_Pkg",
+        "1.0+py3",
+    )
+    assert parse_artifact("tiny.pkg-2.0.tar.gz") == ("tiny.pkg", "2.0")
+    assert parse_artifact("ert-main") is None
+
+
+def test_index_has_a_page_per_project(tmpdir):
+    for filename in (
+        "Tiny_Pkg-1.0+py3-py3-none-any.whl",
+        "tiny.pkg-2.0.tar.gz",
+        "other-3.0.zip",
+    ):
+        (tmpdir / filename).write("")
+    (tmpdir / "ert-main").mkdir()
+
+    assert write_simple_index(str(tmpdir)) == 2
+
+    index = tmpdir / SIMPLE_INDEX
+    assert sorted(os.listdir(index)) == ["index.html", "other", "tiny-pkg"]
+    page = (index / "tiny-pkg" / "index.html").read()
+    assert '<a href="../../Tiny_Pkg-1.0%2Bpy3-py3-none-any.whl">' in page
+    assert '<a href="../../tiny.pkg-2.0.tar.gz">' in page
+    assert "other" not in page
+
+
+def test_index_is_replaced(tmpdir):
+    (tmpdir / "old-1.0.tar.gz").write("")
+    write_simple_index(str(tmpdir))
+    os.remove(tmpdir / "old-1.0.tar.gz")
+    (tmpdir / "new-1.0.tar.gz").write("")
+
+    write_simple_index(str(tmpdir))
+
+    assert sorted(os.listdir(tmpdir / SIMPLE_INDEX)) == ["index.html", "new"]
+    assert sorted(os.listdir(tmpdir)) == [SIMPLE_INDEX, "new-1.0.tar.gz"]
+
+
+def test_pip_uses_index_when_there_is_one(tmpdir):
+    assert pip_source_options(str(tmpdir)) == ["--no-index", f"--find-links {tmpdir}"]
+
+    write_simple_index(str(tmpdir))
+
+    assert pip_source_options(str(tmpdir)) == [
+        f"--index-url file://{tmpdir / SIMPLE_INDEX}"
+    ]
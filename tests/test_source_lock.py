@@ -0,0 +1,149 @@
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+
+import pytest
+
+from komodo.fetch import fetch
+from komodo.source_lock import SourceLock
+
+
+def _git(path, *args):
+    return (
+        subprocess.check_output(
+            ["git", "-c", "user.name=x", "-c", "user.email=x@x", *args], cwd=path
+        )
+        .decode()
+        .strip()
+    )
+
+
+def _tool_repository(source, fetch_protocol, version="1.0"):
+    return {
+        "tool": {
+            version: {
+                "source": source,
+                "fetch": fetch_protocol,
+                "make": "sh",
+                "makefile": "setup-py.sh",
+                "maintainer": "someone",
+            }
+        }
+    }
+
+
+def test_lock_roundtrip(tmpdir):
+    lock = SourceLock()
+    lock.record("tool", version="1.0", source="pypi", url=None)
+    lock.record("tool", filename="tool-1.0.tar.gz", sha256="0" * 64)
+    lock.write(str(tmpdir / "release.lock"))
+
+    assert SourceLock.load(str(tmpdir / "release.lock")).packages == {
+        "tool": {
+            "version": "1.0",
+            "source": "pypi",
+            "filename": "tool-1.0.tar.gz",
+            "sha256": "0" * 64,
+        }
+    }
+
+
+def test_from_lock_checks_out_the_locked_commit(tmpdir):
+    upstream = str(tmpdir / "upstream")
+    os.mkdir(upstream)
+    _git(upstream, "init", "--quiet", "--initial-branch=main")
+    (tmpdir / "upstream" / "setup.py").write("print('first')\n")
+    _git(upstream, "add", "setup.py")
+    _git(upstream, "commit", "--quiet", "-m", "first")
+    first = _git(upstream, "rev-parse", "HEAD")
+    repositories = _tool_repository("file://" + upstream, "git", version="main")
+
+    lock = SourceLock()
+    fetch({"tool": "main"}, repositories, str(tmpdir / "a"), pip="true", lock=lock)
+    assert lock.get("tool") == {
+        "version": "main",
+        "source": "file://" + upstream,
+        "fetch": "git",
+        "commit": first,
+    }
+
+    (tmpdir / "upstream" / "setup.py").write("print('second')\n")
+    _git(upstream, "commit", "--quiet", "-am", "second")
+    git_hashes = fetch(
+        {"tool": "main"}, repositories, str(tmpdir / "b"), pip="true", from_lock=lock
+    )
+
+    assert git_hashes == {"tool": first}
+    assert (tmpdir / "b" / "tool-main" / "setup.py").read() == "print('first')\n"
+
+
+def test_from_lock_keeps_cached_files(tmpdir, monkeypatch):
+    commands = []
+    monkeypatch.setattr(
+        "komodo.fetch.shell", lambda cmd, **kwargs: commands.append(cmd)
+    )
+    (tmpdir / "cache").mkdir()
+    tarball = str(tmpdir / "cache" / "tool-1.0.tar.gz")
+    with tarfile.open(tarball, "w:gz") as archive:
+        info = tarfile.TarInfo("tool-1.0/setup.py")
+        info.size = 5
+        archive.addfile(info, io.BytesIO(b"setup"))
+    with open(tarball, "rb") as archive:
+        sha256 = hashlib.sha256(archive.read()).hexdigest()
+    from_lock = SourceLock(
+        {"tool": {"version": "1.0", "filename": "tool-1.0.tar.gz", "sha256": sha256}}
+    )
+    repositories = _tool_repository("https://example.com/tool-1.0.tar.gz", "https")
+
+    lock = SourceLock()
+    fetch(
+        {"tool": "1.0"},
+        repositories,
+        str(tmpdir / "cache"),
+        lock=lock,
+        from_lock=from_lock,
+    )
+
+    assert commands == []
+    assert (tmpdir / "cache" / "tool-1.0" / "setup.py").read() == "setup"
+    assert lock.get("tool")["sha256"] == sha256
+
+
+def test_from_lock_keeps_cached_pip_downloads(tmpdir, monkeypatch):
+    commands = []
+    monkeypatch.setattr(
+        "komodo.fetch.shell", lambda cmd, **kwargs: commands.append(cmd)
+    )
+    monkeypatch.setattr(
+        "komodo.fetch.latest_pypi_version", lambda package: pytest.fail(package)
+    )
+    (tmpdir / "cache").mkdir()
+    (tmpdir / "cache" / "tool-1.2.tar.gz").write("sdist")
+    sha256 = hashlib.sha256(b"sdist").hexdigest()
+    from_lock = SourceLock(
+        {
+            "tool": {
+                "version": "1.2",
+                "source": "pypi",
+                "filename": "tool-1.2.tar.gz",
+                "sha256": sha256,
+            }
+        }
+    )
+    repositories = {
+        "tool": {"*": {"source": "pypi", "make": "pip", "maintainer": "someone"}}
+    }
+
+    lock = SourceLock()
+    fetch(
+        {"tool": "*"},
+        repositories,
+        str(tmpdir / "cache"),
+        lock=lock,
+        from_lock=from_lock,
+    )
+
+    assert commands == []
+    assert lock.get("tool") == from_lock.get("tool")
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import subprocess
+
+import pytest
+
+from komodo.fetch import fetch
+from komodo.source_store import SourceStore, remote_commit
+
+
+@pytest.fixture
+def git_repository(tmpdir):
+    path = str(tmpdir / "upstream")
+
+    def git(*args):
+        return subprocess.check_output(
+            ["git", "-c", "user.name=x", "-c", "user.email=x@x", *args], cwd=path
+        )
+
+    os.mkdir(path)
+    git("init", "--quiet", "--initial-branch=main")
+    (tmpdir / "upstream" / "setup.py").write("print('setup')\n")
+    git("add", "setup.py")
+    git("commit", "--quiet", "-m", "first")
+    git("tag", "--annotate", "-m", "release", "1.0")
+    commit = git("rev-parse", "HEAD").decode().strip()
+    return "file://" + path, commit
+
+
+def test_remote_commit_peels_annotated_tags(git_repository):
+    url, commit = git_repository
+
+    assert remote_commit(url, "1.0") == commit
+    assert remote_commit(url, "main") == commit
+    assert remote_commit(url, "missing") is None
+    assert remote_commit(url, commit) == commit
+
+
+def test_store_downloads_files_once(tmpdir):
+    store = SourceStore(str(tmpdir / "store"))
+    downloads = []
+
+    def download(path):
+        downloads.append(path)
+        with open(path, "w") as tarball:
+            tarball.write("tarball")
+
+    for release in ("a", "b"):
+        (tmpdir / release).mkdir()
+        dst = str(tmpdir / release / "tool-1.0.tar.gz")
+        store.file("https://example.com/tool-1.0.tar.gz", None, dst, download)
+        assert (tmpdir / release / "tool-1.0.tar.gz").read() == "tarball"
+
+    assert len(downloads) == 1
+    assert os.path.samefile(
+        tmpdir / "a" / "tool-1.0.tar.gz", tmpdir / "b" / "tool-1.0.tar.gz"
+    )
+
+
+def test_store_replaces_files_that_do_not_match_their_sha256(tmpdir):
+    store = SourceStore(str(tmpdir / "store"))
+    contents = iter(["old", "new"])
+
+    def download(path):
+        with open(path, "w") as tarball:
+            tarball.write(next(contents))
+
+    url = "https://example.com/tool-1.0.tar.gz"
+    dst = str(tmpdir / "tool-1.0.tar.gz")
+    store.file(url, None, dst, download)
+    store.file(url, hashlib.sha256(b"new").hexdigest(), dst, download)
+
+    assert (tmpdir / "tool-1.0.tar.gz").read() == "new"
+    store.file(url, hashlib.sha256(b"new").hexdigest(), dst, download)
+    assert (tmpdir / "tool-1.0.tar.gz").read() == "new"
+
+
+def test_fetch_takes_git_checkouts_from_store(git_repository, tmpdir, capsys):
+    url, commit = git_repository
+    packages = {"tool": "1.0"}
+    repositories = {
+        "tool": {
+            "1.0": {
+                "source": url,
+                "fetch": "git",
+                "make": "sh",
+                "makefile": "setup-py.sh",
+                "maintainer": "someone",
+            }
+        }
+    }
+    store = SourceStore(str(tmpdir / "store"))
+
+    for cache in ("cache-a", "cache-b"):
+        git_hashes = fetch(
+            packages,
+            repositories,
+            str(tmpdir / cache),
+            pip="true",
+            source_store=store,
+        )
+        assert git_hashes == {"tool": commit}
+        assert (tmpdir / cache / "tool-1.0" / "setup.py").read() == "print('setup')\n"
+
+    assert f"Using {commit} from the source store" in capsys.readouterr().out
+    assert len(store.entries()) == 1
+
+    # writes into one release's sources stay there
+    with open(tmpdir / "cache-a" / "tool-1.0" / "setup.py", "a") as setup:
+        setup.write("print('patched')\n")
+    assert (tmpdir / "cache-b" / "tool-1.0" / "setup.py").read() == "print('setup')\n"
+
+
+def test_evict_least_recently_used(tmpdir):
+    store = SourceStore(str(tmpdir / "store"))
+    for age, name in enumerate(["new", "old", "older"]):
+        store.file(
+            name,
+            None,
+            str(tmpdir / name),
+            lambda path: open(path, "w").write("x" * 100),
+        )
+        # the store entry is hard linked to the file in the release
+        os.utime(tmpdir / name, (1000 - age, 1000 - age))
+
+    assert store.evict(max_size=150) == 200
+
+    entries = store.entries()
+    assert len(entries) == 1
+    assert os.path.samefile(entries[0][2], tmpdir / "new")
@@ -0,0 +1,37 @@
+import json
+
+from komodo import trace
+from komodo.shell import shell
+
+
+def test_trace_records_nested_spans(tmpdir):
+    trace.start()
+    try:
+        with trace.span("build", "phase"):
+            shell("true")
+    finally:
+        trace.stop(str(tmpdir / "trace.json"))
+
+    with open(tmpdir / "trace.json") as trace_file:
+        events = json.load(trace_file)["traceEvents"]
+
+    assert [(event["name"], event["cat"]) for event in events] == [
+        ("true", "shell"),
+        ("build", "phase"),
+    ]
+    command, phase = events
+    assert all(event["ph"] == "X" for event in events)
+    assert phase["ts"] <= command["ts"]
+    assert command["ts"] + command["dur"] <= phase["ts"] + phase["dur"]
+    assert command["args"]["command"] == "true"
+    assert "children_user_cpu_s" in command["args"]
+
+
+def test_spans_are_not_recorded_when_tracing_is_off():
+    with trace.span("build", "phase"):
+        pass
+
+    tracer = trace.start()
+    trace.stop("/dev/null")
+
+    assert tracer.events == []
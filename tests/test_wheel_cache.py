@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+from komodo.fetch import fetch
+from komodo.simple_index import SIMPLE_INDEX
+from komodo.source_lock import SourceLock, file_sha256
+from komodo.wheel_cache import WheelCache
+
+
+@pytest.fixture
+def fake_pip(monkeypatch):
+    builds = []
+
+    def download(cmd, context=None, **kwargs):
+        with open(os.path.join(context.cwd, "lasio-0.30.tar.gz"), "w") as sdist:
+            sdist.write("sdist")
+
+    def pip_debug(cmd, context=None, **kwargs):
+        return (
+            b"sys.version: 3.8.6\n"
+            b"Compatible tags: 2\n"
+            b"  cp38-cp38-manylinux_2_17_x86_64\n"
+            b"  py3-none-any\n"
+        )
+
+    def wheel_cache_shell(cmd, context=None, **kwargs):
+        cmd = " ".join(filter(None, cmd))
+        builds.append(cmd)
+        wheel_dir = cmd.split("--wheel-dir ")[1].split()[0]
+        with open(os.path.join(wheel_dir, "lasio-0.30-py3-none-any.whl"), "w") as w:
+            w.write("wheel")
+        return b""
+
+    monkeypatch.setattr("komodo.fetch.shell", download)
+    monkeypatch.setattr("komodo.wheel_cache.shell", wheel_cache_shell)
+    monkeypatch.setattr("komodo.pypi_download.shell", pip_debug)
+    yield builds
+
+
+def test_fetch_replaces_sdists_with_cached_wheels(fake_pip, tmpdir):
+    packages = {"lasio": "0.30"}
+    repositories = {
+        "lasio": {
+            "0.30": {
+                "source": "pypi",
+                "make": "pip",
+                "maintainer": "someone",
+            }
+        }
+    }
+    wheel_cache = WheelCache(str(tmpdir / "wheels"))
+
+    for outdir in ("first", "second"):
+        fetch(packages, repositories, str(tmpdir / outdir), wheel_cache=wheel_cache)
+        assert sorted(os.listdir(str(tmpdir / outdir))) == [
+            SIMPLE_INDEX,
+            "lasio-0.30-py3-none-any.whl",
+        ]
+
+    assert len(fake_pip) == 1
+
+
+def test_fetch_keeps_sdists_of_packages_with_makeopts(fake_pip, tmpdir):
+    packages = {"lasio": "0.30"}
+    repositories = {
+        "lasio": {
+            "0.30": {
+                "source": "pypi",
+                "make": "pip",
+                "makeopts": "--no-build-isolation",
+                "maintainer": "someone",
+            }
+        }
+    }
+    wheel_cache = WheelCache(str(tmpdir / "wheels"))
+
+    fetch(packages, repositories, str(tmpdir / "cache"), wheel_cache=wheel_cache)
+
+    assert "lasio-0.30.tar.gz" in os.listdir(str(tmpdir / "cache"))
+    assert fake_pip == []
+
+
+def test_wheel_cache_entry_depends_on_the_target_python(fake_pip, tmpdir):
+    wheel_cache = WheelCache(str(tmpdir / "wheels"))
+    entry = os.path.basename(wheel_cache.entry("/cache/lasio-0.30.tar.gz"))
+
+    assert entry == "lasio-0.30.tar.gz-cp38-cp38-manylinux_2_17_x86_64"
+
+
+def test_lock_records_the_cached_wheel(fake_pip, tmpdir, monkeypatch):
+    packages = {"lasio": "0.30"}
+    repositories = {
+        "lasio": {"0.30": {"source": "pypi", "make": "pip", "maintainer": "someone"}}
+    }
+    wheel_cache = WheelCache(str(tmpdir / "wheels"))
+    outdir = str(tmpdir / "downloads")
+    lock = SourceLock()
+    fetch(packages, repositories, outdir, wheel_cache=wheel_cache, lock=lock)
+
+    wheel = os.path.join(outdir, "lasio-0.30-py3-none-any.whl")
+    assert lock.get("lasio")["filename"] == "lasio-0.30-py3-none-any.whl"
+    assert lock.get("lasio")["sha256"] == file_sha256(wheel)
+    assert "url" not in lock.get("lasio")
+
+    def no_download(cmd, context=None, **kwargs):
+        raise AssertionError(f"unexpected download: {cmd}")
+
+    monkeypatch.setattr("komodo.fetch.shell", no_download)
+    fetch(
+        packages,
+        repositories,
+        outdir,
+        wheel_cache=wheel_cache,
+        lock=SourceLock(),
+        from_lock=lock,
+    )
+    assert os.path.isfile(wheel)